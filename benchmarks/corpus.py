@@ -0,0 +1,111 @@
+from typing import List, Dict, Optional
+import random
+from pathlib import Path
+
+
+_words = ['model', 'network', 'latent', 'variational', 'inference', 'gradient', 'training', 'dataset', 'benchmark',
+          'representation', 'disentangled', 'generative', 'adversarial', 'encoder', 'decoder', 'posterior', 'prior',
+          'likelihood', 'sampling', 'optimization', 'regularization', 'convolutional', 'attention', 'transformer',
+          'embedding', 'robustness', 'causal', 'structure', 'evaluation', 'experiment', 'baseline', 'accuracy',
+          'the', 'of', 'and', 'a', 'to', 'in', 'is', 'we', 'that', 'for', 'with', 'this', 'on', 'by', 'are', 'as']
+
+_github_users = ['felixludos', 'pytorch', 'google-research', 'openai', 'deepmind', 'facebookresearch', 'huggingface']
+_other_urls = ['https://arxiv.org/abs/{}.{:05d}', 'https://doi.org/10.{}/{:05d}', 'http://www.example.org/{}/{}']
+
+
+class CorpusGenerator:
+	'''
+	Generates a reproducible corpus of synthetic papers (PDFs) with fitz.
+
+	Each document has a number of text pages (with embedded GitHub and other URLs in the text and as link
+	annotations), pages with images, and optionally "scanned" pages which are only a rendered image of a
+	text page (so they contain no text layer at all).
+	'''
+	def __init__(self, root, seed=0, words_per_page=450, urls_per_page=1., links_per_page=1.,
+	             image_every=4, image_size=256, scanned_fraction=0.):
+		self.root = Path(root)
+		self.seed = seed
+		self.words_per_page = words_per_page
+		self.urls_per_page = urls_per_page
+		self.links_per_page = links_per_page
+		self.image_every = image_every
+		self.image_size = image_size
+		self.scanned_fraction = scanned_fraction
+
+
+	def _url(self, rng):
+		if rng.random() < 0.5:
+			return f'https://github.com/{rng.choice(_github_users)}/repo-{rng.randrange(1000)}'
+		fmt = rng.choice(_other_urls)
+		return fmt.format(rng.randrange(1000, 3000), rng.randrange(100000))
+
+	def _count(self, rng, rate):
+		num = int(rate)
+		return num + (rng.random() < rate - num)
+
+	def _paragraph(self, rng, num_words):
+		words = [rng.choice(_words) for _ in range(num_words)]
+		for _ in range(self._count(rng, self.urls_per_page)):
+			words.insert(rng.randrange(len(words) + 1), self._url(rng))
+		return ' '.join(words)
+
+	def _image(self, rng, fitz):
+		size = self.image_size
+		samples = bytes(rng.getrandbits(8) for _ in range(size * size * 3))
+		return fitz.Pixmap(fitz.csRGB, size, size, samples, 0)
+
+	def _text_page(self, doc, rng, fitz, with_image=False):
+		page = doc.new_page()
+		rect = page.rect + (50, 50, -50, -50)
+		text = self._paragraph(rng, self.words_per_page)
+		if with_image:
+			img_rect = fitz.Rect(rect.x0, rect.y1 - 200, rect.x0 + 200, rect.y1)
+			page.insert_image(img_rect, pixmap=self._image(rng, fitz))
+			rect = fitz.Rect(rect.x0, rect.y0, rect.x1, rect.y1 - 210)
+		page.insert_textbox(rect, text, fontsize=9)
+		for i in range(self._count(rng, self.links_per_page)):
+			y = 30 + 12 * i
+			page.insert_link({'kind': fitz.LINK_URI, 'from': fitz.Rect(50, y, 250, y + 10), 'uri': self._url(rng)})
+		return page
+
+	def _scanned_page(self, doc, rng, fitz):
+		tmp = fitz.open()
+		self._text_page(tmp, rng, fitz)
+		pix = tmp[0].get_pixmap(dpi=100)
+		tmp.close()
+		page = doc.new_page()
+		page.insert_image(page.rect, pixmap=pix)
+		return page
+
+
+	def generate(self, name: str, pages: int, scanned_fraction: Optional[float] = None, seed: Optional[int] = None):
+		'''Generates a single document with ``pages`` pages and returns its path.'''
+		import fitz
+		if scanned_fraction is None:
+			scanned_fraction = self.scanned_fraction
+		rng = random.Random(f'{self.seed if seed is None else seed}-{name}-{pages}')
+		path = self.root / f'{name}.pdf'
+		path.parent.mkdir(parents=True, exist_ok=True)
+
+		doc = fitz.open()
+		for n in range(pages):
+			if rng.random() < scanned_fraction:
+				self._scanned_page(doc, rng, fitz)
+			else:
+				self._text_page(doc, rng, fitz, with_image=self.image_every and n % self.image_every == 0)
+		doc.save(str(path), garbage=3, deflate=True)
+		doc.close()
+		return path
+
+	def generate_corpus(self, page_counts=(1, 8, 30, 120), scanned_fractions=(0., 1.)) -> List[Dict]:
+		'''Generates one document for every combination of page count and fraction of scanned pages.'''
+		docs = []
+		for pages in page_counts:
+			for scanned in scanned_fractions:
+				name = f'paper-{pages}p-{int(scanned * 100)}scan'
+				path = self.root / f'{name}.pdf'
+				if not path.exists():
+					path = self.generate(name, pages, scanned_fraction=scanned)
+				docs.append({'name': name, 'path': path, 'pages': pages, 'scanned': scanned,
+				             'bytes': path.stat().st_size})
+		return docs
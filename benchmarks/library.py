@@ -0,0 +1,158 @@
+from typing import List, Dict, Tuple, Iterator
+import random
+from pathlib import Path
+
+from src.processing import File_Processor
+
+from .corpus import _words
+
+
+_first_names = ['Ada', 'Alan', 'Grace', 'Claude', 'Yoshua', 'Geoffrey', 'Fei-Fei', 'Judea', 'Daphne', 'Yann']
+_last_names = ['Lovelace', 'Turing', 'Hopper', 'Shannon', 'Bengio', 'Hinton', 'Li', 'Pearl', 'Koller', 'LeCun',
+               'Schmidhuber', 'Ludwig', 'Schoelkopf', 'Locatello', 'Bauer']
+_paper_types = ['journalArticle', 'conferencePaper', 'preprint']
+_tags = ['deep learning', 'causality', 'generative models', 'robotics', 'reinforcement learning', 'theory']
+
+
+class SyntheticLibrary:
+	'''
+	Generates a reproducible Zotero library (as returned by the web API) of ``num_items`` papers.
+
+	Every paper has a "PDF" linked file attachment in ``Papers/zotero`` (named the way the ``file-processor``
+	would name it), and some (``wordcloud_fraction``) have a "Wordcloud" linked file in ``Papers/wordclouds``.
+	The attachment paths are relative to the OneDrive root (``attachments:...``), see ``create_files``.
+
+	If ``processed``, the library looks like it does after ``process`` and ``sharing`` have run: the
+	attachments have share links, and the papers have code links notes, Semantic/Google Scholar links, etc.
+	'''
+	def __init__(self, num_items: int, seed=0, num_collections=20, wordcloud_fraction=0.5, library_id='0',
+	             processed=False):
+		self.num_items = num_items
+		self.seed = seed
+		self.num_collections = num_collections
+		self.wordcloud_fraction = wordcloud_fraction
+		self.library_id = str(library_id)
+		self.processed = processed
+
+
+	def _base(self, key):
+		return {'key': key, 'version': 1, 'library': {'type': 'user', 'id': self.library_id},
+		        'links': {}, 'meta': {}}
+
+	def collections(self) -> List[Dict]:
+		rng = random.Random(f'{self.seed}-collections')
+		collections = []
+		for i in range(self.num_collections):
+			key = f'C{i:07d}'
+			parent = collections[rng.randrange(len(collections))]['key'] if i and rng.random() < 0.3 else False
+			collections.append({**self._base(key), 'meta': {'numCollections': 0, 'numItems': 0},
+			                    'data': {'key': key, 'version': 1, 'name': f'Topic {i}',
+			                             'parentCollection': parent, 'relations': {}}})
+		for collection in collections:
+			parent = collection['data']['parentCollection']
+			if parent:
+				collections[int(parent[1:])]['meta']['numCollections'] += 1
+		return collections
+
+	def paper(self, i: int, rng: random.Random) -> Dict:
+		key = f'I{i:07d}'
+		creators = [{'creatorType': 'author', 'firstName': rng.choice(_first_names),
+		             'lastName': rng.choice(_last_names)} for _ in range(rng.randint(1, 4))]
+		year = rng.randint(1990, 2023)
+		date = f'{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
+		if len(creators) > 2:
+			summary = f'{creators[0]["lastName"]} et al.'
+		elif len(creators) == 2:
+			summary = f'{creators[0]["lastName"]} and {creators[1]["lastName"]}'
+		else:
+			summary = creators[0]['lastName']
+		title = ' '.join(rng.choice(_words[:32]) for _ in range(rng.randint(3, 10))).capitalize() + f' {i}'
+		url = f'http://arxiv.org/abs/{rng.randint(1000, 2300)}.{rng.randrange(100000):05d}' \
+			if rng.random() < 0.5 else ''
+		collections = [f'C{rng.randrange(self.num_collections):07d}'] if self.num_collections else []
+		paper = {**self._base(key), 'meta': {'creatorSummary': summary, 'parsedDate': date, 'numChildren': 1},
+		         'data': {'key': key, 'version': 1, 'itemType': rng.choice(_paper_types), 'title': title,
+		                  'creators': creators, 'abstractNote': '', 'date': date, 'url': url, 'accessDate': '',
+		                  'extra': '', 'tags': [{'tag': tag} for tag in rng.sample(_tags, rng.randint(0, 2))],
+		                  'collections': collections, 'relations': {}, 'dateAdded': f'{date}T12:00:00Z',
+		                  'dateModified': f'{date}T12:00:00Z'}}
+		if self.processed:
+			paper['links']['alternate'] = {'href': f'https://www.zotero.org/users/{self.library_id}/items/{key}'}
+			paper['data'].update(shortTitle=title.split(' ')[0], libraryCatalog='arXiv.org',
+			                     DOI=f'10.{rng.randint(1000, 9999)}/{key.lower()}', accessDate=f'{date}T12:00:00Z')
+			if len(url):
+				paper['data']['archiveID'] = 'arXiv:' + url.split('/')[-1]
+		return paper
+
+	def linked_file(self, key: str, parent: str, title: str, path: str, content_type: str) -> Dict:
+		return {**self._base(key), 'meta': {},
+		        'data': {'key': key, 'version': 1, 'parentItem': parent, 'itemType': 'attachment',
+		                 'linkMode': 'linked_file', 'title': title, 'accessDate': '', 'url': '', 'note': '',
+		                 'contentType': content_type, 'charset': '', 'path': f'attachments:{path}',
+		                 'tags': [], 'relations': {}}}
+
+	def linked_url(self, key: str, parent: str, title: str, url: str) -> Dict:
+		return {**self._base(key), 'meta': {},
+		        'data': {'key': key, 'version': 1, 'parentItem': parent, 'itemType': 'attachment',
+		                 'linkMode': 'linked_url', 'title': title, 'accessDate': '', 'url': url, 'note': '',
+		                 'contentType': '', 'charset': '', 'tags': [], 'relations': {}}}
+
+	def note(self, key: str, parent: str, note: str) -> Dict:
+		return {**self._base(key), 'meta': {},
+		        'data': {'key': key, 'version': 1, 'parentItem': parent, 'itemType': 'note', 'note': note,
+		                 'tags': [], 'relations': {}}}
+
+	def children(self, i: int, paper: Dict, rng: random.Random) -> List[Dict]:
+		key = paper['key']
+		name = File_Processor.gen_file_name(None, paper)
+		children = [self.linked_file(f'P{i:07d}', key, 'PDF', f'Papers/zotero/{name}.pdf', 'application/pdf')]
+		if rng.random() < self.wordcloud_fraction:
+			children.append(self.linked_file(f'W{i:07d}', key, 'Wordcloud', f'Papers/wordclouds/{name}.jpg',
+			                                 'image/jpg'))
+		if self.processed:
+			for child in children:
+				child['data']['url'] = f'https://1drv.ms/b/s!{child["key"].lower()}'
+				if child['data']['title'] == 'Wordcloud':
+					child['data']['note'] = ';'.join(rng.sample(_words[:32], 20))
+			links = [f'https://github.com/user{rng.randrange(1000)}/repo-{rng.randrange(1000)}'
+			         for _ in range(rng.randint(1, 3))]
+			lines = ['<p>Code Links</p>', *[f'<p><a href="{link}" rel="noopener noreferrer nofollow">{link}</a></p>'
+			                                 for link in links]]
+			children.append(self.note(f'N{i:07d}', key, '\n'.join(lines)))
+			children.append(self.linked_url(f'S{i:07d}', key, 'Semantic Scholar',
+			                                f'https://www.semanticscholar.org/paper/{rng.getrandbits(64):016x}'))
+			children.append(self.linked_url(f'G{i:07d}', key, 'Google Scholar',
+			                                f'https://scholar.google.com/scholar?as_q=paper+{i}'))
+		return children
+
+	def papers(self) -> Iterator[Tuple[Dict, List[Dict]]]:
+		'''Generates each paper with its children.'''
+		rng = random.Random(f'{self.seed}-items')
+		for i in range(self.num_items):
+			paper = self.paper(i, rng)
+			yield paper, self.children(i, paper, rng)
+
+	def items(self) -> List[Dict]:
+		items = []
+		for paper, children in self.papers():
+			items.append(paper)
+			items.extend(children)
+		return items
+
+	def generate(self) -> Tuple[List[Dict], List[Dict]]:
+		return self.items(), self.collections()
+
+
+	@staticmethod
+	def create_files(items: List[Dict], root) -> int:
+		'''Creates an (empty) file for every linked file attachment in ``items`` under ``root``.'''
+		root = Path(root)
+		num = 0
+		for item in items:
+			path = item['data'].get('path', '')
+			if path.startswith('attachments:'):
+				path = root / path[len('attachments:'):]
+				path.parent.mkdir(parents=True, exist_ok=True)
+				path.touch()
+				num += 1
+		return num
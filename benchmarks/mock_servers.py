@@ -0,0 +1,598 @@
+'''
+Local stand-ins for the web APIs used by omni-cite, so the scripts can be run (and benchmarked) offline.
+
+Only the subset of each API that omni-cite actually uses is implemented:
+
+- ``MockZotero``: items (top, children, single items, by collection) with the usual query parameters
+  (``q``, ``itemType``, ``tag``, ``itemKey``, ``since``, ``limit``, ``start``, and ``format=versions``), the trash
+  (items with ``deleted`` set, which are excluded otherwise), ``itemFields``, collections, ``deleted``, and
+  writing (create/update via ``POST items``, ``DELETE items``). Reads with an ``If-Modified-Since-Version``
+  of the current library version are answered with a 304.
+- ``MockGraph``: ``$batch`` with item metadata (``GET /me/drive/root:/{path}``, which supports ``If-None-Match``)
+  and ``createLink`` requests, and listing a directory.
+- ``MockNotion``: retrieving and querying (by ``last_edited_time`` or text properties) a database, creating/updating pages, and
+  appending/deleting blocks.
+
+All servers can add a fixed ``latency`` (plus random ``jitter``) to every request and simulate throttling,
+either for a random fraction of requests (``throttle_rate``) or whenever more than ``max_rps`` requests per
+second arrive. Throttled requests are answered with a 429 and a ``Retry-After`` header the same way the real
+service does.
+'''
+from typing import Dict, List, Optional, Tuple
+import re
+import datetime
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import Counter
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class _Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'  # keep-alive
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		pass
+
+	def _handle(self):
+		server: MockServer = self.server.mock
+		length = int(self.headers.get('Content-Length') or 0)
+		body = self.rfile.read(length) if length else None
+		if body is not None:
+			try:
+				body = json.loads(body)
+			except ValueError:
+				pass
+		url = urlparse(self.path)
+		status, payload, headers = server.respond(self.command, unquote(url.path), parse_qs(url.query), body,
+		                                          self.headers)
+		data = b'' if payload is None else json.dumps(payload).encode()
+		self.send_response(status)
+		if payload is not None:
+			self.send_header('Content-Type', 'application/json')
+		for key, value in (headers or {}).items():
+			self.send_header(key, str(value))
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _handle
+
+
+class MockServer:
+	'''
+	Base class of the mock servers: serves in a background thread on ``host:port`` (port 0 picks a free port).
+
+	Subclasses implement ``handle`` which returns the status, json payload and headers of the response.
+	'''
+	service = 'mock'
+
+	def __init__(self, host='127.0.0.1', port=0, latency=0., jitter=0., throttle_rate=0., max_rps=None,
+	             retry_after=1, seed=0):
+		self.host = host
+		self.port = port
+		self.latency = latency
+		self.jitter = jitter
+		self.throttle_rate = throttle_rate
+		self.max_rps = max_rps
+		self.retry_after = retry_after
+		self._rng = random.Random(seed)
+		self._lock = threading.Lock()
+		self._window = [time.monotonic(), 0]
+		self._server = None
+		self._thread = None
+		self.requests = Counter()
+		self.throttled = Counter()
+
+	@property
+	def url(self):
+		return f'http://{self.host}:{self.port}'
+
+	def start(self):
+		self._server = ThreadingHTTPServer((self.host, self.port), _Handler)
+		self._server.daemon_threads = True
+		self._server.mock = self
+		self.port = self._server.server_address[1]
+		self._thread = threading.Thread(target=self._server.serve_forever, daemon=True,
+		                                name=f'{self.service}-server')
+		self._thread.start()
+		return self
+
+	def stop(self):
+		if self._server is not None:
+			self._server.shutdown()
+			self._server.server_close()
+			self._server = None
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.stop()
+
+
+	def route_name(self, method: str, path: str) -> str:
+		'''Name used to count requests (the path without keys and ids).'''
+		return f'{method} {path}'
+
+	def is_throttled(self) -> bool:
+		with self._lock:
+			if self.max_rps is not None:
+				now = time.monotonic()
+				if now - self._window[0] >= 1.:
+					self._window = [now, 0]
+				self._window[1] += 1
+				if self._window[1] > self.max_rps:
+					return True
+			return self.throttle_rate > 0 and self._rng.random() < self.throttle_rate
+
+	def throttle_response(self) -> Tuple[int, Optional[Dict], Dict]:
+		return 429, {'error': 'rate limited'}, {'Retry-After': self.retry_after}
+
+	def respond(self, method, path, query, body, headers):
+		delay = self.latency + (self.jitter * self._rng.random() if self.jitter else 0.)
+		if delay > 0:
+			time.sleep(delay)
+		route = self.route_name(method, path)
+		with self._lock:
+			self.requests[route] += 1
+		if self.is_throttled():
+			with self._lock:
+				self.throttled[route] += 1
+			return self.throttle_response()
+		try:
+			return self.handle(method, path, query, body, headers)
+		except KeyError as e:
+			return 404, {'error': f'Not found: {e}'}, {}
+
+	def handle(self, method: str, path: str, query: Dict[str, List[str]], body, headers) \
+			-> Tuple[int, Optional[Dict], Dict]:
+		raise NotImplementedError
+
+	def stats(self) -> Dict:
+		with self._lock:
+			return {'requests': dict(self.requests), 'throttled': dict(self.throttled),
+			        'total': sum(self.requests.values()), 'total_throttled': sum(self.throttled.values())}
+
+
+class MockZotero(MockServer):
+	'''
+	Zotero web API for a single library with the given ``items`` (full API objects with ``key``, ``version``,
+	``meta`` and ``data``) and ``collections``.
+
+	The real API returns at most 100 items per request (see ``max_limit``), and includes ``Link`` headers to
+	the next pages.
+	'''
+	service = 'zotero'
+
+	def __init__(self, items: List[Dict] = (), collections: List[Dict] = (), library_id='0',
+	             library_type='user', max_limit: Optional[int] = 100, **kwargs):
+		super().__init__(**kwargs)
+		self.library_id = str(library_id)
+		self.library_type = library_type
+		self.max_limit = max_limit
+		self.version = 1
+		self.items = {item['key']: item for item in items}
+		self.collections = {collection['key']: collection for collection in collections}
+		self._children = {}
+		for item in self.items.values():
+			parent = item['data'].get('parentItem')
+			if parent is not None:
+				self._children.setdefault(parent, []).append(item['key'])
+		self._next_key = 0
+		self.deleted = {}
+
+	_route_re = re.compile(r'^/(users|groups)/[^/]+/(.*)$')
+	_key_re = re.compile(r'/[A-Z0-9]{8}(?=/|$)')
+
+	def route_name(self, method, path):
+		match = self._route_re.match(path)
+		if match is not None:
+			path = '/' + match.group(2)
+		return f'{method} {self._key_re.sub("/{key}", path)}'
+
+	_item_fields = ['title', 'abstractNote', 'date', 'url', 'accessDate', 'extra', 'DOI', 'publicationTitle',
+	                'proceedingsTitle', 'volume', 'issue', 'pages', 'language', 'shortTitle', 'rights']
+
+	def _all_items(self) -> List[Dict]:
+		with self._lock:
+			return list(self.items.values())
+
+	def throttle_response(self):
+		return 429, None, {'Retry-After': self.retry_after}
+
+	def new_key(self):
+		with self._lock:
+			while True:
+				self._next_key += 1
+				key = f'N{self._next_key:07d}'
+				if key not in self.items:
+					return key
+
+
+	@staticmethod
+	def _split(values: List[str]) -> List[List[str]]:
+		return [value.split(' || ') for value in values]
+
+	def _matches(self, item: Dict, query: Dict[str, List[str]]) -> bool:
+		data = item['data']
+		if data.get('deleted') and query.get('includeTrashed', ['0'])[0] in {'0', 'false'}:
+			return False
+		if 'since' in query and item['version'] <= int(query['since'][0]):
+			return False
+		if 'itemKey' in query:
+			if item['key'] not in {key for value in query['itemKey'] for key in value.split(',')}:
+				return False
+		if 'q' in query:
+			q = query['q'][0].lower()
+			if q not in data.get('title', '').lower() \
+					and not any(q in creator.get('lastName', '').lower() for creator in data.get('creators', [])):
+				return False
+		for options in self._split(query.get('itemType', [])):
+			if not any((data.get('itemType') != option[1:]) if option.startswith('-')
+			           else (data.get('itemType') == option) for option in options):
+				return False
+		if 'tag' in query:
+			tags = {tag['tag'] for tag in data.get('tags', [])}
+			for options in self._split(query['tag']):
+				if not any((option[1:] not in tags) if option.startswith('-') else (option in tags)
+				           for option in options):
+					return False
+		return True
+
+	def _page(self, items: List[Dict], query: Dict[str, List[str]], path: str):
+		items = [item for item in items if self._matches(item, query)]
+		if query.get('format') == ['versions']:
+			return 200, {item['key']: item['version'] for item in items}, {'Last-Modified-Version': self.version}
+		total = len(items)
+		start = int(query.get('start', [0])[0])
+		limit = int(query['limit'][0]) if 'limit' in query else 25
+		if self.max_limit is not None:
+			limit = min(limit, self.max_limit)
+		page = items[start:start + limit]
+		headers = {'Total-Results': total, 'Last-Modified-Version': self.version}
+		if start + limit < total:
+			params = '&'.join(f'{key}={value}' for key, values in query.items()
+			                  if key not in {'start', 'limit'} for value in values)
+			link = f'{self.url}{path}?{params}&limit={limit}&start='
+			last = (total - 1) // limit * limit
+			headers['Link'] = f'<{link}{start + limit}>; rel="next", <{link}{last}>; rel="last"'
+		return 200, page, headers
+
+
+	def handle(self, method, path, query, body, headers):
+		if path == '/itemFields' and method == 'GET':
+			fields = set(self._item_fields).union(*(item['data'] for item in self._all_items()))
+			return 200, [{'field': field, 'localized': field} for field in sorted(fields)], {}
+
+		match = self._route_re.match(path)
+		if match is None:
+			return 404, {'error': 'Unknown library'}, {}
+		parts = match.group(2).strip('/').split('/')
+
+		since = headers.get('If-Modified-Since-Version') if headers is not None else None
+		if method == 'GET' and since is not None and int(since) >= self.version:
+			return 304, None, {'Last-Modified-Version': self.version}
+
+		if method == 'GET':
+			if parts[0] == 'deleted':
+				since = int(query.get('since', [0])[0])
+				with self._lock:
+					keys = [key for key, version in self.deleted.items() if version > since]
+				return 200, {'collections': [], 'searches': [], 'items': keys, 'tags': [], 'settings': []}, \
+				       {'Last-Modified-Version': self.version}
+			if parts[0] == 'items':
+				if len(parts) == 1:
+					return self._page(self._all_items(), query, path)
+				if parts[1] == 'top':
+					return self._page([item for item in self._all_items() if 'parentItem' not in item['data']],
+					                  query, path)
+				if parts[1] == 'trash':
+					return self._page([item for item in self._all_items() if item['data'].get('deleted')],
+					                  {**query, 'includeTrashed': ['1']}, path)
+				key = parts[1]
+				if len(parts) == 2:
+					return 200, self.items[key], {'Last-Modified-Version': self.version}
+				if parts[2] == 'children':
+					with self._lock:
+						children = [self.items[child] for child in self._children.get(key, [])]
+					return self._page(children, query, path)
+
+			if parts[0] == 'collections':
+				if len(parts) == 1:
+					return self._page(list(self.collections.values()), query, path)
+				if parts[1] == 'top':
+					return self._page([collection for collection in self.collections.values()
+					                   if not collection['data'].get('parentCollection')], query, path)
+				key = parts[1]
+				if len(parts) == 2:
+					return 200, self.collections[key], {}
+				if parts[2] == 'collections':
+					return self._page([collection for collection in self.collections.values()
+					                   if collection['data'].get('parentCollection') == key], query, path)
+				if parts[2] == 'items':
+					items = [item for item in self._all_items() if key in item['data'].get('collections', [])]
+					if parts[3:] == ['top']:
+						items = [item for item in items if 'parentItem' not in item['data']]
+					return self._page(items, query, path)
+
+		elif method == 'POST' and parts == ['items']:
+			return self.write_items(body)
+
+		elif method == 'DELETE' and parts[0] == 'items':
+			keys = [parts[1]] if len(parts) > 1 else [key for value in query.get('itemKey', [])
+			                                             for key in value.split(',')]
+			with self._lock:
+				self.version += 1
+				for key in keys:
+					item = self.items.pop(key, None)
+					if item is not None:
+						self.deleted[key] = self.version
+					if item is not None and item['data'].get('parentItem') in self._children:
+						self._children[item['data']['parentItem']].remove(key)
+			return 204, None, {'Last-Modified-Version': self.version}
+
+		return 404, {'error': f'Unknown route: {method} {path}'}, {}
+
+
+	def write_items(self, objs: List[Dict]):
+		if len(objs) > 50:
+			return 413, {'error': 'Only 50 items can be written at once'}, {}
+		successful, success, unchanged, failed = {}, {}, {}, {}
+		for i, obj in enumerate(objs):
+			data = dict(obj.get('data', obj))
+			key = data.pop('key', obj.get('key'))
+			if key is not None and key not in self.items:
+				failed[str(i)] = {'key': key, 'code': 404, 'message': 'Item not found'}
+				continue
+			if key is None:
+				key = self.new_key()
+			with self._lock:
+				data.pop('version', None)
+				if key in self.items and all(self.items[key]['data'].get(k) == v for k, v in data.items()):
+					unchanged[str(i)] = key # like the real API, unchanged items keep their version
+					continue
+				self.version += 1
+				if key in self.items:
+					item = self.items[key]
+					item['data'].update(data)
+				else:
+					item = {'key': key, 'version': self.version, 'library': {'type': self.library_type,
+					                                                        'id': self.library_id},
+					        'links': {}, 'meta': {}, 'data': {'key': key, **data}}
+					self.items[key] = item
+					parent = data.get('parentItem')
+					if parent is not None:
+						self._children.setdefault(parent, []).append(key)
+				item['version'] = item['data']['version'] = self.version
+			successful[str(i)] = item
+			success[str(i)] = key
+		return 200, {'successful': successful, 'success': success, 'unchanged': unchanged, 'failed': failed}, \
+		       {'Last-Modified-Version': self.version}
+
+
+class MockGraph(MockServer):
+	'''
+	Microsoft Graph API (OneDrive) for the files under ``/me/drive/root``. Any path is assumed to exist.
+
+	Throttling is simulated per sub-request of a batch (like the real API), so a ``$batch`` request succeeds
+	while some of its responses have the status 429.
+	'''
+	service = 'graph'
+
+	def __init__(self, **kwargs):
+		super().__init__(**kwargs)
+		self.links = Counter()
+
+	_path_re = re.compile(r'^(?:/v1\.0)?/me/drive/root:/(.*?)(?::?/(children|createLink))?$')
+
+	def route_name(self, method, path):
+		match = self._path_re.match(path)
+		if match is not None:
+			return f'{method} {match.group(2) or "item"}'
+		return f'{method} {path}'
+
+	def respond(self, method, path, query, body, headers):
+		if path.endswith('/$batch') and method == 'POST':
+			delay = self.latency + (self.jitter * self._rng.random() if self.jitter else 0.)
+			if delay > 0:
+				time.sleep(delay)
+			with self._lock:
+				self.requests['POST $batch'] += 1
+			return 200, {'responses': [self.sub_request(req) for req in body.get('requests', [])]}, {}
+		return super().respond(method, path, query, body, headers)
+
+	def sub_request(self, req: Dict) -> Dict:
+		route = self.route_name(req['method'], req['url'])
+		with self._lock:
+			self.requests[route] += 1
+		if self.is_throttled():
+			with self._lock:
+				self.throttled[route] += 1
+			return {'id': req['id'], 'status': 429, 'headers': {'Retry-After': self.retry_after},
+			        'body': {'error': {'code': 'activityLimitReached',
+			                           'message': 'The application or user has been throttled.'}}}
+		status, payload, headers = self.handle(req['method'], req['url'], {}, req.get('body'), req.get('headers', {}))
+		return {'id': req['id'], 'status': status, 'headers': headers, 'body': payload}
+
+	def handle(self, method, path, query, body, headers):
+		match = self._path_re.match(path)
+		if match is None:
+			return 404, {'error': {'code': 'itemNotFound', 'message': path}}, {}
+		path, action = match.group(1), match.group(2)
+		name = path.split('/')[-1]
+		web_url = f'{self.url}/files/{path}'
+		if action is None and method == 'GET':
+			etag = f'"{{{hashlib.md5(path.encode()).hexdigest()}}},1"'
+			if headers.get('If-None-Match') == etag:
+				return 304, None, {'ETag': etag}
+			return 200, {'id': f'id-{abs(hash(path))}', 'name': name, 'webUrl': web_url, 'eTag': etag}, {'ETag': etag}
+		if action == 'children' and method == 'GET':
+			return 200, {'value': []}, {}
+		if action == 'createLink' and method == 'POST':
+			link_type = (body or {}).get('type', 'view')
+			with self._lock:
+				self.links[link_type] += 1
+			return 201, {'id': f'link-{abs(hash(path))}',
+			             'link': {'type': link_type, 'webUrl': f'{self.url}/share/{link_type}/{path}'}}, {}
+		return 404, {'error': {'code': 'invalidRequest', 'message': f'{method} {path}'}}, {}
+
+
+class MockNotion(MockServer):
+	'''
+	Notion API for a single database with the given ``properties`` (by default any property is accepted).
+
+	Pages are kept in memory (see ``pages``), as well as their body (see ``blocks`` and ``children``, which only
+	contains the blocks that were not deleted).
+	'''
+	service = 'notion'
+
+	def __init__(self, database_id='mock-database', properties: Optional[Dict] = None, **kwargs):
+		super().__init__(**kwargs)
+		self.database_id = database_id
+		self.properties = properties
+		self.pages = {}
+		self.blocks = {}
+		self.children = {}
+		self._next_id = 0
+	
+	def _new_id(self):
+		with self._lock:
+			self._next_id += 1
+			return f'{self._next_id:032x}'
+	
+	@staticmethod
+	def _properties(properties):
+		'''Like the real API, every property value includes its ``type``.'''
+		return {name: {'type': next(key for key in value if key != 'type'), **value}
+		        for name, value in properties.items()}
+	
+	def _edited(self, page):
+		page['last_edited_time'] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds')
+	
+	def edit_page(self, page_id, properties):
+		'''Simulates a user editing the properties of a page in Notion.'''
+		page = self.pages[page_id]
+		page['properties'].update(self._properties(properties))
+		self._edited(page)
+		return page
+	
+	def query(self, body):
+		pages = [page for page in self.pages.values() if not page.get('archived')]
+		filters = body.get('filter', {})
+		if 'or' in filters: # only text properties which equal a value
+			pages = [page for page in pages if any(
+				''.join(term['text']['content'] for term in page['properties'].get(condition['property'], {})
+				        .get('rich_text', [])) == condition['rich_text']['equals'] for condition in filters['or'])]
+		condition = filters.get('last_edited_time', {})
+		if 'on_or_after' in condition:
+			pages = [page for page in pages if page['last_edited_time'] >= condition['on_or_after']]
+		if 'after' in condition:
+			pages = [page for page in pages if page['last_edited_time'] > condition['after']]
+		for sort in reversed(body.get('sorts', [])):
+			pages.sort(key=lambda page: page[sort['timestamp']], reverse=sort.get('direction') == 'descending')
+		start = int(body.get('start_cursor') or 0)
+		size = min(int(body.get('page_size', 100)), 100)
+		more = start + size < len(pages)
+		return {'object': 'list', 'results': pages[start:start + size], 'has_more': more,
+		        'next_cursor': str(start + size) if more else None}
+	
+	def _add_blocks(self, parent_id, blocks, after=None):
+		'''Stores the blocks (and their children) and returns them with their IDs.'''
+		siblings = self.children.setdefault(parent_id, [])
+		index = len(siblings) if after is None else siblings.index(after) + 1
+		created = []
+		for block in blocks:
+			block = dict(block)
+			block['id'] = self._new_id()
+			content = dict(block.get(block.get('type'), {}))
+			children = content.pop('children', [])
+			block[block['type']] = content
+			block['has_children'] = len(children) > 0
+			self.blocks[block['id']] = block
+			siblings.insert(index, block['id'])
+			index += 1
+			if len(children):
+				self._add_blocks(block['id'], children)
+			created.append(block)
+		return created
+
+	def route_name(self, method, path):
+		parts = path.strip('/').split('/')
+		if parts[0] == 'v1':
+			parts = parts[1:]
+		return f'{method} {parts[0]}' if len(parts) else f'{method} /'
+
+	def throttle_response(self):
+		return 429, {'object': 'error', 'status': 429, 'code': 'rate_limited',
+		             'message': 'You have been rate limited. Please try again in a few minutes.'}, \
+		       {'Retry-After': self.retry_after}
+
+	def _not_found(self, path):
+		return 404, {'object': 'error', 'status': 404, 'code': 'object_not_found',
+		             'message': f'Could not find {path}'}, {}
+
+	def handle(self, method, path, query, body, headers):
+		parts = path.strip('/').split('/')
+		if parts[0] == 'v1':
+			parts = parts[1:]
+
+		if parts[0] == 'databases' and len(parts) == 2 and method == 'GET':
+			if parts[1] != self.database_id:
+				return self._not_found(path)
+			properties = {} if self.properties is None else self.properties
+			return 200, {'object': 'database', 'id': self.database_id, 'properties': properties}, {}
+		
+		if parts[0] == 'databases' and len(parts) == 3 and parts[2] == 'query' and method == 'POST':
+			if parts[1] != self.database_id:
+				return self._not_found(path)
+			return 200, self.query(body or {}), {}
+
+		if parts[0] == 'pages':
+			if len(parts) == 1 and method == 'POST':
+				page_id = self._new_id()
+				page = {'object': 'page', 'id': page_id, 'url': f'https://www.notion.so/Page-{page_id}',
+				        'parent': body.get('parent'), 'properties': self._properties(body.get('properties', {}))}
+				self._edited(page)
+				self.pages[page_id] = page
+				return 200, page, {}
+			if len(parts) == 2:
+				page = self.pages.get(parts[1])
+				if page is None:
+					return self._not_found(path)
+				if method == 'PATCH':
+					page['properties'].update(self._properties(body.get('properties', {})))
+					if 'archived' in body:
+						page['archived'] = body['archived']
+					self._edited(page)
+				return 200, page, {}
+		
+		if parts[0] == 'blocks' and len(parts) >= 2:
+			block_id = parts[1]
+			if block_id not in self.pages and block_id not in self.blocks:
+				return self._not_found(path)
+			if len(parts) == 3 and parts[2] == 'children' and method == 'PATCH':
+				blocks = body.get('children', [])
+				if len(blocks) > 100 or any(len(block.get(block.get('type'), {}).get('children', [])) > 100
+				                            for block in blocks):
+					return 400, {'object': 'error', 'status': 400, 'code': 'validation_error',
+					             'message': 'body.children.length should be ≤ 100'}, {}
+				if body.get('after') is not None and body['after'] not in self.children.get(block_id, []):
+					return self._not_found(body['after'])
+				created = self._add_blocks(block_id, blocks, after=body.get('after'))
+				return 200, {'object': 'list', 'results': created, 'has_more': False}, {}
+			if len(parts) == 2 and method == 'DELETE':
+				block = self.blocks.get(block_id)
+				if block is None or block.get('archived'):
+					return self._not_found(path)
+				block['archived'] = True
+				for siblings in self.children.values():
+					if block_id in siblings:
+						siblings.remove(block_id)
+				return 200, block, {}
+
+		return self._not_found(path)
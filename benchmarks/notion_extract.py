@@ -0,0 +1,156 @@
+'''
+Microbenchmark of the CPU cost of publishing to Notion (without any requests), run from the repo root with:
+
+	python -m benchmarks.notion_extract --items 100000 --out notion-extract.json
+
+The publisher is created from the ``notion`` config (with all of its extractors and modifiers), and then for
+synthetic (already processed) items and their children, the per-item cost of each extractor is measured
+separately for the extraction (the base extractor) and the packaging (the ``to-*`` modifiers), followed by the
+cost of the full ``NotionPublisher.extract`` and of the fingerprint (``json.dumps`` and md5 separately).
+'''
+from typing import Dict
+import sys
+import json
+import time
+import hashlib
+import argparse
+from collections import defaultdict
+from tabulate import tabulate
+
+from .mock_servers import MockZotero
+from .library import SyntheticLibrary
+
+
+def create_publisher(zotero_url: str, configs=('notion',), **params):
+	'''Creates the publisher the way ``sync-notion`` does (only the collections are requested from zotero).'''
+	import omnifig as fig
+	fig.initialize()
+	from src.publishing import prepare_sync_notion
+	cfg = fig.create_config(*configs, **{'silent': True, 'zotero-library': '0', 'zotero-library-type': 'user',
+	                                     'zotero-api-key': 'mock', 'zotero-endpoint': zotero_url,
+	                                     'notion_database_id': 'mock', 'notion_secret': 'mock', **params})
+	cfg.silent = True
+	return prepare_sync_notion(cfg)['publisher']
+
+
+def split_extractor(extractor):
+	'''Returns the base extraction of ``extractor`` (without the packaging of the modifiers), if it has any.'''
+	from src.publishing import ExtrationPackager, LinksToRichText
+	for cls in type(extractor).__mro__:
+		if cls in (ExtrationPackager, LinksToRichText):
+			return super(cls, extractor).__call__
+	return None
+
+
+def benchmark_batch(publisher, batch, totals: Dict[str, Dict[str, float]], fingerprints: Dict[str, float]):
+	calls = [(item, lambda children=children: children) for item, children in batch]
+
+	for name, extractor in publisher.extractors.items():
+		raw_fn = split_extractor(extractor)
+		if raw_fn is not None:
+			start = time.perf_counter()
+			for item, get_children in calls:
+				try:
+					raw_fn(item, get_children)
+				except (extractor.ExtractionError, extractor.SkipItem):
+					pass
+			totals[name]['extraction'] += time.perf_counter() - start
+		start = time.perf_counter()
+		for item, get_children in calls:
+			try:
+				extractor(item, get_children)
+			except (extractor.ExtractionError, extractor.SkipItem):
+				pass
+		totals[name]['total'] += time.perf_counter() - start
+
+	from src.publishing import Extractor
+	results = []
+	start = time.perf_counter()
+	for item, get_children in calls:
+		try:
+			results.append(publisher.extract(item, get_children)[0])
+		except (Extractor.ExtractionError, Extractor.SkipItem):
+			pass
+	fingerprints['extract'] += time.perf_counter() - start
+
+	start = time.perf_counter()
+	dumps = [json.dumps(data, sort_keys=True, indent=4) for data in results]
+	fingerprints['json.dumps(indent=4)'] += time.perf_counter() - start
+	start = time.perf_counter()
+	for obj in dumps:
+		hashlib.md5(obj.encode('utf-8')).hexdigest()
+	fingerprints['md5'] += time.perf_counter() - start
+	start = time.perf_counter()
+	for data in results:
+		publisher.fingerprint(data)
+	fingerprints['fingerprint'] += time.perf_counter() - start
+	start = time.perf_counter()
+	for data in results:
+		json.dumps(data, sort_keys=True, separators=(',', ':'))
+	fingerprints['json.dumps(compact)'] += time.perf_counter() - start
+	return len(results)
+
+
+def format_results(extractors: Dict[str, Dict[str, float]], fingerprints: Dict[str, float], processed: int,
+                   published: int) -> str:
+	'''
+	The extractors and ``extract`` run on all ``processed`` items (including the skipped/failed ones), while the
+	fingerprint (and json) steps only run on the ``published`` items, so each is averaged over its own items.
+	'''
+	processed, published = max(processed, 1), max(published, 1)
+	us = lambda seconds, num=processed: f'{seconds / num * 1e6:.2f}'
+	per_published = {name for name in fingerprints if name != 'extract'}
+	rows = []
+	for name, times in sorted(extractors.items(), key=lambda x: -x[1]['total']):
+		extraction = times.get('extraction')
+		packaging = None if extraction is None else max(times['total'] - extraction, 0.)
+		rows.append([name, '--' if extraction is None else us(extraction),
+		             '--' if packaging is None else us(packaging), us(times['total'])])
+	table = tabulate(rows, headers=['Extractor', 'Extraction (us/item)', 'Packaging (us/item)', 'Total (us/item)'])
+
+	extraction = sum(times.get('extraction', times['total']) for times in extractors.values())
+	total = sum(times['total'] for times in extractors.values())
+	summary = [['extractors: extraction', us(extraction)], ['extractors: packaging', us(total - extraction)],
+	           *[[name, us(seconds, published if name in per_published else processed)]
+	             for name, seconds in fingerprints.items()]]
+	per_item = fingerprints['extract'] / processed + fingerprints['fingerprint'] / published
+	summary.append(['extract + fingerprint', us(per_item, 1)])
+	rate = f'{1 / per_item:.0f} items/s' if per_item > 0 else '--'
+	return f'{table}\n\n{tabulate(summary, headers=["Step", "us/item"])}\n\nCPU bound publish rate: {rate}'
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark the extraction and fingerprinting of Notion pages.')
+	parser.add_argument('--items', type=int, default=100000, help='number of synthetic items')
+	parser.add_argument('--batch', type=int, default=1000, help='items generated (and measured) at a time')
+	parser.add_argument('--configs', type=str, nargs='+', default=['notion'], help='configs of the publisher')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--out', type=str, default=None, help='save the results as json')
+	args = parser.parse_args(argv)
+
+	library = SyntheticLibrary(args.items, seed=args.seed, processed=True)
+	with MockZotero(collections=library.collections(), library_id=library.library_id) as zotero:
+		publisher = create_publisher(zotero.url, configs=args.configs, ignore_failed_extractors=True)
+
+	extractors = defaultdict(lambda: defaultdict(float))
+	fingerprints = defaultdict(float)
+	num, processed, batch = 0, 0, []
+	for paper in library.papers():
+		processed += 1
+		batch.append(paper)
+		if len(batch) == args.batch:
+			num += benchmark_batch(publisher, batch, extractors, fingerprints)
+			batch.clear()
+	if len(batch):
+		num += benchmark_batch(publisher, batch, extractors, fingerprints)
+
+	print(format_results(extractors, fingerprints, processed, num))
+	if args.out is not None:
+		with open(args.out, 'w') as f:
+			json.dump({'items': args.items, 'published': num, 'extractors': extractors, 'steps': fingerprints,
+			           'python': sys.version, 'args': vars(args)}, f, indent=2)
+	return extractors, fingerprints
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,148 @@
+'''
+Benchmarks the PDF features on a synthetic corpus (see ``corpus.py``), run from the repo root with:
+
+	python -m benchmarks.pdf_features --pages 1 8 30 120 --scanned 0 1 --repeat 3 --out pdf-bench.json
+
+For each document it reports the median wall time, pages/sec, MB/sec and peak (python) memory of:
+text extraction (several strategies), GitHub link extraction, wordcloud generation and saving the image.
+'''
+from typing import Callable, Dict, List
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+from pathlib import Path
+from tabulate import tabulate
+
+from src.features import PDF_Feature, GithubExtractor, WordcloudMaker
+from src.metrics import peak_rss
+
+from .corpus import CorpusGenerator
+
+
+def _text_blocks(path):
+	import fitz
+	with fitz.open(path) as pdf:
+		return [''.join(block[4] for block in page.get_text('blocks')) for page in pdf]
+
+
+def _text_sorted(path):
+	import fitz
+	with fitz.open(path) as pdf:
+		return [page.get_text(sort=True) for page in pdf]
+
+
+# alternative text extraction strategies to compare against PDF_Feature.extract_text
+TEXT_STRATEGIES: Dict[str, Callable] = {
+	'extract_text': PDF_Feature.extract_text,
+	'extract_text[blocks]': _text_blocks,
+	'extract_text[sorted]': _text_sorted,
+}
+
+
+def measure(fn: Callable, repeat=3):
+	'''
+	Returns the median wall time, peak traced (python) memory and the output of ``fn``.
+
+	The memory is measured in a separate call, since tracing the allocations slows down the timed calls.
+	'''
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		out = fn()
+		times.append(time.perf_counter() - start)
+	tracemalloc.start()
+	try:
+		fn()
+		peak = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	return statistics.median(times), peak, out
+
+
+def benchmark_document(doc: Dict, wordcloud: WordcloudMaker, out_dir: Path, repeat=3) -> List[Dict]:
+	path = doc['path']
+	cases = {name: (lambda fn=fn: fn(path)) for name, fn in TEXT_STRATEGIES.items()}
+	cases['code_urls_from_path'] = lambda: GithubExtractor.code_urls_from_path(path)
+	cases['generate_from_path'] = lambda: wordcloud.generate_from_path(path)
+
+	rows = []
+	wc = None
+	for name, fn in cases.items():
+		try:
+			seconds, peak, out = measure(fn, repeat=repeat)
+		except Exception as e: # e.g. no words for a wordcloud of a scanned document
+			rows.append({'document': doc['name'], 'case': name, 'seconds': None, 'peak_bytes': None,
+			             'error': f'{type(e).__name__}: {e}'})
+			continue
+		if name == 'generate_from_path':
+			wc = out
+		rows.append({'document': doc['name'], 'case': name, 'seconds': seconds, 'peak_bytes': peak})
+
+	if wc is not None:
+		dest = out_dir / f'{path.stem}.jpg'
+		seconds, peak, _ = measure(lambda: wc.to_image().save(str(dest), 'JPEG'), repeat=repeat)
+		rows.append({'document': doc['name'], 'case': 'save_image', 'seconds': seconds, 'peak_bytes': peak})
+
+	for row in rows:
+		valid = row['seconds'] is not None and row['seconds'] > 0
+		row.update(pages=doc['pages'], scanned=doc['scanned'], bytes=doc['bytes'],
+		           pages_per_second=doc['pages'] / row['seconds'] if valid else None,
+		           mb_per_second=doc['bytes'] / 2**20 / row['seconds'] if valid else None)
+	return rows
+
+
+def format_rows(rows: List[Dict]) -> str:
+	table = [[row['document'], row['case'], row['error']] if 'error' in row else
+	         [row['document'], row['case'], f'{row["seconds"]*1000:.1f}',
+	          '--' if row['pages_per_second'] is None else f'{row["pages_per_second"]:.1f}',
+	          '--' if row['mb_per_second'] is None else f'{row["mb_per_second"]:.2f}',
+	          f'{row["peak_bytes"] / 2**20:.1f}'] for row in rows]
+	return tabulate(table, headers=['Document', 'Case', 'ms', 'Pages/s', 'MB/s', 'Peak MB'])
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark the PDF features on a synthetic corpus.')
+	parser.add_argument('--pages', type=int, nargs='+', default=[1, 8, 30, 120],
+	                    help='page counts of the generated documents')
+	parser.add_argument('--scanned', type=float, nargs='+', default=[0., 1.],
+	                    help='fractions of scanned-like (image only) pages')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--corpus-dir', type=str, default=None,
+	                    help='where to keep the corpus (defaults to a temporary directory)')
+	parser.add_argument('--regenerate', action='store_true', help='regenerate documents even if they exist')
+	parser.add_argument('--out', type=str, default=None, help='save the results as json')
+	args = parser.parse_args(argv)
+
+	tmp = Path(tempfile.mkdtemp(prefix='omnicite-bench-'))
+	corpus_dir = tmp / 'corpus' if args.corpus_dir is None else Path(args.corpus_dir) / f'seed-{args.seed}'
+	if args.regenerate and corpus_dir.exists():
+		shutil.rmtree(str(corpus_dir))
+	try:
+		docs = CorpusGenerator(corpus_dir, seed=args.seed).generate_corpus(args.pages, args.scanned)
+		wordcloud = WordcloudMaker(wordcloud_root=str(tmp / 'wordclouds'), attachment_base_root=str(tmp))
+
+		rows = []
+		for doc in docs:
+			rows.extend(benchmark_document(doc, wordcloud, tmp, repeat=args.repeat))
+		print(format_rows(rows))
+		rss = peak_rss()
+		if rss is not None:
+			print(f'\nPeak RSS: {rss / 2**20:.1f} MB')
+
+		if args.out is not None:
+			with open(args.out, 'w') as f:
+				json.dump({'rows': rows, 'peak_rss_bytes': rss, 'python': sys.version,
+				           'args': vars(args)}, f, indent=2)
+	finally:
+		shutil.rmtree(str(tmp), ignore_errors=True)
+	return rows
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,196 @@
+'''
+End-to-end benchmark of ``process``, ``sharing`` and ``publish`` against local mock servers (see
+``mock_servers.py``) for synthetic libraries of increasing size, run from the repo root with:
+
+	python -m benchmarks.scaling --sizes 1000 10000 100000 --latency 0.005 --throttle-rate 0.01 --out scaling.json
+
+For each size, the library is served by a ``MockZotero`` (together with a ``MockGraph`` and ``MockNotion``) in
+this process, while the scripts run in a fresh subprocess (so its peak memory only includes omni-cite itself).
+Reported are the wall time, processed items, requests (by service) and peak RSS of each stage, as well as the
+number of requests the servers received and throttled.
+
+Note that the PDF based features (code links, wordclouds) and the Semantic Scholar lookup are disabled (the
+former are covered by ``pdf_features.py``, the latter uses an external API). The client side rate limits (see
+``src/transport.py``) are also disabled, unless ``--keep-rate-limits`` is given, so the throughput is only limited
+by the servers (and retries are still done as usual).
+'''
+from typing import Dict, List
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import traceback
+import subprocess
+from pathlib import Path
+from tabulate import tabulate
+
+from .mock_servers import MockZotero, MockGraph, MockNotion
+from .library import SyntheticLibrary
+
+
+STAGES = ['process', 'share', 'publish']
+
+
+def run_stages(spec: Dict) -> Dict:
+	'''Runs the stages in this process (called in the subprocess) and returns the measurements.'''
+	import omnifig as fig
+	fig.initialize()
+	from src import OmniCite
+	from src.metrics import metrics, peak_rss
+
+	params = dict(spec['params'])
+	if spec.get('workers'):
+		params['manager'] = {'_type': 'parallel-manager', 'workers': spec['workers']}
+
+	results = {}
+	with OmniCite.from_config(*spec['configs'], **params) as engine:
+		for name in spec['stages']:
+			metrics.reset()
+			start = time.perf_counter()
+			try:
+				managers = engine.run(name)
+			except Exception as e: # e.g. unhandled throttling
+				managers, failure = [], f'{type(e).__name__}: {e}'
+				traceback.print_exc()
+			else:
+				failure = None
+			wall = time.perf_counter() - start
+			summary = metrics.summary()
+			results[name] = {
+				'wall_seconds': wall,
+				'failure': failure,
+				'items': sum(stage['items'] for stage in summary['stages'].values()),
+				'errors': sum(manager.num_errors for manager in managers),
+				'requests': {service: sum(entry['count'] for entry in endpoints.values())
+				             for service, endpoints in summary['requests'].items()},
+				'request_seconds': {service: sum(entry['seconds'] for entry in endpoints.values())
+				                    for service, endpoints in summary['requests'].items()},
+				'throttled': summary['throttled'],
+				'retries': summary['retries'],
+				'peak_rss_bytes': peak_rss(),
+				'detail': summary,
+			}
+	return results
+
+
+def benchmark_size(num_items: int, args, root: Path) -> Dict:
+	library = SyntheticLibrary(num_items, seed=args.seed)
+	start = time.perf_counter()
+	items, collections = library.generate()
+	onedrive_root = root / 'OneDrive'
+	library.create_files(items, onedrive_root)
+	(root / 'storage').mkdir(exist_ok=True)
+	setup = time.perf_counter() - start
+
+	server_kwargs = dict(latency=args.latency, jitter=args.jitter, throttle_rate=args.throttle_rate,
+	                     max_rps=args.max_rps, retry_after=args.retry_after, seed=args.seed)
+	zotero = MockZotero(items, collections, library_id=library.library_id, max_limit=args.max_limit,
+	                    **server_kwargs)
+	graph = MockGraph(**server_kwargs)
+	notion = MockNotion(**server_kwargs)
+	del items
+
+	with zotero, graph, notion:
+		limit = num_items * 3 if args.max_limit is None else None
+		spec = {
+			'configs': ['notion'],
+			'stages': args.stages,
+			'workers': args.workers,
+			'params': {
+				'silent': True, 'pbar': False,
+				'zotero-library': library.library_id, 'zotero-library-type': 'user', 'zotero-api-key': 'mock',
+				'zotero-endpoint': zotero.url, 'limit': limit, 'onedrive-limit': limit,
+				'graph_app_id': 'mock', '_header': {'Authorization': 'Bearer mock'},
+				'graph_root': f'{graph.url}/v1.0', 'onedrive-root': str(onedrive_root),
+				'notion_database_id': notion.database_id, 'notion_secret': 'mock',
+				'notion_root': f'{notion.url}/v1',
+				'attachment_base_root': str(onedrive_root), 'zotero_storage': str(root / 'storage'),
+				'http-cache': str(root / 'http-cache'),
+				'cloud_root': str(onedrive_root / 'Papers' / 'zotero'),
+				'wordcloud_root': str(onedrive_root / 'Papers' / 'wordclouds'),
+				'link-semantic-scholar': False, 'extract-code-links': False, 'generate-wordcloud': False,
+			},
+		}
+		if not args.keep_rate_limits:
+			spec['params']['rate-limits'] = {service: {'rate': None} for service in ['zotero', 'graph', 'notion']}
+		spec_path, out_path = root / 'spec.json', root / 'results.json'
+		spec_path.write_text(json.dumps(spec))
+
+		env = dict(os.environ)
+		env['NO_PROXY'] = ','.join(filter(None, [env.get('NO_PROXY'), '127.0.0.1', 'localhost']))
+		proc = subprocess.run([sys.executable, '-m', 'benchmarks.scaling', '--run-spec', str(spec_path),
+		                       '--run-out', str(out_path)], env=env, capture_output=not args.verbose, text=True)
+		if proc.returncode != 0:
+			raise RuntimeError(f'Benchmark of {num_items} items failed:\n{proc.stderr}')
+		stages = json.loads(out_path.read_text())
+
+	return {'num_items': num_items, 'setup_seconds': setup, 'stages': stages,
+	        'servers': {server.service: server.stats() for server in [zotero, graph, notion]}}
+
+
+def format_results(results: List[Dict]) -> str:
+	services = ['zotero', 'graph', 'notion']
+	rows = []
+	for result in results:
+		for name, stage in result['stages'].items():
+			rows.append([result['num_items'], name, f'{stage["wall_seconds"]:.1f}', stage['items'],
+			             f'{stage["items"] / stage["wall_seconds"]:.1f}' if stage['wall_seconds'] > 0 else '--',
+			             *[stage['requests'].get(service, 0) for service in services],
+			             sum(stage['throttled'].values()), 'failed' if stage['failure'] else stage['errors'],
+			             f'{stage["peak_rss_bytes"] / 2**20:.0f}' if stage['peak_rss_bytes'] else '--'])
+	return tabulate(rows, headers=['Library', 'Stage', 'Seconds', 'Items', 'Items/s',
+	                               *[s.capitalize() for s in services], '429s', 'Errors', 'Peak MB'])
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark the scripts end-to-end against local mock servers.')
+	parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+	                    help='number of papers in the synthetic libraries')
+	parser.add_argument('--stages', type=str, nargs='+', default=STAGES, choices=STAGES)
+	parser.add_argument('--workers', type=int, default=None, help='use a parallel-manager with this many workers')
+	parser.add_argument('--latency', type=float, default=0., help='added latency of every request (in seconds)')
+	parser.add_argument('--jitter', type=float, default=0., help='added random latency (in seconds)')
+	parser.add_argument('--throttle-rate', type=float, default=0., help='fraction of requests answered with 429')
+	parser.add_argument('--max-rps', type=int, default=None, help='throttle above this many requests per second')
+	parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of throttled requests (seconds)')
+	parser.add_argument('--max-limit', type=int, default=None,
+	                    help='max items per zotero response (the real API uses 100, by default no limit, '
+	                         'so all items are returned at once)')
+	parser.add_argument('--keep-rate-limits', action='store_true',
+	                    help='use the default client side rate limits (e.g. 3 requests/s for notion)')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--out', type=str, default=None, help='save the results as json')
+	parser.add_argument('--verbose', action='store_true', help='show the output of the scripts')
+	parser.add_argument('--run-spec', type=str, default=None, help=argparse.SUPPRESS)
+	parser.add_argument('--run-out', type=str, default=None, help=argparse.SUPPRESS)
+	args = parser.parse_args(argv)
+
+	if args.run_spec is not None:
+		results = run_stages(json.loads(Path(args.run_spec).read_text()))
+		Path(args.run_out).write_text(json.dumps(results))
+		return results
+
+	results = []
+	for num_items in args.sizes:
+		root = Path(tempfile.mkdtemp(prefix=f'omnicite-scaling-{num_items}-'))
+		try:
+			results.append(benchmark_size(num_items, args, root))
+		finally:
+			shutil.rmtree(str(root), ignore_errors=True)
+		print(format_results(results[-1:]))
+		print('Servers: ' + ', '.join(f'{name} {stats["total"]} requests ({stats["total_throttled"]} throttled)'
+		                              for name, stats in results[-1]['servers'].items()), end='\n\n')
+
+	if len(results) > 1:
+		print(format_results(results))
+	if args.out is not None:
+		with open(args.out, 'w') as f:
+			json.dump({'results': results, 'python': sys.version, 'args': vars(args)}, f, indent=2)
+	return results
+
+
+if __name__ == '__main__':
+	main()
@@ -3,5 +3,12 @@
 from .processing import *
 from .sharing import *
 from .publishing import *
+from .pulling import *
+from .cleanup import *
+from .replay import *
+from .scheduling import *
 from .top import *
+from .engine import OmniCite
+from .planning import *
+from .fulltext import *
 from . import auth
\ No newline at end of file
@@ -2,14 +2,19 @@ import os, shutil
 from pathlib import Path
 import json
 import omnifig as fig
-import msal
 import webbrowser
 from datetime import datetime, timedelta
 import time
+from functools import partial
+from collections import deque
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
-import pyperclip
-from msal import PublicClientApplication
-from pyzotero import zotero
+
+from .metrics import metrics
+from .transport import transport
+from .ledger import Ledger
+from .mirror import LibraryMirror
 
 
 @fig.component('zotero')
@@ -26,26 +31,132 @@ class ZoteroProcess: # should be configurable
 				exclusion_tags = exclusion_tags.split(' AND ')
 			exclusion_tags = [f'-{tag}' for tag in exclusion_tags]
 		self.exclusion_tags = exclusion_tags
+		ledger = A.pull('ledger', None)
+		self.ledger = None if ledger is None else Ledger(ledger)
+		# with a ledger, the brand tags are only added in zotero if requested
+		self.ledger_tags = A.pull('ledger-tags', False) if self.ledger is not None else True
+		self.scheduler = A.pull('scheduler', None)
+		self.fetch_window = A.pull('fetch-window', 4) # pages requested concurrently when listing items
+		mirror = A.pull('mirror', None)
+		self.mirror = None if mirror is None else LibraryMirror(mirror)
+		self._mirror_synced = False
 		self._full_top = None
+		self.written = {} # key -> (version, parent) of every item written by this process
+		self._local = threading.local() # the last response of each thread
+		transport.configure(A.pull('rate-limits', None, silent=True), http_cache=A.pull('http-cache', None, silent=True))
 	
 	_zotero_obj = None
+	_zotero_lock = threading.Lock() # pyzotero keeps the last response on the client, so calls are serialized
 	
 	@classmethod
 	def _load_zotero(cls, A):
 		if cls._zotero_obj is None:
+			from pyzotero import zotero
 			cls._zotero_obj = zotero.Zotero(A.pull('zotero-library', silent=True), A.pull('zotero-library-type', silent=True),
 			                            A.pull('zotero-api-key', silent=True))
+			endpoint = A.pull('zotero-endpoint', None, silent=True) # e.g. a local mock server
+			if endpoint is not None:
+				cls._zotero_obj.endpoint = endpoint
+			client = getattr(cls._zotero_obj, 'client', None)
+			if client is not None and hasattr(client, 'event_hooks'):
+				client.event_hooks['response'].append(cls._count_throttled)
 		return cls._zotero_obj
 	
+	@staticmethod
+	def _count_throttled(resp):
+		'''
+		pyzotero waits out (and retries) throttled reads itself, so the rate limiter only sees the final response,
+		and these 429s are counted here instead (throttled writes are returned, so the rate limiter counts them).
+		'''
+		if resp.status_code == 429 and resp.request.method == 'GET':
+			metrics.add_throttled('zotero')
+	
+	@staticmethod
+	def _retry_exceptions():
+		'''Errors of pyzotero (and its http client) which are worth retrying (throttling, server errors, etc.).'''
+		from pyzotero import zotero_errors
+		errors = [getattr(zotero_errors, name) for name in ['TooManyRequests', 'TooManyRequestsError',
+		                                                      'TooManyRetries', 'TooManyRetriesError',
+		                                                      'HTTPError', 'CouldNotReachURL', 'CouldNotReachURLError']
+		          if hasattr(zotero_errors, name)]
+		for client in ['httpx', 'httpx2']:
+			try:
+				errors.append(__import__(client).TransportError)
+			except (ImportError, AttributeError):
+				pass
+		return (requests.ConnectionError, requests.Timeout, *errors)
+	
+	def _timed(self, endpoint, fn, read=True):
+		'''
+		Wraps a call to the zotero API to send it through the rate limiter (which also records it in the metrics).
+		
+		pyzotero only returns the parsed output, so the response is taken from ``self.zot.request``. Since the
+		client is shared by all threads (e.g. the workers of a ``Parallel_Manager``), the calls hold a lock until
+		their response was read, so no call sees the response of another. Note that pyzotero doesn't raise for
+		throttled writes (it tries to parse and return the body of the 429 instead), so for writes the response is
+		only used to decide whether to retry.
+		'''
+		limiter = transport.limiter('zotero')
+		def timed(*args, **kwargs):
+			state = {}
+			def get_response():
+				resp = state.get('response')
+				if read or getattr(resp, 'status_code', None) in limiter.retry_statuses:
+					return resp
+			def send():
+				with self._zotero_lock:
+					try:
+						return fn(*args, **kwargs)
+					except ValueError: # e.g. the (empty) body of a throttled write
+						if getattr(getattr(self.zot, 'request', None), 'status_code', None) in limiter.retry_statuses:
+							return None
+						raise
+					finally:
+						state['response'] = self._local.response = getattr(self.zot, 'request', None)
+			return limiter.call(send, endpoint=endpoint, get_response=get_response,
+			                    retry_exceptions=self._retry_exceptions())
+		return timed
+	
 	_brand_tag_prefix = 'omnicite:'
 	
 	def brand_items(self, brand_tag, items):
+		if not self.ledger_tags: # recorded in the ledger instead (see ``mark_items``)
+			return
 		brand = f'{self._brand_tag_prefix}{brand_tag}'
 		for item in items:
 			if brand not in {tag['tag'] for tag in item.get('data', item)['tags']}:
 				item.get('data', item)['tags'].append({'tag': brand, 'type': 1})
 	
-	def update_items(self, items, use_brand_tag=True, brand_tag=None, **kwargs):
+	def mark_items(self, brand_tag, items, status='done'):
+		'''Records the items as processed by the stage ``brand_tag`` in the ledger (if there is one).'''
+		if self.ledger is not None and brand_tag is not None:
+			self.ledger.record(brand_tag, items, status=status)
+	
+	def refresh(self):
+		'''Forgets the cached listing of all top-level items (at the start of every stage, and after any write).'''
+		self._full_top = None
+	
+	def _changed(self):
+		self._mirror_synced = False
+		self.refresh()
+	
+	def _remember(self, out):
+		'''Remembers the new versions of the ``successful`` objects of a write (see ``written``).'''
+		if not isinstance(out, dict):
+			return
+		for item in out.get('successful', {}).values():
+			if isinstance(item, dict) and 'key' in item:
+				self.written[item['key']] = (item.get('version'), item.get('data', {}).get('parentItem'))
+	
+	def _last_output(self):
+		'''The parsed body of the last response of this thread (e.g. the results of a write).'''
+		try:
+			return self._local.response.json()
+		except (AttributeError, ValueError):
+			return None
+	
+	def update_items(self, items, use_brand_tag=True, brand_tag=None, status='done', **kwargs):
+		self._changed()
 		if use_brand_tag and brand_tag is None:
 			brand_tag = self.brand_tag
 		if brand_tag is not None:
@@ -54,45 +165,137 @@ class ZoteroProcess: # should be configurable
 			batches = [items[i:i+50] for i in range(0, len(items), 50)]
 			outs = []
 			for batch in batches:
-				out = self.zot.update_items(batch, **kwargs)
+				out = self._timed('update_items', self.zot.update_items, read=False)(batch, **kwargs)
+				if out:
+					self._remember(self._last_output())
+				if out and use_brand_tag:
+					self.mark_items(brand_tag, batch, status=status)
 				outs.append(out)
 			return all(outs)
-		return self.zot.update_items(items, **kwargs)
+		out = self._timed('update_items', self.zot.update_items, read=False)(items, **kwargs)
+		if out:
+			self._remember(self._last_output())
+		if out and use_brand_tag:
+			self.mark_items(brand_tag, items, status=status)
+		return out
 	
 	def create_items(self, items, use_brand_tag=True, brand_tag=None, **kwargs):
+		self._changed()
 		if use_brand_tag and brand_tag is None:
 			brand_tag = self.brand_tag
 		if brand_tag is not None:
 			self.brand_items(brand_tag, items)
+		out = self._create_items(items, **kwargs)
+		self._remember(out)
+		if use_brand_tag and isinstance(out, dict):
+			self.mark_items(brand_tag, out.get('successful', {}).values())
+		return out
+	
+	def _create_items(self, items, **kwargs):
 		if len(items) > 50:
 			batches = [items[i:i+50] for i in range(0, len(items), 50)]
 			outs = []
 			for batch in batches:
-				out = self.zot.create_items(batch, **kwargs)
+				out = self._timed('create_items', self.zot.create_items, read=False)(batch, **kwargs)
 				outs.append(out)
 			total = {}
-			for i, out in enumerate(outs[1:]):
-				for k, vs in out.items():
+			for i, out in enumerate(outs):
+				for k, vs in (out or {}).items():
 					if k not in total:
 						total[k] = {}
 					total[k].update({str(int(rid) + i*50): v for rid, v in vs.items()})
 			return total
-		return self.zot.create_items(items, **kwargs)
+		return self._timed('create_items', self.zot.create_items, read=False)(items, **kwargs)
 	
-	def top(self, brand_tag=None, top=True, **kwargs):
-		if len(kwargs) or brand_tag is not None:
-			return self.collect(top=top, brand_tag=brand_tag, **kwargs)
+	def top(self, brand_tag=None, top=True, keys=None, stream=False, **kwargs):
+		if len(kwargs) or brand_tag is not None or keys is not None:
+			return self.collect(top=top, brand_tag=brand_tag, keys=keys, stream=stream, **kwargs)
+		if stream and self._full_top is None: # not cached, since the items are only seen once
+			return self.collect(top=True, stream=True)
 		if self._full_top is None:
+			metrics.record_cache('zotero-top', misses=1)
 			self._full_top = self.collect(top=True)
+		else:
+			metrics.record_cache('zotero-top', hits=1)
 		return self._full_top
 	
+	def local(self) -> LibraryMirror:
+		'''The mirror of the library, which is synced first if anything was written since the last sync.'''
+		if not self._mirror_synced:
+			self.mirror.sync(self)
+			self._mirror_synced = True
+		return self.mirror
+	
 	def children(self, itemID, **kwargs):
-		return self.zot.children(itemID, **kwargs)
+		if self.mirror is not None and set(kwargs) <= {'itemType'}:
+			return self.local().query(parent=itemID, item_type=kwargs.get('itemType'))
+		return self._timed('children', self.zot.children)(itemID, **kwargs)
+	
+	def stream(self, top=False, collection=None, limit=None, window=None, trash=False, **params):
+		'''
+		Yields the items of a query as soon as their page arrives (all items, or at most ``limit``). The keys of all
+		matching items are fetched first (``format=versions``), then the items are requested by key concurrently,
+		where at most ``window`` pages are in flight (or waiting to be yielded) at any time, so memory stays bounded.
+		As the pages are fixed by this snapshot (rather than by offsets), items which stop matching the query while
+		the stream is open (e.g. when they are branded by a flush of the manager) don't shift the remaining pages.
+		With ``trash``, the items in the trash are listed instead.
+		'''
+		if window is None:
+			window = self.fetch_window
+		path = 'items/top' if top else 'items'
+		endpoint = 'top' if top else 'items'
+		if trash:
+			path, endpoint = 'items/trash', 'trash'
+		if collection is not None:
+			path = f'collections/{collection}/{path}'
+			endpoint = f'collection_items{"_top" if top else ""}'
+		url = f'{self.zot.endpoint}/{self.zot.library_type}/{self.zot.library_id}/{path}'
+		headers = {'Zotero-API-Version': '3', 'Zotero-API-Key': self.zot.api_key}
+		
+		def fetch(endpoint, **query):
+			resp = transport.request('zotero', 'GET', url, endpoint=endpoint, headers=headers,
+			                         params={**params, **query})
+			resp.raise_for_status()
+			return resp.json()
+		
+		def fetch_page(keys):
+			order = {key: i for i, key in enumerate(keys)}
+			items = fetch(endpoint, itemKey=','.join(keys), limit=len(keys))
+			return sorted(items, key=lambda item: order.get(item['key'], len(order)))
+		
+		if limit is not None and limit <= 0:
+			return
+		keys = list(fetch(f'{endpoint}_versions', format='versions')) # in the order of the query
+		if limit is not None:
+			keys = keys[:limit]
+		if not len(keys):
+			return
+		
+		batches = [keys[i:i+self._max_item_keys] for i in range(0, len(keys), self._max_item_keys)]
+		with ThreadPoolExecutor(max_workers=max(1, window)) as executor:
+			pages = deque()
+			for batch in batches:
+				pages.append(executor.submit(fetch_page, batch))
+				if len(pages) >= window:
+					yield from pages.popleft().result()
+			while len(pages):
+				yield from pages.popleft().result()
 	
 	def collect(self, q=None, top=False, collection=None, brand_tag=None, ignore_brand=None,
-	            limit=None, itemType=None, tag=None, **kwargs):
+	            limit=None, itemType=None, tag=None, keys=None, stream=False, **kwargs):
+		'''
+		Items matching the query (and the brand/exclusion tags), where all pages are fetched (up to the ``limit``).
+		With ``stream`` (and neither a ledger nor a scheduler, which need all items first, nor a mirror, which
+		already has them), a generator is returned which yields the items as they arrive instead.
+		'''
 		if brand_tag is None:
 			brand_tag = self.brand_tag
+		if ignore_brand is None:
+			ignore_brand = self.ignore_brand_tag
+		# any query the mirror can answer is selected locally (the attachment title has to match exactly)
+		local = self.mirror is not None and set(kwargs) <= {'sort', 'direction'}
+		# with a ledger, the processed items are filtered locally instead of with a (growing) negative tag query
+		use_ledger = self.ledger is not None and brand_tag is not None and not ignore_brand
 		if len(self.exclusion_tags) or brand_tag is not None:
 			if tag is None:
 				tag = self.exclusion_tags
@@ -100,40 +303,159 @@ class ZoteroProcess: # should be configurable
 				tag = [tag, *self.exclusion_tags]
 			else:
 				tag = [*tag, *self.exclusion_tags]
-			if ignore_brand is None:
-				ignore_brand = self.ignore_brand_tag
-			if brand_tag is not None and not ignore_brand:
+			if brand_tag is not None and not ignore_brand and not use_ledger:
 				tag = [*tag, f'-{self._brand_tag_prefix}{brand_tag}']
 		
 		if limit is None:
 			limit = self.limit
-		
+		if use_ledger and limit is not None: # enough for ``limit`` unprocessed items
+			kwargs['limit'] = limit + self.ledger.count(brand_tag)
+
 		if q is not None:
 			kwargs['q'] = q
 		if itemType is not None:
 			kwargs['itemType'] = itemType
 		if tag is not None:
 			kwargs['tag'] = tag
-		if limit is not None:
+		if limit is not None and 'limit' not in kwargs:
 			kwargs['limit'] = limit
+		scheduler = self.scheduler
+		if scheduler is not None and keys is None:
+			kwargs = {**scheduler.sort_kwargs(), **kwargs}
+
+		if local:
+			attachments = itemType == 'attachment'
+			order = {key: value for key, value in kwargs.items() if key in {'sort', 'direction'}}
+			items = self.local().query(top=top, item_type=itemType, tags=tag, collection=collection, keys=keys,
+			                           title=q if attachments else None, q=None if attachments else q,
+			                           limit=None if use_ledger or scheduler is not None else limit, **order)
+			if use_ledger:
+				items = self.ledger.pending(brand_tag, items, brand=f'{self._brand_tag_prefix}{brand_tag}')
+			if scheduler is not None:
+				items = scheduler.order(items)
+			if limit is not None:
+				items = items[:limit]
+			return items
 		
+		if keys is None and stream and not use_ledger and scheduler is None:
+			return self.stream(top=top, collection=collection, **kwargs)
+
 		if collection is not None:
-			collect_fn = self.zot.collection_items_top if top else self.zot.collection_items
-			return collect_fn(collection, **kwargs)
-		collect_fn = self.zot.top if top else self.zot.items
-		return collect_fn(**kwargs)
+			endpoint = 'collection_items_top' if top else 'collection_items'
+			collect_fn = partial(getattr(self.zot, endpoint), collection)
+		else:
+			endpoint = 'top' if top else 'items'
+			collect_fn = getattr(self.zot, endpoint)
+		collect_fn = self._timed(endpoint, collect_fn)
+		
+		if keys is None:
+			items = list(self.stream(top=top, collection=collection, **kwargs))
+			if scheduler is not None and scheduler.uses_flagged and collection is None:
+				items = self._collect_flagged(items, scheduler.flagged_collections, top=top, **kwargs)
+		else:
+			items = self._collect_keys(collect_fn, keys, top=top, **kwargs)
+		if use_ledger:
+			items = self.ledger.pending(brand_tag, items, brand=f'{self._brand_tag_prefix}{brand_tag}')
+		if scheduler is not None: # the limit keeps the most important items
+			items = scheduler.order(items)
+		if limit is not None and (use_ledger or scheduler is not None):
+			items = items[:limit]
+		return items
+	
+	def _collect_flagged(self, items, collections, top=False, **kwargs):
+		'''Adds the items of the (flagged) collections to the query results, so they aren't cut off by the limit.'''
+		seen = {item['key'] for item in items}
+		for collection in collections:
+			for item in self.stream(top=top, collection=collection, **kwargs):
+				if item['key'] not in seen:
+					seen.add(item['key'])
+					items.append(item)
+		return items
+	
+	_max_item_keys = 50
+	
+	def _collect_keys(self, collect_fn, keys, top=False, **kwargs):
+		'''Restricts a query to the given item keys (or, for child items, to children of those keys).'''
+		keys = set(keys)
+		if not len(keys):
+			return []
+		if top:
+			ordered = sorted(keys)
+			items = []
+			for i in range(0, len(ordered), self._max_item_keys):
+				items.extend(collect_fn(itemKey=','.join(ordered[i:i+self._max_item_keys]), **kwargs))
+		else:
+			items = collect_fn(**kwargs)
+		return [item for item in items
+		        if item['key'] in keys or item['data'].get('parentItem') in keys]
 
+	def item(self, key, **kwargs):
+		return self._timed('item', self.zot.item)(key, **kwargs)
+	
+	def get_items(self, keys):
+		'''Any (top-level or child) items with the given keys.'''
+		return self._collect_keys(self._timed('items', self.zot.items), keys, top=True)
+	
+	def library_version(self):
+		return self._timed('library_version', self.zot.last_modified_version)()
+	
+	def item_versions(self, since=None, **kwargs):
+		'''Versions of all items (including children) that changed since the library version ``since``.'''
+		if since is not None:
+			kwargs['since'] = since
+		return self._timed('item_versions', self.zot.item_versions)(**kwargs)
+	
+	def deleted(self, since):
+		'''Keys of the objects deleted since the library version ``since`` (by type, e.g. ``items``).'''
+		return self._timed('deleted', self.zot.deleted)(since=since)
+	
+	def trash(self, since=None, **kwargs):
+		'''
+		All items in the trash (which changed since the library version ``since``), where all pages are fetched
+		(the ``limit`` of the stages doesn't apply, since every trashed item has to be cleaned up).
+		'''
+		if since is not None:
+			kwargs['since'] = since
+		return list(self.stream(trash=True, limit=None, **kwargs))
+	
 	def delete_items(self, items):
-		return [self.zot.delete_item(item) for item in items]
+		self._changed()
+		delete_fn= self._timed('delete_item', self.zot.delete_item, read=False)
+		return [delete_fn(item) for item in items]
 		
 	def find_collection(self, **kwargs):
-		return self.zot.collections(**kwargs)
+		if self.mirror is not None and set(kwargs) == {'q'}: # exact name instead of a quick search
+			return self.local().find_collections(kwargs['q'])
+		return self._timed('collections', self.zot.collections)(**kwargs)
 
 	def get_collection(self, collectionID, **kwargs):
-		return self.zot.collection(collectionID, **kwargs)
+		return self._timed('collection', self.zot.collection)(collectionID, **kwargs)
 
 	def all_collections(self, **kwargs):
-		return self.zot.all_collections(**kwargs)
+		'''
+		All collections of the library, which are cached until the library changes (checked with a single
+		``If-Modified-Since-Version`` request instead of one request per collection with subcollections).
+		'''
+		if len(kwargs):
+			return self._timed('all_collections', self.zot.all_collections)(**kwargs)
+		
+		url = f'{self.zot.endpoint}/{self.zot.library_type}/{self.zot.library_id}/collections'
+		entry = transport.cache.get('zotero', url)
+		headers = {'Zotero-API-Version': '3', 'Zotero-API-Key': self.zot.api_key}
+		if entry is not None:
+			headers.update(transport.cache.conditional_headers(entry))
+		resp = transport.request('zotero', 'GET', url, endpoint='collections-version', headers=headers,
+		                         params={'format': 'versions', 'limit': 1})
+		if resp.status_code == 304 and entry is not None:
+			metrics.record_cache('zotero-collections', hits=1)
+			return json.loads(entry['body'])
+		resp.raise_for_status()
+		metrics.record_cache('zotero-collections', misses=1)
+		collections = self._timed('all_collections', self.zot.all_collections)()
+		version = resp.headers.get('Last-Modified-Version')
+		if version is not None:
+			transport.cache.put('zotero', url, json.dumps(collections), {'Last-Modified-Version': version})
+		return collections
 
 
 @fig.component('onedrive-auth')
@@ -141,9 +463,10 @@ class OneDriveProcess(fig.Configurable):
 	@fig.silent_config_args('graph-app-id', '_header')
 	def __init__(self, graph_app_id, _header=None, graph_scopes=(),
 	             auto_copy=True, auto_open_browser=True, onedrive_info_path='onedrive-info.json',
-	             
+	             graph_root='https://graph.microsoft.com/v1.0', rate_limits=None, http_cache=None,
 	             **kwargs):
 		super().__init__(**kwargs)
+		transport.configure(rate_limits, http_cache=http_cache)
 		
 		self.auto_copy = auto_copy
 		self.auto_open_browser = auto_open_browser
@@ -152,8 +475,8 @@ class OneDriveProcess(fig.Configurable):
 			self.storage_path = Path(self.storage_path)
 		
 		self.app_id = graph_app_id
-		if self._onedrive_app is None:
-			self.__class__._onedrive_app = PublicClientApplication(self.app_id, authority=self._authority_url)
+		self.graph_root = graph_root.rstrip('/')
+		self.endpoint = f'{self.graph_root}/me'
 		
 		if self._onedrive_header is None:
 			self.__class__._onedrive_header = _header
@@ -176,9 +499,13 @@ class OneDriveProcess(fig.Configurable):
 				new = False
 				print('Using existing onedrive auth info (', self.storage_path, ')')
 			else:
+				if self._onedrive_app is None:
+					from msal import PublicClientApplication
+					self.__class__._onedrive_app = PublicClientApplication(self.app_id, authority=self._authority_url)
 				self._onedrive_flow = self._onedrive_app.initiate_device_flow(scopes=self.scopes)
 				print('OneDrive:', self._onedrive_flow['message'])
 				if self.auto_copy:
+					import pyperclip
 					pyperclip.copy(self._onedrive_flow['user_code'])
 					print('(code copied to clipboard!) Waiting for you to complete the sign in...')
 				
@@ -203,13 +530,15 @@ class OneDriveProcess(fig.Configurable):
 	def is_expired(self):
 		return self._onedrive_header is None
 	
-	endpoint = 'https://graph.microsoft.com/v1.0/me'
-	
-	def send_request(self, send_fn, retry=1, auto_wait=False):
+	def send_request(self, send_fn, retry=1, endpoint='request'):
+		'''
+		Sends a request (``send_fn`` gets the auth header) through the rate limiter, so throttled or failed requests
+		are retried there. Here the request is only retried if the token expired.
+		'''
 		if self.is_expired():
 			self.authorize()
 		
-		response = send_fn(self._onedrive_header)
+		response = transport.limiter('graph').call(lambda: send_fn(self._onedrive_header), endpoint=endpoint)
 		out = response.json()
 		
 		if 'error' in out and retry > 0:
@@ -218,32 +547,8 @@ class OneDriveProcess(fig.Configurable):
 				self.__class__._onedrive_header = None
 				if self.storage_path is not None and self.storage_path.exists():
 					os.remove(str(self.storage_path))
-				return self.send_request(send_fn, retry-1, auto_wait=auto_wait)
-		
-		if retry > 0 and auto_wait and out.get('responses', [{}])[0].get('status') == 429:
-			if 'responses' in out:
-				resp = out['responses'][0]
-				wait_time = resp.get('headers', {}).get('Retry-After')
-
-				etype = f'{resp["status"]} {resp["body"]["error"]["code"]}'
-				emsg = resp["body"]["error"]["message"]
-			else:
-				wait_time = out.get('headers', {}).get('Retry-After')
-
-				etype = f'{out["status"]} {out["body"]["error"]["code"]}'
-				emsg = out["body"]["error"]["message"]
-			
-			print(f'OneDrive: {etype}: {emsg}')
-			if wait_time is not None:
-				# wait_time = int(wait_time) + 1
-				# print(f'Waiting {wait_time // 60}:{str(wait_time % 60).zfill(2)} min and then retrying...')
-				
-				done = datetime.now() + timedelta(seconds=wait_time)
-				print(f'Waiting {wait_time // 60}:{str(wait_time % 60).zfill(2)} min '
-				      f'until {done.strftime("%H:%M:%S")} and then retrying...')
-				
-				time.sleep(wait_time)
-				return self.send_request(send_fn, retry=retry-1, auto_wait=auto_wait)
+				metrics.add_retry('graph')
+				return self.send_request(send_fn, retry-1, endpoint=endpoint)
 		
 		return out
 		
@@ -252,15 +557,35 @@ class OneDriveProcess(fig.Configurable):
 		if self.is_expired():
 			self.authorize()
 		
+		session = transport.limiter('graph').session
 		out = self.send_request(lambda header:
-		                        requests.get(self.endpoint + f'/drive/root:/{str(path)}/:/children'.replace('\\', '/'),
-		                                             headers=header))
+		                        session.get(self.endpoint + f'/drive/root:/{str(path)}/:/children'.replace('\\', '/'),
+		                                    headers=header), endpoint='children')
 		return out['value']
 		
 		
 	def get_meta(self, paths):
-		reqs = [self.generate_request(f'/me/drive/root:/{path}'.replace('\\', '/')) for path in paths]
+		'''
+		Metadata of the files, where any previously fetched metadata is only revalidated (with the ``eTag``),
+		so unchanged files are answered with a 304 (and the cached metadata is used).
+		'''
+		urls = [f'/me/drive/root:/{path}'.replace('\\', '/') for path in paths]
+		entries = [transport.cache.get('graph', url) for url in urls]
+		reqs = [self.generate_request(url) if entry is None else
+		        self.generate_request(url, headers=transport.cache.conditional_headers(entry))
+		        for url, entry in zip(urls, entries)]
 		out = self.batch_send(reqs)
+		
+		hits = 0
+		for i, (url, entry, resp) in enumerate(zip(urls, entries, out)):
+			if resp['status'] == 304 and entry is not None:
+				out[i] = {**resp, 'status': 200, 'body': json.loads(entry['body'])}
+				hits += 1
+			elif resp['status'] == 200:
+				etag = resp.get('body', {}).get('eTag', resp.get('headers', {}).get('ETag'))
+				if etag is not None:
+					transport.cache.put('graph', url, json.dumps(resp['body']), {'ETag': etag})
+		metrics.record_cache('http-graph', hits=hits, misses=len(out) - hits)
 		return out
 
 	
@@ -291,20 +616,23 @@ class OneDriveProcess(fig.Configurable):
 	def batch_send(self, reqs):
 		req_order = {id(req): i for i, req in enumerate(reqs)}
 		
+		limiter = transport.limiter('graph')
 		resps = [None] * len(reqs)
 		remaining = list(reqs)
+		attempt = 0
 		while len(remaining):
 			batch = [remaining.pop() for _ in range(min(len(remaining), self._batch_size))]
 			for i, req in enumerate(batch):
 				req['id'] = str(i + 1)
 			
 			out = self.send_request(lambda header:
-			                        requests.post('https://graph.microsoft.com/v1.0/$batch',
-			                                      json={'requests': batch},
-			                                      headers={'content-type': 'application/json', **header}))
+			                        limiter.session.post(f'{self.graph_root}/$batch',
+			                                             json={'requests': batch},
+			                                             headers={'content-type': 'application/json', **header}),
+			                        endpoint='$batch')
 			bad = []
 			for i, resp in enumerate(out['responses']):
-				if resp['status'] < 300:
+				if resp['status'] < 300 or resp['status'] == 304:
 					resps[req_order[id(batch[int(resp['id'])-1])]] = resp
 				else:
 					# print(f'OneDrive: {resp["status"]} {resp["body"]["error"]["code"]}: {resp["body"]["error"]["message"]}')
@@ -317,19 +645,25 @@ class OneDriveProcess(fig.Configurable):
 
 				wait_times = [int(resp['headers']['Retry-After'])
 				              for resp in bad if 'Retry-After' in resp.get('headers', {})]
+				metrics.add_throttled('graph', sum(1 for resp in bad if resp['status'] == 429))
 				
 				print(f'OneDrive: {etype}: {emsg} ({len(bad)}/{len(batch)} failed)')
 				if len(wait_times):
 					sec = max(wait_times)
-				
-					done = datetime.now() + timedelta(seconds=sec)
-					print(f'Waiting {sec // 60}:{str(sec % 60).zfill(2)} min '
-					      f'until {done.strftime("%H:%M:%S")} and then retrying (safe to exit)...')
-					time.sleep(sec)
-				
+				elif all(resp['status'] in limiter.retry_statuses for resp in bad) and attempt < limiter.max_retries:
+					sec = int(limiter.backoff(attempt)) + 1
 				else:
 					raise Exception(f'OneDrive: {etype}: {emsg} (and no retry times given)')
+				
+				done = datetime.now() + timedelta(seconds=sec)
+				print(f'Waiting {sec // 60}:{str(sec % 60).zfill(2)} min '
+				      f'until {done.strftime("%H:%M:%S")} and then retrying (safe to exit)...')
+				# pausing the limiter also holds back all other requests to graph (e.g. from other threads)
+				limiter.wait(sec)
+				attempt += 1
 			
+			if len(bad):
+				metrics.add_retry('graph', len(bad))
 			remaining.extend(batch[int(resp['id'])-1] for resp in bad)
 		
 		return resps
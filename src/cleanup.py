@@ -0,0 +1,171 @@
+from pathlib import Path
+import os
+import json
+import shutil
+
+import omnifig as fig
+
+from .util import Script_Manager
+from .auth import ZoteroProcess
+from .features import Attachment_Based
+from .pulling import NotionDatabase
+
+
+@fig.component('deletion-cleaner')
+class DeletionCleaner(NotionDatabase, Attachment_Based):
+	'''
+	Archives the Notion pages of the Zotero items which were deleted or moved to the trash since the last
+	cleanup, and optionally moves their files (only the linked files in ``cloud_root`` or ``wordcloud_root``, i.e.
+	the renamed PDFs and the wordclouds) to ``trash_root``.
+	
+	Only the changes since the library version of the last cleanup (stored in ``deletion_checkpoint``) are
+	requested with ``deleted?since=`` and ``items/trash?since=`` (all pages), and the pages are found with one
+	query per 100 items. The checkpoint only moves forward once every change was handled (otherwise the same
+	changes are requested again next time). Note that the files of deleted items can only be found while the
+	items are in the trash.
+	'''
+	def __init__(self, deletion_checkpoint=None, trash_root=None,
+	             cloud_root=str(Path.home() / 'OneDrive/Papers/zotero'),
+	             wordcloud_root=str(Path.home() / 'OneDrive/Papers/wordclouds'), **kwargs):
+		super().__init__(**kwargs)
+		self.trash_root = None if trash_root is None else Path(trash_root)
+		self.managed_roots = [Path(root) for root in [cloud_root, wordcloud_root] if root is not None]
+		
+		self.checkpoint_path = None if deletion_checkpoint is None else Path(deletion_checkpoint)
+		self.version = None
+		if self.checkpoint_path is not None and self.checkpoint_path.exists():
+			try:
+				self.version = json.loads(self.checkpoint_path.read_text(encoding='utf-8')).get('version')
+			except ValueError:
+				pass
+		self._start_version = None
+
+
+	def changes(self, zot: ZoteroProcess):
+		'''The keys of the deleted items and the trashed items since the last cleanup.'''
+		self._start_version = zot.library_version()
+		since = 0 if self.version is None else self.version
+		deleted = zot.deleted(since).get('items', [])
+		trashed = zot.trash(since=since)
+		return deleted, trashed
+
+
+	_max_filter_keys = 100
+	
+	def find_pages(self, keys):
+		'''The pages of the given items (by key), which are found with one query per 100 keys.'''
+		keys = sorted(keys)
+		pages = {}
+		for i in range(0, len(keys), self._max_filter_keys):
+			batch = keys[i:i+self._max_filter_keys]
+			query = {'or': [{'property': self.key_property, 'rich_text': {'equals': key}} for key in batch]}
+			for page in self.query(filter=query):
+				key = self.page_key(page)
+				if key is not None:
+					pages.setdefault(key, []).append(page)
+		return pages
+
+
+	def archive_page(self, page):
+		return self.send_request('PATCH', f'{self.notion_root}/pages/{page["id"]}', data={'archived': True})
+
+
+	def orphaned_files(self, attachments):
+		'''The paths of the linked files (managed by omni-cite) of the given attachments.'''
+		paths = []
+		for attachment in attachments:
+			data = attachment['data']
+			if data.get('itemType') == 'attachment' and data.get('linkMode') == 'linked_file' and 'path' in data:
+				path = self.fix_path(data['path'])
+				if any(root == path.parent or root in path.parents for root in self.managed_roots) \
+						and path.exists():
+					paths.append(path)
+		return paths
+
+
+	def move_to_trash(self, path):
+		self.trash_root.mkdir(parents=True, exist_ok=True)
+		dest = self.trash_root / path.name
+		i = 1
+		while dest.exists():
+			dest = self.trash_root / f'{path.stem} ({i}){path.suffix}'
+			i += 1
+		shutil.move(str(path), str(dest))
+		return dest
+
+
+	def commit(self):
+		if self.checkpoint_path is not None and self._start_version is not None:
+			self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+			tmp = self.checkpoint_path.with_name(f'{self.checkpoint_path.name}.tmp')
+			tmp.write_text(json.dumps({'version': self._start_version}), encoding='utf-8')
+			os.replace(str(tmp), str(self.checkpoint_path))
+		self.version = self._start_version
+
+
+def prepare_cleanup(A):
+	A.push('manager._type', 'zotero-manager', overwrite=False, silent=True)
+	A.push('manager.pbar_desc', 'Cleanup', overwrite=False, silent=True)
+	
+	A.push('zotero._type', 'zotero', overwrite=False, silent=True)
+	zot: ZoteroProcess = A.pull('zotero')
+	
+	A.push('cleaner._type', 'deletion-cleaner', overwrite=False, silent=True)
+	cleaner: DeletionCleaner = A.pull('cleaner')
+	return {'zot': zot, 'cleaner': cleaner}
+
+
+def run_cleanup(manager: Script_Manager, zot: ZoteroProcess, cleaner: DeletionCleaner):
+	manager.preamble(zot=zot)
+	
+	deleted, trashed = cleaner.changes(zot)
+	trashed_top = [item for item in trashed if 'parentItem' not in item['data']]
+	keys = set(deleted).union(item['key'] for item in trashed_top)
+	manager.log(f'Found {len(deleted)} deleted and {len(trashed)} trashed items.')
+	
+	pages = cleaner.find_pages(keys) if len(keys) else {}
+	items = {item['key']: item for item in trashed}
+	
+	handled = set()
+	def archive(key):
+		item = items.get(key, {'key': key})
+		for page in pages[key]:
+			if not manager.is_real_run:
+				manager.log(f'Would archive notion page {page.get("url")}')
+				continue
+			resp = cleaner.archive_page(page)
+			if resp.get('status', 200) != 200:
+				manager.log_error(f'{resp.get("status")}: {resp.get("code")}', resp.get('message'), item=item)
+				return
+			manager.log_success('archived', f'Archived notion page {page.get("url")}', item)
+		handled.add(key)
+	
+	manager.map(archive, list(pages), desc='Archive Notion pages')
+	
+	if cleaner.trash_root is not None:
+		attachments = [item for item in trashed if 'parentItem' in item['data']]
+		for item in trashed_top:
+			attachments.extend(zot.children(item['key']))
+		for path in cleaner.orphaned_files(attachments):
+			if manager.is_real_run:
+				dest = cleaner.move_to_trash(path)
+				manager.log_success('moved', f'Moved {path.name} to {dest.parent}')
+			else:
+				manager.log(f'Would move {path} to {cleaner.trash_root}')
+	
+	out = manager.finish()
+	if manager.is_real_run:
+		if len(handled) == len(pages) and not manager.num_errors:
+			cleaner.commit()
+		else:
+			manager.log(f'Not all changes were handled ({len(pages) - len(handled)} items left), so they will be '
+			            f'requested again in the next cleanup.')
+	return out
+
+
+@fig.script('cleanup', description='Archive the Notion pages (and move the files) of deleted Zotero items.')
+def cleanup(A):
+	components = prepare_cleanup(A)
+	manager: Script_Manager = A.pull('manager')
+	with manager.guard():
+		return run_cleanup(manager, **components)
@@ -0,0 +1,135 @@
+from typing import Dict, List, Tuple, Iterable, Optional, Callable
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import omnifig as fig
+
+from .util import Script_Manager, Parallel_Manager, get_now
+from .metrics import metrics
+from .processing import prepare_item_feature, run_item_feature, prepare_process_attachments, \
+	run_process_attachments, prepare_attachment_feature, run_attachment_feature
+from .sharing import prepare_onedrive_links, run_onedrive_links
+from .publishing import prepare_sync_notion, run_sync_notion
+from .top import process_stages, sharing_stages, publish_stages
+
+
+class OmniCite:
+	'''
+	Long-lived entry point to run the ``process``, ``sharing``, and ``publish`` scripts from python.
+
+	The config is parsed and all components of each stage (zotero, onedrive, publisher, extractors, etc.) are
+	created once, the first time the stage is needed, and then reused for every subsequent call. Only the
+	(cheap) ``Script_Manager`` is created anew for each call.
+
+	If the stages use a ``parallel-manager``, the engine also owns the thread pool that all of their workers share
+	(use the engine as a context manager or call ``close()`` to shut it down).
+	'''
+
+	_stage_fns: Dict[str, Tuple[Callable, Callable]] = {
+		'item-feature': (prepare_item_feature, run_item_feature),
+		'process-attachments': (prepare_process_attachments, run_process_attachments),
+		'extract-attachment-feature': (prepare_attachment_feature, run_attachment_feature),
+		'onedrive-links': (prepare_onedrive_links, run_onedrive_links),
+		'sync-notion': (prepare_sync_notion, run_sync_notion),
+	}
+
+	_stage_lists = {
+		'process': process_stages,
+		'share': sharing_stages,
+		'publish': publish_stages,
+	}
+
+	def __init__(self, config: fig.Configuration, workers: Optional[int] = None):
+		self.config = config
+		self.workers = workers
+		self._stages = {}
+		self._lock = threading.RLock()
+		self._pool = None
+
+	@classmethod
+	def from_config(cls, *configs: str, **parameters):
+		'''Creates the engine from registered config files (e.g. ``'secrets'``, ``'notion'``) and parameters.'''
+		return cls(fig.create_config(*configs, **parameters))
+
+
+	@property
+	def pool(self) -> ThreadPoolExecutor:
+		'''Worker pool shared by all parallel managers of this engine.'''
+		with self._lock:
+			if self._pool is None:
+				workers = self.workers
+				if workers is None:
+					workers = self.config.pull('workers', 4, silent=True)
+				self._pool = ThreadPoolExecutor(max_workers=workers)
+			return self._pool
+
+	def close(self):
+		with self._lock:
+			if self._pool is not None:
+				self._pool.shutdown()
+				self._pool = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+	class Stage:
+		def __init__(self, engine, script_name, config, components, run_fn):
+			self.engine = engine
+			self.script_name = script_name
+			self.config = config
+			self.components = components
+			self.run_fn = run_fn
+
+		def run(self, keys=None, **kwargs):
+			for component in self.components.values():
+				if hasattr(component, 'timestamp'):
+					component.timestamp = get_now()
+			manager: Script_Manager = self.config.peek_create('manager', **kwargs)
+			if isinstance(manager, Parallel_Manager) and manager.executor is None:
+				manager.executor = self.engine.pool
+			with manager.guard():
+				return self.run_fn(manager, keys=keys, **self.components)
+
+
+	def stages(self, name: str) -> List['OmniCite.Stage']:
+		'''Returns the (cached) stages of the top-level script ``name`` ('process', 'share' or 'publish').'''
+		with self._lock:
+			if name not in self._stages:
+				stages = []
+				for script_name, cfg in self._stage_lists[name](self.config):
+					prepare_fn, run_fn = self._stage_fns[script_name]
+					stages.append(self.Stage(self, script_name, cfg, prepare_fn(cfg), run_fn))
+				self._stages[name] = stages
+			return self._stages[name]
+
+	def reset(self, name: Optional[str] = None):
+		'''Drops the cached components (of one or all top-level scripts) so they are recreated on the next call.'''
+		with self._lock:
+			if name is None:
+				self._stages.clear()
+			else:
+				self._stages.pop(name, None)
+
+	def run(self, name: str, keys: Optional[Iterable[str]] = None, **kwargs) -> List[Script_Manager]:
+		'''
+		Runs all stages of the top-level script ``name`` and returns the managers of each stage.
+
+		If ``keys`` are provided, only the items (or children of the items) with those Zotero keys are processed.
+		Any additional keyword arguments are passed to the managers (e.g. ``dry_run=True``).
+		'''
+		if keys is not None:
+			keys = list(keys)
+		with self._lock, metrics.run():
+			return [stage.run(keys=keys, **kwargs) for stage in self.stages(name)]
+
+	def process(self, keys: Optional[Iterable[str]] = None, **kwargs) -> List[Script_Manager]:
+		return self.run('process', keys, **kwargs)
+
+	def share(self, keys: Optional[Iterable[str]] = None, **kwargs) -> List[Script_Manager]:
+		return self.run('share', keys, **kwargs)
+
+	def publish(self, keys: Optional[Iterable[str]] = None, **kwargs) -> List[Script_Manager]:
+		return self.run('publish', keys, **kwargs)
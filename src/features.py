@@ -8,15 +8,12 @@ from tabulate import tabulate
 from collections import OrderedDict
 
 import re
-import fitz
 from urllib.parse import urlparse, quote
 import requests
-import pdfkit
-import PyPDF2
-from fuzzywuzzy import fuzz
-from wordcloud import WordCloud, STOPWORDS
 
 from .util import create_note, create_file, create_url, get_now, Script_Manager
+from .metrics import metrics
+from .transport import transport
 
 
 class Item_Feature(fig.Configurable):
@@ -97,15 +94,17 @@ class Google_Scholar(Paper_Feature):
 			url = self.google_scholar_url_base.format(url_title=quote(title))
 			new = create_url(self.attachment_name, url, parentItem=item['key'], accessDate=self.timestamp)
 			manager.add_new(new, msg=f'Using {url}')
-			manager.add_update(item, msg=f'Using {url}')
+			manager.add_branded(item, msg=f'Using {url}')
 		else:
 			manager.add_failed(item, msg='No title')
 
 
 @fig.component('semantic-scholar')
 class Semantic_Scholar(Paper_Feature):
-	def __init__(self, match_ratio=92, attachment_name='Semantic Scholar', **kwargs):
+	def __init__(self, match_ratio=92, attachment_name='Semantic Scholar', rate_limits=None, http_cache=None,
+	             **kwargs):
 		super().__init__(**kwargs)
+		transport.configure(rate_limits, http_cache=http_cache)
 		self.match_ratio = match_ratio
 		self.attachment_name = attachment_name
 		self.timestamp = get_now()
@@ -122,7 +121,8 @@ class Semantic_Scholar(Paper_Feature):
 		return quote(fixed).replace('%2B', '+')
 	
 	def call_home(self, url):
-		out = requests.get(url).json()
+		resp = transport.request('semanticscholar', 'GET', url, endpoint='paper/search')
+		out = resp.json()
 		return out
 	
 	def format_result(self, ssid):
@@ -140,6 +140,7 @@ class Semantic_Scholar(Paper_Feature):
 		
 		out = self.call_home(url)
 		
+		from fuzzywuzzy import fuzz
 		for res in out.get('data', []):
 			if fuzz.ratio(res.get('title', ''), title) >= self.match_ratio:
 				return self.format_result(res.get('paperId', ''))
@@ -151,7 +152,7 @@ class Semantic_Scholar(Paper_Feature):
 		if url is not None and len(url):
 			new = create_url(self.attachment_name, url, parentItem=item['key'], accessDate=self.timestamp)
 			manager.add_new(new, msg=f'Found {url}')
-			manager.add_update(item, msg=f'Found {url}')
+			manager.add_branded(item, msg=f'Found {url}')
 		else:
 			manager.add_failed(item, msg='No match found')
 
@@ -190,9 +191,16 @@ class Attachment_Feature(Attachment_Based):
 	
 
 class PDF_Feature(Attachment_Feature):
+	def __init__(self, fulltext_index=None, **kwargs):
+		super().__init__(**kwargs)
+		if fulltext_index is not None:
+			from .fulltext import open_index
+			fulltext_index = open_index(fulltext_index)
+		self.fulltext_index = fulltext_index
 	
 	@staticmethod
 	def extract_text(path):
+		import fitz
 		pdf = fitz.open(path)
 		full_text = []
 		for n in range(pdf.page_count):
@@ -204,6 +212,14 @@ class PDF_Feature(Attachment_Feature):
 		full_text = cls.extract_text(path)
 		transcript = '\n'.join(full_text)
 		return transcript
+	
+	def transcript(self, item):
+		'''The transcript of the attachment (reused from the full-text index if the file didn't change).'''
+		path = self.fix_path(item['data']['path'])
+		if self.fulltext_index is None:
+			return self.extract_transcript(path)
+		return self.fulltext_index.transcript(item['key'], path, self.extract_transcript,
+		                                      parent=item['data'].get('parentItem'))
 
 
 class CodeExtractor(Attachment_Feature):
@@ -230,6 +246,7 @@ class GithubExtractor(CodeExtractor, PDF_Feature):
 	
 	@staticmethod
 	def extract_pdf_links(path):
+		import PyPDF2
 		PDF = PyPDF2.PdfReader(str(path))
 		pages = PDF.pages
 		key = '/Annots'
@@ -254,9 +271,10 @@ class GithubExtractor(CodeExtractor, PDF_Feature):
 	
 	
 	@classmethod
-	def extract_urls(cls, path):
+	def extract_urls(cls, path, transcript=None):
 		path = Path(path)
-		transcript = cls.extract_transcript(path)
+		if transcript is None:
+			transcript = cls.extract_transcript(path)
 		
 		urls = cls.extract_pdf_links(path) + cls.find_urls(transcript)
 		urls = [url if isinstance(url, str) else (url.decode() if isinstance(url, bytes) else str(url)) for url in urls]
@@ -283,15 +301,16 @@ class GithubExtractor(CodeExtractor, PDF_Feature):
 	
 	
 	@classmethod
-	def code_urls_from_path(cls, path):
-		urls = cls.extract_urls(path)
+	def code_urls_from_path(cls, path, transcript=None):
+		urls = cls.extract_urls(path, transcript)
 		return cls.select_code_urls(urls)
 	
 	
 	def extract(self, items, get_parent, manager):
 		srcs = [src for src in items if 'path' in src['data']]
 		assert len(srcs), 'No sources found'
-		urls = [url for src in srcs for url in self.code_urls_from_path(self.fix_path(src['data']['path']))]
+		urls = [url for src in srcs for url in self.code_urls_from_path(self.fix_path(src['data']['path']),
+		                                                                self.transcript(src))]
 		urls = list(OrderedDict.fromkeys(urls))
 		
 		if len(urls):
@@ -304,7 +323,7 @@ class GithubExtractor(CodeExtractor, PDF_Feature):
 			links = "\n".join(urls)
 			msg = f'{len(urls)} code links (from {len(srcs)} sources)\n{links}'
 			manager.add_new(note, msg=msg)
-			manager.add_update(*items, msg=msg)
+			manager.add_branded(*items, msg=msg)
 			return note
 		
 		manager.add_failed(*items, msg='No code links found')
@@ -324,7 +343,7 @@ class WordcloudMaker(PDF_Feature, fig.Configurable):
 			
 		stopwords = set(extra_stopwords)
 		if use_stopwords:
-			stopwords = {*stopwords, *self.EXPANDED_STOPWORDS}
+			stopwords = {*stopwords, *self.expanded_stopwords()}
 		
 		super().__init__(feature_title=feature_title, **kwargs)
 		
@@ -430,7 +449,7 @@ class WordcloudMaker(PDF_Feature, fig.Configurable):
 	                "x3", "xf", "xi", "xj", "xk", "xl", "xn", "xo", "xs", "xt", "xv", "xx", "y", "Y", "y2", "yes",
 	                "yet", "yj", "yl", "you", "youd", "your", "youre", "yours", "yr", "ys", "yt", "z", "Z", "zero",
 	                "zi", "zz"]
-	EXPANDED_STOPWORDS = {'arXiv', 'preprint', 'arxiv', 'proceedings', 'advances', 'model', 'sample', 'samples',
+	paper_stopwords = {'arXiv', 'preprint', 'arxiv', 'proceedings', 'advances', 'model', 'sample', 'samples',
 	                      'images',
 	                      'using', 'image', 'set', 'models', 'journal', 'international', 'conference', 'article',
 	                      'method', 'outcome', 'data', 'section', 'pages',
@@ -439,8 +458,16 @@ class WordcloudMaker(PDF_Feature, fig.Configurable):
 	                      'really', 'think', 'thing', 'know', 'need', 'going', 'maybe', 'want', 'something',
 	                      'will', 'make', 'may', 'another', 'much', 'many',
 	                      'mathbf', 'mathbb', 'nabla', 'nabla_', 'mathrm',
-	                      'Neural Information Processing Systems', 'use', 'Figure', 'Fig', 'Table', 'Equation',
-	                      *STOPWORDS, *gh_stopwords}
+	                      'Neural Information Processing Systems', 'use', 'Figure', 'Fig', 'Table', 'Equation'}
+	
+	_expanded_stopwords = None
+	
+	@classmethod
+	def expanded_stopwords(cls):
+		if cls._expanded_stopwords is None:
+			from wordcloud import STOPWORDS
+			cls._expanded_stopwords = frozenset({*cls.paper_stopwords, *STOPWORDS, *cls.gh_stopwords})
+		return cls._expanded_stopwords
 	
 	
 	def generate_from_path(self, *paths, **kwargs):
@@ -449,6 +476,7 @@ class WordcloudMaker(PDF_Feature, fig.Configurable):
 	
 	
 	def generate(self, text, **kwargs):
+		from wordcloud import WordCloud
 		return WordCloud(width=self.size[1], height=self.size[0], max_words=self.max_words,
 		                 min_font_size=self.min_font_size, background_color=self.background_color,
 		                 colormap=self.colormap, stopwords=self.stopwords, min_word_length=self.min_word_length,
@@ -456,12 +484,12 @@ class WordcloudMaker(PDF_Feature, fig.Configurable):
 	
 	
 	def extract(self, items, get_parent, manager):
-		srcs = [Path(self.fix_path(src['data']['path'])) for src in items if 'path' in src['data']]
+		srcs = [src for src in items if 'path' in src['data']]
 		assert len(srcs), 'No sources found'
 		
-		dest = self.wordcloud_root / f'{srcs[-1].stem}.jpg'
+		dest = self.wordcloud_root / f'{Path(self.fix_path(srcs[-1]["data"]["path"])).stem}.jpg'
 		
-		wc = self.generate_from_path(*srcs)
+		wc = self.generate('\n'.join(self.transcript(src) for src in srcs))
 		words = sorted(wc.words_.keys(), key=lambda w: wc.words_[w], reverse=True)
 		
 		if manager.is_real_run:
@@ -473,7 +501,7 @@ class WordcloudMaker(PDF_Feature, fig.Configurable):
 		
 		msg = f'Top 3: {"; ".join(words[:3])}...'
 		manager.add_new(linked_file, msg=msg)
-		manager.add_update(*items, msg=msg)
+		manager.add_branded(*items, msg=msg)
 		return wc
 		
 
@@ -0,0 +1,268 @@
+from typing import Callable, Dict, Iterable, List, Optional, Set, Union
+from pathlib import Path
+import time
+import sqlite3
+import hashlib
+import threading
+from tabulate import tabulate
+
+import omnifig as fig
+
+from .util import Script_Manager
+from .auth import ZoteroProcess
+from .features import PDF_Feature
+
+
+class FullTextIndex:
+	'''
+	Local full-text index (a sqlite FTS5 table at ``path``) of the transcripts of the PDF attachments, keyed by
+	the Zotero key of the attachment and the content hash of its file.
+	
+	The stages which extract the text of a PDF (e.g. the wordclouds) add it to the index, and reuse the stored
+	transcript as long as the file is unchanged, so every file is only extracted once. A file is considered
+	unchanged if its size and modification time match, or otherwise if its content hash does.
+	
+	All stages should share one index (and connection) per file, see ``open_index``.
+	'''
+	_schema = [
+		'''CREATE TABLE IF NOT EXISTS documents (
+			key TEXT PRIMARY KEY,
+			parent TEXT,
+			title TEXT,
+			path TEXT,
+			size INTEGER,
+			mtime REAL,
+			hash TEXT NOT NULL,
+			indexed REAL NOT NULL
+		)''',
+		'CREATE INDEX IF NOT EXISTS documents_parent ON documents (parent)',
+		"CREATE VIRTUAL TABLE IF NOT EXISTS transcripts USING fts5(key UNINDEXED, title, text, "
+		"tokenize='porter unicode61')",
+		'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)',
+	]
+	
+	def __init__(self, path):
+		self.path = Path(path)
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		self._lock = threading.RLock()
+		self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+		try:
+			with self._conn:
+				for statement in self._schema:
+					self._conn.execute(statement)
+		except sqlite3.OperationalError as e:
+			self._conn.close()
+			raise RuntimeError(f'The full-text index requires sqlite with FTS5 ({e})') from e
+	
+
+	@staticmethod
+	def file_hash(path: Union[str, Path]) -> str:
+		md5 = hashlib.md5()
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(2**20), b''):
+				md5.update(chunk)
+		return md5.hexdigest()
+	
+	def cached(self, key: str, path: Union[str, Path]) -> Optional[str]:
+		'''The stored transcript of the attachment (or None if the file changed or wasn't indexed yet).'''
+		stat = Path(path).stat()
+		with self._lock:
+			row = self._conn.execute('SELECT size, mtime, hash FROM documents WHERE key = ?', (key,)).fetchone()
+			if row is None:
+				return
+			size, mtime, content_hash = row
+			if size != stat.st_size or mtime != stat.st_mtime:
+				if self.file_hash(path) != content_hash:
+					return
+				with self._conn: # only touched (e.g. copied), so the next check is cheap again
+					self._conn.execute('UPDATE documents SET path = ?, size = ?, mtime = ? WHERE key = ?',
+					                   (str(path), stat.st_size, stat.st_mtime, key))
+			row = self._conn.execute('SELECT text FROM transcripts WHERE key = ?', (key,)).fetchone()
+		return None if row is None else row[0]
+	
+	def add(self, key: str, path: Union[str, Path], text: str, parent: Optional[str] = None,
+	        title: Optional[str] = None):
+		'''Adds (or replaces) the transcript of the attachment ``key`` (the file at ``path``).'''
+		stat = Path(path).stat()
+		content_hash = self.file_hash(path)
+		if title is None:
+			title = Path(path).stem
+		with self._lock, self._conn:
+			self._conn.execute('DELETE FROM transcripts WHERE key = ?', (key,))
+			self._conn.execute('INSERT INTO transcripts (key, title, text) VALUES (?, ?, ?)', (key, title, text))
+			self._conn.execute('INSERT OR REPLACE INTO documents (key, parent, title, path, size, mtime, hash, indexed) '
+			                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+			                   (key, parent, title, str(path), stat.st_size, stat.st_mtime, content_hash, time.time()))
+	
+	def transcript(self, key: str, path: Union[str, Path], extract: Callable[[Path], str],
+	               parent: Optional[str] = None, title: Optional[str] = None) -> str:
+		'''The transcript of the attachment, which is only extracted (and indexed) if the file changed.'''
+		text = self.cached(key, path)
+		if text is None:
+			text = extract(path)
+			self.add(key, path, text, parent=parent, title=title)
+		return text
+	
+	def remove(self, keys: Iterable[str]):
+		keys = [(key,) for key in keys]
+		with self._lock, self._conn:
+			self._conn.executemany('DELETE FROM transcripts WHERE key = ?', keys)
+			self._conn.executemany('DELETE FROM documents WHERE key = ?', keys)
+	
+	def keys(self) -> Set[str]:
+		with self._lock:
+			return {row[0] for row in self._conn.execute('SELECT key FROM documents')}
+	
+	def count(self) -> int:
+		with self._lock:
+			return self._conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+	
+	@property
+	def version(self) -> Optional[int]:
+		'''Library version up to which the deleted attachments were removed (None if never).'''
+		with self._lock:
+			row = self._conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+		return None if row is None else int(row[0])
+	
+	@version.setter
+	def version(self, version: int):
+		with self._lock, self._conn:
+			self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('version', ?)", (str(version),))
+	
+
+	@staticmethod
+	def _quoted(query: str) -> str:
+		return ' '.join('"{}"'.format(term.replace('"', '""')) for term in query.split())
+	
+	def search(self, query: str, limit: Optional[int] = 20, snippet_words: int = 12) -> List[Dict]:
+		'''
+		Attachments matching the ``query`` (FTS5 syntax, e.g. ``diffusion AND "score matching"`` or ``transform*``)
+		ordered by relevance (bm25), each with the key, parent, title, path, score and a snippet of the match.
+		Queries which aren't valid FTS5 syntax (e.g. with punctuation) are searched as plain terms instead.
+		'''
+		if not len(query.split()):
+			raise ValueError('Empty search query.')
+		sql = 'SELECT documents.key, documents.parent, documents.title, documents.path, bm25(transcripts), ' \
+		      f"snippet(transcripts, 2, '[', ']', '...', {int(snippet_words)}) " \
+		      'FROM transcripts JOIN documents ON documents.key = transcripts.key ' \
+		      'WHERE transcripts MATCH ? ORDER BY bm25(transcripts)'
+		if limit is not None:
+			sql += f' LIMIT {int(limit)}'
+		with self._lock:
+			try:
+				rows = self._conn.execute(sql, (query,)).fetchall()
+			except sqlite3.OperationalError:
+				rows = self._conn.execute(sql, (self._quoted(query),)).fetchall()
+		return [{'key': key, 'parent': parent, 'title': title, 'path': path, 'score': -score,
+		         'snippet': ' '.join(snippet.split())}
+		        for key, parent, title, path, score, snippet in rows]
+	
+	def close(self):
+		with _indexes_lock:
+			if _indexes.get(self.path.resolve()) is self:
+				del _indexes[self.path.resolve()]
+		with self._lock:
+			self._conn.close()
+
+
+_indexes: Dict[Path, FullTextIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def open_index(path: Union[str, Path]) -> FullTextIndex:
+	'''
+	The full-text index at ``path``, which is shared by all stages (e.g. the wordclouds and the page bodies), so
+	their (possibly concurrent) writes go through one connection instead of waiting for each other's locks.
+	'''
+	path = Path(path).resolve()
+	with _indexes_lock:
+		if path not in _indexes:
+			_indexes[path] = FullTextIndex(path)
+		return _indexes[path]
+
+
+def prepare_fulltext(A):
+	A.push('manager._type', 'zotero-manager', overwrite=False, silent=True)
+	A.push('manager.pbar_desc', 'Indexing transcripts', overwrite=False, silent=True)
+	
+	path = A.pull('fulltext-index', None)
+	if path is None:
+		raise ValueError('No full-text index specified (set "fulltext-index" to the path of the index).')
+	
+	A.push('attachment-fixer._type', 'attachment-path', overwrite=False, silent=True)
+	fixer = A.pull('attachment-fixer')
+	
+	A.push('zotero._type', 'zotero', overwrite=False, silent=True)
+	zot: ZoteroProcess = A.pull('zotero')
+	return {'zot': zot, 'index': open_index(path), 'fixer': fixer}
+
+
+def run_fulltext(manager: Script_Manager, zot: ZoteroProcess, index: FullTextIndex, fixer, keys=None):
+	'''
+	Adds the transcripts of all (linked) PDFs which aren't indexed yet (or changed since) to the index, and removes
+	the attachments which were deleted (or moved to the trash) since the last time.
+	'''
+	manager.preamble(zot=zot)
+	
+	version = zot.library_version()
+	since = 0 if index.version is None else index.version
+	gone = set(zot.deleted(since).get('items', [])).union(item['key'] for item in zot.trash(since=since))
+	gone.intersection_update(index.keys())
+	if len(gone):
+		index.remove(gone)
+		manager.log(f'Removed {len(gone)} deleted attachments from the index.')
+	index.version = version
+	
+	if zot.mirror is not None:
+		todo = zot.local().query(item_type='attachment', content_type='application/pdf', keys=keys)
+	else:
+		todo = zot.collect(itemType='attachment', keys=keys, ignore_brand=True)
+	todo = [item for item in todo if item['data'].get('contentType') == 'application/pdf'
+	        and item['data'].get('path') is not None]
+	manager.log(f'Found {len(todo)} PDFs ({index.count()} already indexed).')
+	
+	def index_item(item):
+		path = fixer.fix_path(item['data']['path'])
+		try:
+			if not path.exists():
+				raise FileNotFoundError(str(path))
+			if index.cached(item['key'], path) is None:
+				with manager.timed(item, path=str(path)):
+					index.add(item['key'], path, PDF_Feature.extract_transcript(path),
+					          parent=item['data'].get('parentItem'))
+				manager.log_success('indexed', 'Indexed transcript', item)
+		except Exception as e:
+			manager.log_error(e, item=item)
+	
+	manager.map(index_item, todo)
+	return manager.finish()
+
+
+@fig.script('index-fulltext', description='Add the transcripts of all PDFs to the local full-text index.')
+def index_fulltext(A):
+	components = prepare_fulltext(A)
+	manager: Script_Manager = A.pull('manager')
+	with manager.guard():
+		return run_fulltext(manager, keys=A.pull('keys', None), **components)
+
+
+@fig.script('search', description='Search the transcripts of the PDFs in the local full-text index.')
+def search(A):
+	silent = A.pull('silent', False, silent=True)
+	path = A.pull('fulltext-index', None)
+	if path is None:
+		raise ValueError('No full-text index specified (set "fulltext-index" to the path of the index).')
+	query = A.pull('query')
+	limit = A.pull('search-limit', 20)
+	
+	index = open_index(path)
+	start = time.time()
+	results = index.search(query, limit=limit)
+	elapsed = time.time() - start
+	index.close()
+	
+	if not silent:
+		rows = [[i + 1, result['title'], result['parent'], result['snippet']] for i, result in enumerate(results)]
+		print(tabulate(rows, headers=['#', 'Title', 'Parent', 'Match'], maxcolwidths=[None, 40, None, 80]))
+		print(f'{len(results)} results in {elapsed * 1000:.1f}ms')
+	return results
@@ -0,0 +1,85 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+from pathlib import Path
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class Ledger:
+	'''
+	Local record (in a sqlite database at ``path``) of the items each stage (identified by its brand tag)
+	already processed, which replaces the ``omnicite:*`` brand tags in Zotero as the "already processed" marker.
+	
+	For every item and stage, the item version, the status ("done" or "failed"), and a hash of the written
+	item (the output) is stored. Processed items are skipped, except failed items which changed since they
+	failed (e.g. a missing PDF was added). Items which still have the brand tag of the stage (e.g. from before
+	the ledger was used) also count as processed.
+	'''
+	_schema = '''CREATE TABLE IF NOT EXISTS ledger (
+		key TEXT NOT NULL,
+		stage TEXT NOT NULL,
+		version INTEGER,
+		status TEXT NOT NULL,
+		output TEXT,
+		updated REAL NOT NULL,
+		PRIMARY KEY (key, stage)
+	)'''
+	
+	def __init__(self, path):
+		self.path = Path(path)
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		self._lock = threading.Lock()
+		self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+		with self._conn:
+			self._conn.execute(self._schema)
+	
+	@staticmethod
+	def output_hash(data: Dict) -> str:
+		return hashlib.md5(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+	
+	def entries(self, stage: str) -> Dict[str, Tuple[Optional[int], str]]:
+		'''The version and status of all items recorded for the ``stage`` (by key).'''
+		with self._lock:
+			rows = self._conn.execute('SELECT key, version, status FROM ledger WHERE stage = ?', (stage,)).fetchall()
+		return {key: (version, status) for key, version, status in rows}
+	
+	def count(self, stage: str) -> int:
+		with self._lock:
+			return self._conn.execute('SELECT COUNT(*) FROM ledger WHERE stage = ?', (stage,)).fetchone()[0]
+	
+	def record(self, stage: str, items: Iterable[Dict], status: str = 'done'):
+		'''Records the items (full items or only their data) as processed by the ``stage``.'''
+		now = time.time()
+		rows = []
+		for item in items:
+			data = item.get('data', item)
+			key = data.get('key', item.get('key'))
+			if key is not None:
+				rows.append((key, stage, data.get('version', item.get('version')), status,
+				             self.output_hash(data), now))
+		if len(rows):
+			with self._lock, self._conn:
+				self._conn.executemany('INSERT OR REPLACE INTO ledger (key, stage, version, status, output, updated) '
+				                       'VALUES (?, ?, ?, ?, ?, ?)', rows)
+	
+	def pending(self, stage: str, items: List[Dict], brand: Optional[str] = None) -> List[Dict]:
+		'''The items which still need to be processed by the ``stage`` (in order).'''
+		entries = self.entries(stage)
+		todo = []
+		for item in items:
+			data = item.get('data', item)
+			if brand is not None and any(tag['tag'] == brand for tag in data.get('tags', [])):
+				continue
+			entry = entries.get(item['key'])
+			if entry is not None:
+				version, status = entry
+				if status != 'failed' or version is None or item.get('version', 0) <= version:
+					continue
+			todo.append(item)
+		return todo
+	
+	def close(self):
+		with self._lock:
+			self._conn.close()
@@ -0,0 +1,267 @@
+from typing import Dict, Optional
+import sys
+import json
+import time
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+def peak_rss() -> Optional[int]:
+	'''Peak resident memory of this process in bytes (if it can be determined on this platform).'''
+	try:
+		import resource
+	except ImportError:
+		try:
+			import psutil
+		except ImportError:
+			return None
+		info = psutil.Process().memory_info()
+		return getattr(info, 'peak_wset', info.rss)
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Metrics:
+	'''
+	Thread-safe collection of timings and counters for a whole run (shared by all stages and clients), which is
+	reset at the start of every run (see ``start_run``), so a long-lived process doesn't accumulate old stages.
+
+	Records the wall/CPU time and number of items of each stage, the count, latency, size and status of the
+	requests to each endpoint of each service, the number of throttled (429) responses and retries, the time
+	spent waiting for the rate limits and the last reported quota of each service, and cache hits/misses.
+	'''
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._runs = 0
+		self.reset()
+	
+	def reset(self):
+		with self._lock:
+			self._reset()
+	
+	def _reset(self):
+		self.started = time.time()
+		self.stages = {}
+		self.requests = defaultdict(lambda: {'count': 0, 'seconds': 0., 'max_seconds': 0., 'bytes': 0,
+		                                     'errors': 0, 'statuses': defaultdict(int)})
+		self.throttled = defaultdict(int)
+		self.retries = defaultdict(int)
+		self.waits = defaultdict(float)
+		self.quotas = {}
+		self.caches = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+
+	def start_stage(self, name: str) -> str:
+		'''Starts timing a new stage and returns its (unique) name.'''
+		with self._lock:
+			base, i = name, 2
+			while name in self.stages:
+				name = f'{base} ({i})'
+				i += 1
+			self.stages[name] = {'wall': time.perf_counter(), 'cpu': time.process_time(), 'items': 0,
+			                     'wall_seconds': None, 'cpu_seconds': None}
+		return name
+
+	def end_stage(self, name: str):
+		with self._lock:
+			stage = self.stages.get(name)
+			if stage is not None and stage['wall_seconds'] is None:
+				stage['wall_seconds'] = time.perf_counter() - stage['wall']
+				stage['cpu_seconds'] = time.process_time() - stage['cpu']
+
+	@contextmanager
+	def stage(self, name: str):
+		name = self.start_stage(name)
+		try:
+			yield name
+		finally:
+			self.end_stage(name)
+
+	def add_items(self, name: str, num: int = 1):
+		with self._lock:
+			if name in self.stages:
+				self.stages[name]['items'] += num
+
+
+	def record_request(self, service: str, endpoint: str, seconds: float, status: Optional[int] = None,
+	                   size: Optional[int] = None, error: bool = False):
+		with self._lock:
+			entry = self.requests[service, endpoint]
+			entry['count'] += 1
+			entry['seconds'] += seconds
+			entry['max_seconds'] = max(entry['max_seconds'], seconds)
+			if size is not None:
+				entry['bytes'] += size
+			if status is not None:
+				entry['statuses'][status] += 1 # 429s are counted by the rate limiter (see ``add_throttled``)
+			if error:
+				entry['errors'] += 1
+
+	def request_counts(self) -> Dict[str, int]:
+		'''Total number of requests sent to each service (so far).'''
+		with self._lock:
+			counts = defaultdict(int)
+			for (service, endpoint), entry in self.requests.items():
+				counts[service] += entry['count']
+			return dict(counts)
+	
+	
+	def start_run(self):
+		'''
+		Starts a run (a script, or a call of the engine), which can be nested (e.g. the stages of ``process``),
+		where only the outermost run resets the metrics.
+		'''
+		with self._lock:
+			self._runs += 1
+			if self._runs == 1:
+				self._reset()
+	
+	def end_run(self):
+		with self._lock:
+			self._runs = max(0, self._runs - 1)
+	
+	@contextmanager
+	def run(self):
+		self.start_run()
+		try:
+			yield
+		finally:
+			self.end_run()
+	
+	def add_throttled(self, service: str, num: int = 1):
+		with self._lock:
+			self.throttled[service] += num
+
+	def add_retry(self, service: str, num: int = 1):
+		with self._lock:
+			self.retries[service] += num
+
+	def add_wait(self, service: str, seconds: float):
+		with self._lock:
+			self.waits[service] += seconds
+
+	def set_quota(self, service: str, **quota: float):
+		with self._lock:
+			self.quotas.setdefault(service, {}).update(quota)
+
+	def record_cache(self, name: str, hits: int = 0, misses: int = 0):
+		with self._lock:
+			self.caches[name]['hits'] += hits
+			self.caches[name]['misses'] += misses
+
+
+	@contextmanager
+	def timed_request(self, service: str, endpoint: str):
+		'''
+		Times the request in the body, which should set ``info['response']`` (or ``status`` and ``size``)
+		to record the status code and size of the response.
+		'''
+		info = {}
+		start = time.perf_counter()
+		try:
+			yield info
+		except Exception:
+			self.record_request(service, endpoint, time.perf_counter() - start, error=True)
+			raise
+		resp = info.get('response')
+		status, size = info.get('status'), info.get('size')
+		if resp is not None:
+			status = getattr(resp, 'status_code', status)
+			content = getattr(resp, 'content', None)
+			if size is None and content is not None:
+				size = len(content)
+		self.record_request(service, endpoint, time.perf_counter() - start, status=status, size=size,
+		                    error=status is not None and status >= 400)
+
+
+	def summary(self) -> Dict:
+		with self._lock:
+			stages = {}
+			for name, stage in self.stages.items():
+				wall = stage['wall_seconds']
+				if wall is None:
+					wall = time.perf_counter() - stage['wall']
+				cpu = stage['cpu_seconds']
+				if cpu is None:
+					cpu = time.process_time() - stage['cpu']
+				stages[name] = {'wall_seconds': wall, 'cpu_seconds': cpu, 'items': stage['items'],
+				                'items_per_second': stage['items'] / wall if wall > 0 else None}
+
+			requests = {}
+			for (service, endpoint), entry in self.requests.items():
+				requests.setdefault(service, {})[endpoint] = {
+					'count': entry['count'], 'seconds': entry['seconds'], 'max_seconds': entry['max_seconds'],
+					'mean_seconds': entry['seconds'] / entry['count'] if entry['count'] else None,
+					'bytes': entry['bytes'], 'errors': entry['errors'],
+					'statuses': {str(k): v for k, v in entry['statuses'].items()}}
+
+			caches = {name: {**cache, 'hit_rate': cache['hits'] / (cache['hits'] + cache['misses'])
+			                 if cache['hits'] + cache['misses'] else None}
+			          for name, cache in self.caches.items()}
+
+			return {'started': self.started, 'stages': stages, 'requests': requests,
+			        'throttled': dict(self.throttled), 'retries': dict(self.retries),
+			        'wait_seconds': dict(self.waits), 'quotas': {k: dict(v) for k, v in self.quotas.items()},
+			        'caches': caches,
+			        'peak_rss_bytes': peak_rss()}
+
+
+	@staticmethod
+	def _labels(**labels):
+		terms = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+		                 for k, v in labels.items())
+		return f'{{{terms}}}' if len(terms) else ''
+
+	def to_prometheus(self, prefix='omnicite') -> str:
+		summary = self.summary()
+		metrics = defaultdict(list)
+		for name, stage in summary['stages'].items():
+			for key in ['wall_seconds', 'cpu_seconds', 'items', 'items_per_second']:
+				if stage[key] is not None:
+					metrics[f'stage_{key}'].append((self._labels(stage=name), stage[key]))
+		for service, endpoints in summary['requests'].items():
+			for endpoint, entry in endpoints.items():
+				labels = self._labels(service=service, endpoint=endpoint)
+				metrics['requests_total'].append((labels, entry['count']))
+				metrics['request_seconds_total'].append((labels, entry['seconds']))
+				metrics['request_max_seconds'].append((labels, entry['max_seconds']))
+				metrics['request_bytes_total'].append((labels, entry['bytes']))
+				metrics['request_errors_total'].append((labels, entry['errors']))
+		for service, num in summary['throttled'].items():
+			metrics['throttled_total'].append((self._labels(service=service), num))
+		for service, num in summary['retries'].items():
+			metrics['retries_total'].append((self._labels(service=service), num))
+		for service, seconds in summary['wait_seconds'].items():
+			metrics['rate_limit_wait_seconds_total'].append((self._labels(service=service), seconds))
+		for service, quota in summary['quotas'].items():
+			for key, value in quota.items():
+				metrics[f'quota_{key}'].append((self._labels(service=service), value))
+		for name, cache in summary['caches'].items():
+			metrics['cache_hits_total'].append((self._labels(cache=name), cache['hits']))
+			metrics['cache_misses_total'].append((self._labels(cache=name), cache['misses']))
+		if summary['peak_rss_bytes'] is not None:
+			metrics['peak_rss_bytes'].append(('', summary['peak_rss_bytes']))
+
+		lines = []
+		for name, values in metrics.items():
+			kind = 'counter' if name.endswith('_total') else 'gauge'
+			lines.append(f'# TYPE {prefix}_{name} {kind}')
+			lines.extend(f'{prefix}_{name}{labels} {value}' for labels, value in values)
+		return '\n'.join(lines) + '\n'
+
+
+	def export(self, path=None, prometheus_path=None):
+		if path is not None:
+			path = Path(path)
+			path.parent.mkdir(parents=True, exist_ok=True)
+			with path.open('w') as f:
+				json.dump(self.summary(), f, indent=2)
+		if prometheus_path is not None:
+			prometheus_path = Path(prometheus_path)
+			prometheus_path.parent.mkdir(parents=True, exist_ok=True)
+			prometheus_path.write_text(self.to_prometheus())
+
+
+metrics = Metrics()
@@ -0,0 +1,212 @@
+from typing import Dict, Iterable, List, Optional, Union
+from pathlib import Path
+import json
+import sqlite3
+import threading
+
+
+class LibraryMirror:
+	'''
+	Local copy of the Zotero library (in a sqlite database at ``path``) with indexes on the item type, tags,
+	collections, parent item, link mode, content type and title, so that the items of each stage can be selected
+	locally (with exact matches) instead of with remote (quick) searches.
+
+	The mirror is kept up to date with ``sync``, which only requests the items that changed (and the keys of the
+	deleted items) since the library version of the last sync. Items in the trash are not part of the mirror.
+	'''
+	_schema = [
+		'''CREATE TABLE IF NOT EXISTS items (
+			key TEXT PRIMARY KEY,
+			version INTEGER,
+			item_type TEXT,
+			parent TEXT,
+			link_mode TEXT,
+			content_type TEXT,
+			title TEXT,
+			date_added TEXT,
+			date_modified TEXT,
+			item TEXT NOT NULL
+		)''',
+		'CREATE TABLE IF NOT EXISTS tags (key TEXT NOT NULL, tag TEXT NOT NULL)',
+		'CREATE TABLE IF NOT EXISTS item_collections (key TEXT NOT NULL, collection TEXT NOT NULL)',
+		'''CREATE TABLE IF NOT EXISTS collections (
+			key TEXT PRIMARY KEY,
+			parent TEXT,
+			name TEXT,
+			collection TEXT NOT NULL
+		)''',
+		'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)',
+		'CREATE INDEX IF NOT EXISTS items_type ON items (item_type)',
+		'CREATE INDEX IF NOT EXISTS items_parent ON items (parent)',
+		'CREATE INDEX IF NOT EXISTS items_link ON items (link_mode, content_type)',
+		'CREATE INDEX IF NOT EXISTS items_title ON items (title COLLATE NOCASE)',
+		'CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag)',
+		'CREATE INDEX IF NOT EXISTS tags_key ON tags (key)',
+		'CREATE INDEX IF NOT EXISTS item_collections_collection ON item_collections (collection)',
+		'CREATE INDEX IF NOT EXISTS item_collections_key ON item_collections (key)',
+		'CREATE INDEX IF NOT EXISTS collections_parent ON collections (parent)',
+		'CREATE INDEX IF NOT EXISTS collections_name ON collections (name COLLATE NOCASE)',
+	]
+
+	def __init__(self, path):
+		self.path = Path(path)
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		self._lock = threading.RLock()
+		self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+		with self._conn:
+			for statement in self._schema:
+				self._conn.execute(statement)
+
+	@property
+	def version(self) -> Optional[int]:
+		'''Library version of the last sync (None if the mirror is empty).'''
+		with self._lock:
+			row = self._conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+		return None if row is None else int(row[0])
+
+
+	def sync(self, zot) -> int:
+		'''Updates the mirror with all changes since the last sync and returns the number of changed items.'''
+		with self._lock:
+			version = zot.library_version()
+			since = self.version
+			if since is not None and since >= version:
+				return 0
+
+			if since is None:
+				items, removed = list(zot.stream(limit=None)), None
+			else:
+				# items moved to the trash are only listed with includeTrashed (deleted?since only has purged items)
+				changed = list(zot.item_versions(since=since, includeTrashed=1))
+				items = zot.get_items(changed) if len(changed) else []
+				items = [item for item in items if not item['data'].get('deleted')]
+				# changed items which can't be found anymore (outside the trash) were moved to the trash
+				removed = set(changed).difference(item['key'] for item in items)
+				removed.update(zot.deleted(since).get('items', []))
+			collections = zot.all_collections()
+
+			with self._conn:
+				if removed is None:
+					for table in ['items', 'tags', 'item_collections', 'collections']:
+						self._conn.execute(f'DELETE FROM {table}')
+				else:
+					self._remove(removed)
+				self._remove(item['key'] for item in items)
+				self._insert(items)
+				self._conn.execute('DELETE FROM collections')
+				self._conn.executemany('INSERT INTO collections (key, parent, name, collection) VALUES (?, ?, ?, ?)',
+				                       [(collection['key'], collection['data'].get('parentCollection') or None,
+				                         collection['data'].get('name'), json.dumps(collection))
+				                        for collection in collections])
+				self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('version', ?)", (str(version),))
+			return len(items) + (0 if removed is None else len(removed))
+
+	def _remove(self, keys: Iterable[str]):
+		keys = [(key,) for key in keys]
+		for table in ['items', 'tags', 'item_collections']:
+			self._conn.executemany(f'DELETE FROM {table} WHERE key = ?', keys)
+
+	def _insert(self, items: List[Dict]):
+		rows, tags, collections = [], [], []
+		for item in items:
+			data = item['data']
+			if data.get('deleted'): # in the trash
+				continue
+			rows.append((item['key'], item.get('version'), data.get('itemType'), data.get('parentItem'),
+			             data.get('linkMode'), data.get('contentType'), data.get('title'), data.get('dateAdded'),
+			             data.get('dateModified'), json.dumps(item)))
+			tags.extend((item['key'], tag['tag']) for tag in data.get('tags', []))
+			collections.extend((item['key'], collection) for collection in data.get('collections', []))
+		self._conn.executemany('INSERT INTO items (key, version, item_type, parent, link_mode, content_type, title, '
+		                       'date_added, date_modified, item) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+		self._conn.executemany('INSERT INTO tags (key, tag) VALUES (?, ?)', tags)
+		self._conn.executemany('INSERT INTO item_collections (key, collection) VALUES (?, ?)', collections)
+
+
+	def find_collections(self, name: str) -> List[Dict]:
+		'''Collections with the given name (ignoring case).'''
+		with self._lock:
+			rows = self._conn.execute('SELECT collection FROM collections WHERE name = ? COLLATE NOCASE',
+			                          (name,)).fetchall()
+		return [json.loads(row[0]) for row in rows]
+
+	def subcollections(self, key: str) -> List[str]:
+		'''The keys of the collection and all of its (nested) subcollections.'''
+		with self._lock:
+			rows = self._conn.execute('WITH RECURSIVE tree(key) AS (SELECT ? UNION '
+			                          'SELECT collections.key FROM collections JOIN tree ON collections.parent = tree.key) '
+			                          'SELECT key FROM tree', (key,)).fetchall()
+		return [row[0] for row in rows]
+
+
+	@staticmethod
+	def _options(specs: Union[None, str, Iterable[str]]):
+		'''Parses Zotero style filters (each one is e.g. "a", "-a", or "a || b") into (negated, values).'''
+		if specs is None:
+			return []
+		if isinstance(specs, str):
+			specs = [specs]
+		options = []
+		for spec in specs:
+			values = [value.strip() for value in spec.split('||')]
+			negated = len(values) == 1 and values[0].startswith('-')
+			options.append((negated, [values[0][1:]] if negated else values))
+		return options
+
+	@staticmethod
+	def _marks(values):
+		return ', '.join('?' * len(values))
+
+	def query(self, top: bool = False, item_type=None, tags=None, collection: Optional[str] = None,
+	          subcollections: bool = False, parent: Optional[str] = None, link_mode: Optional[str] = None,
+	          content_type: Optional[str] = None, title: Optional[str] = None, q: Optional[str] = None,
+	          keys: Optional[Iterable[str]] = None, sort: str = 'dateModified', direction: str = 'desc',
+	          limit: Optional[int] = None) -> List[Dict]:
+		'''
+		Items matching all of the given filters, where ``item_type`` and ``tags`` use the syntax of the Zotero API
+		(e.g. "-attachment" or "a || b"), ``title`` must match exactly (ignoring case), ``q`` is a substring of the
+		title, and ``keys`` selects the items or their children.
+		'''
+		where, args = [], []
+		if top:
+			where.append('parent IS NULL')
+		for negated, values in self._options(item_type):
+			where.append(f'item_type {"NOT " if negated else ""}IN ({self._marks(values)})')
+			args.extend(values)
+		for negated, values in self._options(tags):
+			where.append(f'key {"NOT " if negated else ""}IN (SELECT key FROM tags WHERE tag IN ({self._marks(values)}))')
+			args.extend(values)
+		if collection is not None:
+			collections = self.subcollections(collection) if subcollections else [collection]
+			where.append(f'key IN (SELECT key FROM item_collections WHERE collection IN ({self._marks(collections)}))')
+			args.extend(collections)
+		for column, value in [('parent', parent), ('link_mode', link_mode), ('content_type', content_type)]:
+			if value is not None:
+				where.append(f'{column} = ?')
+				args.append(value)
+		if title is not None:
+			where.append('title = ? COLLATE NOCASE')
+			args.append(title)
+		if q is not None:
+			where.append('instr(lower(title), lower(?)) > 0')
+			args.append(q)
+
+		order = {'dateAdded': 'date_added', 'dateModified': 'date_modified', 'title': 'title'}.get(sort, 'date_modified')
+		sql = f'SELECT item FROM items{" WHERE " + " AND ".join(where) if len(where) else ""} ' \
+		      f'ORDER BY {order} {"ASC" if direction == "asc" else "DESC"}, key'
+		if limit is not None and keys is None:
+			sql += f' LIMIT {int(limit)}'
+		with self._lock:
+			rows = self._conn.execute(sql, args).fetchall()
+		items = [json.loads(row[0]) for row in rows]
+
+		if keys is not None:
+			keys = set(keys)
+			items = [item for item in items if item['key'] in keys or item['data'].get('parentItem') in keys]
+			if limit is not None:
+				items = items[:limit]
+		return items
+
+	def close(self):
+		with self._lock:
+			self._conn.close()
@@ -0,0 +1,161 @@
+from typing import Dict, List, Optional
+import math
+from collections import Counter
+from tabulate import tabulate
+
+import omnifig as fig
+
+from .transport import transport
+from .engine import OmniCite
+
+
+@fig.component('planner')
+class Planner(fig.Configurable):
+	'''
+	Estimates the work of each stage without doing any of it: the pending items are found with the same (cheap)
+	Zotero queries as a real run (so the ledger, the brand tags, and the extraction memo are respected), and the
+	CPU time and API calls are estimated per item (and per MB of the local files) using the ``costs`` of each
+	stage. The estimated calls are compared with the rate limit of each service.
+	'''
+	_default_costs = {
+		# cpu: seconds per item, cpu_per_mb: seconds per MB of the (local) files, calls: requests per item
+		'url': {'cpu': 0.001},
+		'googlescholar': {'cpu': 0.01}, # only builds the url
+		'semanticscholar': {'cpu': 0.01, 'calls': {'semanticscholar': 1}},
+		'attachments': {'cpu': 0.5, 'calls': {'zotero': 1}},
+		'github': {'cpu': 0.1, 'cpu_per_mb': 0.5},
+		'wordcloud': {'cpu': 1., 'cpu_per_mb': 2.},
+		'onedrive': {'cpu': 0.001, 'calls': {'graph': 2}},
+		'notion': {'cpu': 0.05, 'calls': {'zotero': 1, 'notion': 1}},
+	}
+	_write_batch = 50 # items per zotero write
+	_page_size = 50 # items per zotero read (listings first fetch the matching keys, then the items by key)
+
+	def __init__(self, costs=None, **kwargs):
+		super().__init__(**kwargs)
+		self.costs = {name: {**cost} for name, cost in self._default_costs.items()}
+		for name, cost in (costs or {}).items():
+			self.costs.setdefault(name, {}).update(cost)
+
+
+	@staticmethod
+	def file_size(fixer, item):
+		'''Size (in bytes) of the linked/imported file of the attachment (0 if it can't be found locally).'''
+		path = item['data'].get('path')
+		if path is None or fixer is None:
+			return 0
+		try:
+			path = fixer.fix_path(path)
+			return path.stat().st_size if path.exists() else 0
+		except (OSError, ValueError):
+			return 0
+
+
+	def pending(self, stage: OmniCite.Stage):
+		'''Returns the name of the stage's costs, the pending items, the number of skipped items, and their files.'''
+		components = stage.components
+		zot = components['zot']
+		zot.refresh()
+
+		if stage.script_name == 'item-feature':
+			extractor = components['extractor']
+			return extractor.feature_name, zot.top(**extractor.get_zotero_kwargs()), 0, []
+
+		if stage.script_name == 'process-attachments':
+			return 'attachments', zot.top(), 0, []
+
+		if stage.script_name == 'extract-attachment-feature':
+			extractor = components['extractor']
+			todo = zot.collect(q=components['source_name'], itemType=components['source_type'],
+			                   **components['source_kwargs'])
+			todo = [item for item in todo if 'parentItem' in item['data']]
+			return extractor.feature_name, todo, 0, [self.file_size(extractor, item) for item in todo]
+
+		if stage.script_name == 'onedrive-links':
+			todo = zot.collect(q=components['source_name'], itemType='attachment')
+			todo = [item for item in todo if item['data'].get('linkMode') == 'linked_file']
+			return 'onedrive', todo, 0, []
+
+		if stage.script_name == 'sync-notion':
+			publisher = components['publisher']
+			todo = zot.top(**components['zot_query'])
+			memo = getattr(publisher, 'memo', None)
+			if memo is None:
+				return 'notion', todo, 0, []
+			publisher.refresh(zot) # only reads the changes since the last sync (nothing is saved)
+			changed = [item for item in todo if not memo.is_unchanged(item)]
+			return 'notion', changed, len(todo) - len(changed), []
+
+		raise ValueError(f'Unknown stage: {stage.script_name}')
+
+
+	def plan_stage(self, stage: OmniCite.Stage) -> Dict:
+		name, todo, skipped, sizes = self.pending(stage)
+		cost = self.costs.get(name, {})
+		num = len(todo)
+		megabytes = sum(sizes) / 2**20
+
+		calls = Counter({service: math.ceil(num * per_item) for service, per_item in cost.get('calls', {}).items()})
+		calls['zotero'] += 1 + math.ceil((num + skipped) / self._page_size) # listing the pending items
+		calls['zotero'] += math.ceil(num / self._write_batch) # writing the results
+
+		return {'stage': stage.script_name, 'name': name, 'pending': num, 'skipped': skipped,
+		        'megabytes': megabytes, 'cpu_seconds': num * cost.get('cpu', 0.) + megabytes * cost.get('cpu_per_mb', 0.),
+		        'calls': dict(calls)}
+
+
+	def plan(self, engine: OmniCite, names: List[str]) -> List[Dict]:
+		return [{'script': name, **self.plan_stage(stage)} for name in names for stage in engine.stages(name)]
+
+
+	@staticmethod
+	def min_seconds(service: str, calls: int) -> Optional[float]:
+		'''The least time the calls take at the rate limit of the service (None if there is no fixed limit).'''
+		rate = transport.limiter(service).bucket.rate
+		if rate is None or not rate:
+			return
+		return calls / rate
+
+
+	@staticmethod
+	def _duration(seconds: Optional[float]):
+		if seconds is None:
+			return '--'
+		if seconds < 120:
+			return f'{seconds:.0f}s'
+		if seconds < 7200:
+			return f'{seconds / 60:.0f}min'
+		return f'{seconds / 3600:.1f}h'
+
+
+	def report(self, plan: List[Dict]) -> str:
+		rows = [[entry['script'], entry['name'], entry['pending'], entry['skipped'] or '',
+		         f'{entry["megabytes"]:.0f}' if entry['megabytes'] else '', self._duration(entry['cpu_seconds']),
+		         ', '.join(f'{service}: {num}' for service, num in sorted(entry['calls'].items()))]
+		        for entry in plan]
+		lines = [tabulate(rows, headers=['Script', 'Stage', 'Pending', 'Skipped', 'MB', 'CPU', 'API calls'])]
+
+		totals = Counter()
+		for entry in plan:
+			totals.update(entry['calls'])
+		rows = [[service, num, self._duration(self.min_seconds(service, num))]
+		        for service, num in sorted(totals.items())]
+		lines.extend(['', tabulate(rows, headers=['Service', 'Calls', 'At rate limit'])])
+		lines.extend(['', f'Estimated CPU time: {self._duration(sum(entry["cpu_seconds"] for entry in plan))}'])
+		return '\n'.join(lines)
+
+
+@fig.script('plan', description='Estimate the pending work of each stage without running anything.')
+def plan(A):
+	silent = A.pull('silent', False, silent=True)
+	names = A.pull('plan-scripts', ['process', 'share', 'publish'])
+	if isinstance(names, str):
+		names = [names]
+
+	A.push('planner._type', 'planner', overwrite=False, silent=True)
+	planner: Planner = A.pull('planner')
+
+	out = planner.plan(OmniCite(A), names)
+	if not silent:
+		print(planner.report(out))
+	return out
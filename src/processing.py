@@ -8,50 +8,62 @@ from tabulate import tabulate
 from collections import OrderedDict
 
 import re
-import fitz
 from urllib.parse import urlparse, quote
 import requests
-import pdfkit
-import PyPDF2
-from fuzzywuzzy import fuzz
 
 from .util import create_url, create_file, get_now, Script_Manager
 from .features import Attachment_Feature, Item_Feature, Attachment_Based
 from .auth import ZoteroProcess
+from .metrics import metrics
 
 
-@fig.script('item-feature', description='Extract feature from a Zotero entries')
-def item_feature(A):
+def prepare_item_feature(A):
 	A.push('manager._type', 'zotero-manager', overwrite=False, silent=True)
 	A.push('manager.pbar_desc', '--', overwrite=False, silent=True)
-	manager: Script_Manager = A.pull('manager')
 	
 	extractor: Item_Feature = A.pull('extractor', None)
-	if manager.pbar_desc == '--':
-		manager.pbar_desc = f'Extracting {extractor.feature_name}'
 	
 	A.push('brand_tag', f'feature:{extractor.feature_name}', overwrite=False, silent=True)
 	A.push('zotero._type', 'zotero', overwrite=False, silent=True)
 	zot: ZoteroProcess = A.pull('zotero')
+	return {'zot': zot, 'extractor': extractor}
+
+
+def run_item_feature(manager: Script_Manager, zot: ZoteroProcess, extractor: Item_Feature, keys=None):
+	if manager.pbar_desc == '--':
+		manager.pbar_desc = f'Extracting {extractor.feature_name}'
 	
 	manager.preamble(zot=zot)
 	
-	todo = zot.top(**extractor.get_zotero_kwargs())
-	manager.log(f'Found {len(todo)} new items to process.')
+	todo = zot.top(keys=keys, stream=True, **extractor.get_zotero_kwargs())
+	if isinstance(todo, list): # otherwise the items are processed as they arrive
+		manager.log(f'Found {len(todo)} new items to process.')
 
-	for item in manager.iterate(todo):
+	def extract_item(item):
 		@lru_cache
 		def get_children(**kwargs):
 			return zot.children(item['key'], **kwargs)
 		try:
-			extractor.extract(manager, item, get_children=get_children)
+			with manager.timed(item):
+				extractor.extract(manager, item, get_children=get_children)
 		except Exception as e:
 			manager.log_error(e, item=item)
 			# raise
-		
+		info = get_children.cache_info()
+		metrics.record_cache('children', hits=info.hits, misses=info.misses)
+	
+	manager.map(extract_item, todo)
 	return manager.finish()
 
 
+@fig.script('item-feature', description='Extract feature from a Zotero entries')
+def item_feature(A):
+	components = prepare_item_feature(A)
+	manager: Script_Manager = A.pull('manager')
+	with manager.guard():
+		return run_item_feature(manager, keys=A.pull('keys', None), **components)
+
+
 @fig.component('file-processor')
 class File_Processor(Attachment_Based):
 	def __init__(self, zotero_storage=str(Path.home() / 'Zotero/storage'),
@@ -93,6 +105,7 @@ class File_Processor(Attachment_Based):
 	
 	
 	def export_as_pdf(self, src, dest):
+		import pdfkit
 		pdfkit.from_file(str(src), str(dest))
 	
 	
@@ -138,7 +151,8 @@ class File_Processor(Attachment_Based):
 				if manager.is_real_run:
 					shutil.move(str(old), str(dest))
 				
-				manager.add_update(linked_file, item, msg=f'Renamed to {dest.name}')
+				manager.add_update(linked_file, msg=f'Renamed to {dest.name}')
+				manager.add_branded(item, msg=f'Renamed to {dest.name}')
 				
 			else:
 				manager.add_failed(item, msg=f'Unchanged: {dest.name}')
@@ -190,7 +204,7 @@ class File_Processor(Attachment_Based):
 		                          contentType='application/pdf')
 		
 		manager.add_new(linked_file, msg=msg)
-		manager.add_update(item, msg=msg)
+		manager.add_branded(item, msg=msg)
 		
 	
 	def gen_file_name(self, item):
@@ -213,11 +227,9 @@ class File_Processor(Attachment_Based):
 	
 
 
-@fig.script('process-attachments', description='Converts imported (local) PDFs and/or HTML Snapshots to linked PDFs.')
-def process_pdfs(A):
+def prepare_process_attachments(A):
 	A.push('manager._type', 'zotero-manager', overwrite=False, silent=True)
 	A.push('manager.pbar_desc', 'Processing Attachments', overwrite=False, silent=True)
-	manager: Script_Manager = A.pull('manager')
 
 	A.push('attachment-processor._type', 'file-processor', overwrite=False, silent=True)
 	processor: File_Processor = A.pull('attachment-processor')
@@ -225,34 +237,42 @@ def process_pdfs(A):
 	A.push('brand_tag', 'attachments', overwrite=False, silent=True)
 	A.push('zotero._type', 'zotero', overwrite=False, silent=True)
 	zot: ZoteroProcess = A.pull('zotero')
-	
+	return {'zot': zot, 'processor': processor}
+
+
+def run_process_attachments(manager: Script_Manager, zot: ZoteroProcess, processor: File_Processor, keys=None):
 	manager.preamble(zot=zot)
 
-	todo = zot.top()
-	manager.log(f'Found {len(todo)} new items to process.')
+	todo = zot.top(keys=keys, stream=True)
+	if isinstance(todo, list):
+		manager.log(f'Found {len(todo)} new items to process.')
 	
-	for item in manager.iterate(todo):
-		attachments = zot.children(item['data']['key'], itemType='attachment')
+	def process_item(item):
 		try:
-			processor.process(item, attachments, manager)
+			with manager.timed(item):
+				attachments = zot.children(item['data']['key'], itemType='attachment')
+				processor.process(item, attachments, manager)
 		except Exception as e:
 			manager.log_error(e, item=item)
 	
+	manager.map(process_item, todo)
 	return manager.finish()
 
 
-@fig.script('extract-attachment-feature',
-            description='Generates a word cloud and list of key words from given source (linked) PDFs.')
-def extract_attachment_feature(A):
+@fig.script('process-attachments', description='Converts imported (local) PDFs and/or HTML Snapshots to linked PDFs.')
+def process_pdfs(A):
+	components = prepare_process_attachments(A)
+	manager: Script_Manager = A.pull('manager')
+	with manager.guard():
+		return run_process_attachments(manager, keys=A.pull('keys', None), **components)
+
+
+def prepare_attachment_feature(A):
 	A.push('manager._type', 'zotero-manager', overwrite=False, silent=True)
 	A.push('manager.pbar_desc', '--', overwrite=False, silent=True)
-	manager: Script_Manager = A.pull('manager')
 	
 	extractor: Attachment_Feature = A.pull('feature-processor')
 	
-	if manager.pbar_desc == '--':
-		manager.pbar_desc = f'Extracting {extractor.feature_name}'
-	
 	source_name = A.pull('source-name', 'PDF')
 	source_type = A.pull('source-type', 'attachment')
 	source_kwargs = A.pull('source-kwargs', {})
@@ -260,10 +280,20 @@ def extract_attachment_feature(A):
 	A.push('brand_tag', f'feature:{extractor.feature_name}', overwrite=False, silent=True)
 	A.push('zotero._type', 'zotero', overwrite=False, silent=True)
 	zot: ZoteroProcess = A.pull('zotero')
+	return {'zot': zot, 'extractor': extractor, 'source_name': source_name, 'source_type': source_type,
+	        'source_kwargs': source_kwargs}
+
+
+def run_attachment_feature(manager: Script_Manager, zot: ZoteroProcess, extractor: Attachment_Feature,
+                           source_name='PDF', source_type='attachment', source_kwargs=None, keys=None):
+	if manager.pbar_desc == '--':
+		manager.pbar_desc = f'Extracting {extractor.feature_name}'
+	if source_kwargs is None:
+		source_kwargs = {}
 	
 	manager.preamble(zot=zot)
 	
-	todo = zot.collect(q=source_name, itemType=source_type, **source_kwargs)
+	todo = zot.collect(q=source_name, itemType=source_type, keys=keys, **source_kwargs)
 	atts = {}
 	bad = []
 	for item in todo:
@@ -279,14 +309,23 @@ def extract_attachment_feature(A):
 	
 	manager.log(f'Found {len(todo)} new attachments to extract {extractor.feature_name}.')
 	
-	for items in manager.iterate(atts.values()):
+	def extract_items(items):
+		paths = ', '.join(item['data']['path'] for item in items if 'path' in item['data'])
 		try:
-			extractor.extract(items, lambda: zot.item(item['data']['parentItem']), manager)
+			with manager.timed({'key': items[-1]['data']['parentItem']}, path=paths):
+				extractor.extract(items, lambda: zot.item(items[-1]['data']['parentItem']), manager)
 		except Exception as e:
 			for item in items:
 				manager.log_error(e, item=item)
-		
+	
+	manager.map(extract_items, atts.values(), total=len(atts))
 	return manager.finish()
 
 
-
+@fig.script('extract-attachment-feature',
+            description='Generates a word cloud and list of key words from given source (linked) PDFs.')
+def extract_attachment_feature(A):
+	components = prepare_attachment_feature(A)
+	manager: Script_Manager = A.pull('manager')
+	with manager.guard():
+		return run_attachment_feature(manager, keys=A.pull('keys', None), **components)
@@ -0,0 +1,95 @@
+from typing import Optional, List, Tuple
+import io
+import re
+import time
+import heapq
+import cProfile
+import pstats
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from tabulate import tabulate
+
+
+class Profiler:
+	'''
+	Profiles a single stage (sub-script) with cProfile and times each item it processes.
+
+	When exported, the stage profile is saved as ``<name>.prof`` (loadable with ``pstats`` or snakeviz) and
+	``<name>.txt`` (top functions by cumulative time), and the ``slowest`` items are listed in
+	``<name>-slowest.txt`` with their Zotero key, attachment path and duration.
+
+	Note that cProfile only profiles the thread that started it (so for parallel managers only the per-item
+	timings include the work done by the workers).
+	'''
+	def __init__(self, name: str, root='profiles', slowest=20, top_functions=40):
+		self.name = name
+		self.root = Path(root)
+		self.slowest = slowest
+		self.top_functions = top_functions
+		self._profile = None
+		self._items = []  # min-heap of (duration, index, key, path)
+		self._count = 0
+		self._lock = threading.Lock()
+
+	@property
+	def file_stem(self):
+		return re.sub(r'[^\w\-_()+]+', '_', self.name).strip('_') or 'stage'
+
+	def start(self):
+		self._profile = cProfile.Profile()
+		self._profile.enable()
+		return self
+
+	def stop(self):
+		if self._profile is not None:
+			self._profile.disable()
+
+
+	@contextmanager
+	def item(self, key: str, path: Optional[str] = None):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add_item(time.perf_counter() - start, key, path)
+
+	def add_item(self, duration: float, key: str, path: Optional[str] = None):
+		with self._lock:
+			self._count += 1
+			entry = (duration, self._count, key, path)
+			if len(self._items) < self.slowest:
+				heapq.heappush(self._items, entry)
+			elif duration > self._items[0][0]:
+				heapq.heapreplace(self._items, entry)
+
+	def slowest_items(self) -> List[Tuple[float, str, Optional[str]]]:
+		with self._lock:
+			return [(duration, key, path) for duration, _, key, path in sorted(self._items, reverse=True)]
+
+	def format_slowest(self):
+		rows = [[f'{duration:.2f}', key, '--' if path is None else path]
+		        for duration, key, path in self.slowest_items()]
+		return f'{self.name}: slowest {len(rows)} of {self._count} items\n' \
+		       + tabulate(rows, headers=['Seconds', 'Key', 'Attachment'])
+
+
+	def export(self):
+		self.stop()
+		self.root.mkdir(parents=True, exist_ok=True)
+		paths = []
+		if self._profile is not None:
+			path = self.root / f'{self.file_stem}.prof'
+			self._profile.dump_stats(str(path))
+			paths.append(path)
+
+			stream = io.StringIO()
+			pstats.Stats(self._profile, stream=stream).sort_stats('cumulative').print_stats(self.top_functions)
+			path = self.root / f'{self.file_stem}.txt'
+			path.write_text(stream.getvalue())
+			paths.append(path)
+
+		path = self.root / f'{self.file_stem}-slowest.txt'
+		path.write_text(self.format_slowest() + '\n')
+		paths.append(path)
+		return paths
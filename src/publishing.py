@@ -1,5 +1,8 @@
 from pathlib import Path
+import os
 import json
+import html
+import threading
 from typing import Union, List, Dict, Callable, Tuple, Optional
 from functools import lru_cache
 import re
@@ -17,8 +20,10 @@ import requests
 from dateutil import parser
 
 from .util import Script_Manager, create_url, get_now
+from .metrics import metrics
+from .transport import transport
 from .auth import ZoteroProcess
-from .features import Attachment_Based
+from .features import Attachment_Based, PDF_Feature
 
 
 class Extractor(fig.Configurable):
@@ -30,6 +35,10 @@ class Extractor(fig.Configurable):
 	
 	def __call__(self, item, get_children=None):
 		raise NotImplementedError
+	
+	def memo_state(self):
+		'''Any state (other than the item and its children) that the output depends on, see ``ExtractionMemo``.'''
+		return None
 		
 
 class SimpleExtractor(Extractor):
@@ -97,8 +106,13 @@ class Tags(Extractor):
 		assert self.include_auto_tags or self.include_real_tags, 'At least one of include-auto-tags ' \
 		                                                         'or include-real-tags must be True'
 	
+	@staticmethod
+	def option_name(tag: str) -> str:
+		'''The name of the (multi-)select option of the tag (notion doesn't allow commas in options).'''
+		return tag.replace(',', '')
+	
 	def __call__(self, item, get_children=None):
-		return [tag['tag'].replace(',', '') for tag in item['data']['tags']
+		return [self.option_name(tag['tag']) for tag in item['data']['tags']
 		        if ((self.include_real_tags and tag.get('type', 0) == 0)
 		        or (self.include_auto_tags and tag.get('type', 0) == 1))]
 
@@ -127,6 +141,9 @@ class Collections(Extractor):
 	def __call__(self, item, get_children=None):
 		return [self.collections[c]['data'][self._item_key]
 		        for c in item['data']['collections'] if c in self.collections]
+	
+	def memo_state(self):
+		return {key: c['data'][self._item_key] for key, c in self.collections.items()}
 
 
 @fig.component('extractor/arxiv')
@@ -189,6 +206,36 @@ class PDF_Path(PDF):
 		return str(path) if self.full_path else path.stem
 
 
+@fig.component('extractor/pdf/text')
+class PDF_Text(PDF):
+	'''
+	The beginning (at most ``max_chars`` characters) of the full text of the PDF (e.g. for the page body), which is
+	taken from the full-text index (if there is one) unless the file changed.
+	'''
+	def __init__(self, max_chars=5000, fulltext_index=None, **kwargs):
+		super().__init__(**kwargs)
+		self.max_chars = max_chars
+		if fulltext_index is not None:
+			from .fulltext import open_index
+			fulltext_index = open_index(fulltext_index)
+		self.fulltext_index = fulltext_index
+	
+	def __call__(self, item, get_children=None):
+		pdf = super().__call__(item, get_children)
+		if pdf is None:
+			return
+		path = self.fix_path(pdf['data']['path'])
+		if not path.exists():
+			return
+		if self.fulltext_index is None:
+			text = PDF_Feature.extract_transcript(path)
+		else:
+			text = self.fulltext_index.transcript(pdf['key'], path, PDF_Feature.extract_transcript,
+			                                      parent=pdf['data'].get('parentItem'))
+		text = ' '.join(text.split())
+		return text if self.max_chars is None else text[:self.max_chars]
+
+
 @fig.component('extractor/pdf/link')
 class PDF_Link(PDF):
 	def __init__(self, *, skip_if_missing=False, **kwargs):
@@ -400,6 +447,157 @@ class ToSelect(ExtrationPackager):
 			return {self.select_type: {'name': data}}
 
 
+class ToBlocks(ExtrationPackager):
+	'''Packages the extracted data as a list of blocks for the page body (see ``NotionPublisher``).'''
+	_max_text_length = 2000 # of a single rich text object
+	
+	def _text_obj(self, text, url=None):
+		obj = {'type': 'text', 'text': {'content': text}}
+		if url is not None:
+			obj['text']['link'] = {'url': url}
+		return obj
+	
+	def _block(self, block_type, rich_text):
+		return {'object': 'block', 'type': block_type, block_type: {'rich_text': rich_text}}
+	
+	def _chunks(self, text):
+		chunks = []
+		while len(text) > self._max_text_length:
+			cut = text.rfind(' ', 0, self._max_text_length)
+			if cut <= 0:
+				cut = self._max_text_length
+			chunks.append(text[:cut])
+			text = text[cut:].lstrip()
+		if len(text):
+			chunks.append(text)
+		return chunks
+
+
+@fig.modifier('to-paragraphs')
+class ToParagraphs(ToBlocks):
+	def __init__(self, separator=', ', **kwargs):
+		super().__init__(**kwargs)
+		self.separator = separator
+	
+	def package(self, data):
+		if isinstance(data, (list, tuple)):
+			data = self.separator.join(term.strip() for term in map(str, data) if len(term.strip()))
+		blocks = [self._block('paragraph', [self._text_obj(chunk)])
+		          for paragraph in str(data).split('\n\n') for chunk in self._chunks(paragraph.strip())]
+		if len(blocks):
+			return blocks
+
+
+@fig.modifier('to-bullets')
+class ToBullets(ToBlocks):
+	def __init__(self, links=True, **kwargs):
+		super().__init__(**kwargs)
+		self.links = links
+	
+	def package(self, data):
+		if isinstance(data, str):
+			data = [data]
+		blocks = []
+		for entry in map(str, data):
+			entry = entry.strip()
+			url = entry if self.links and re.match(r'https?://\S+$', entry) else None
+			blocks.extend(self._block('bulleted_list_item', [self._text_obj(chunk, url)])
+			              for chunk in self._chunks(entry))
+		if len(blocks):
+			return blocks
+
+
+class ExtractionMemo:
+	'''
+	Remembers the fingerprint of every item that was published (stored as json in ``path``), so that items
+	which haven't changed since the last sync can be skipped without extracting anything.
+
+	An item counts as changed if it or any of its children changed (or were deleted) since the version that was
+	remembered, which is found with a single ``items?since=`` (and ``deleted?since=``) request. The versions of the
+	sync's own writes (e.g. the notion attachment and tag) are remembered as well (see ``record_writes``), so they
+	don't count as changes. All entries are discarded if the ``config`` (of the extractors) changed.
+	'''
+	def __init__(self, path, config=None):
+		self.path = Path(path)
+		self.config = config
+		self.version = None
+		self.items = {}
+		self.changed = None
+		self._start_version = None
+		self._lock = threading.Lock()
+		if self.path.exists():
+			try:
+				data = json.loads(self.path.read_text(encoding='utf-8'))
+			except ValueError:
+				data = {}
+			if data.get('config') == self.config:
+				self.version = data.get('version')
+				self.items = data.get('items', {})
+				for entry in self.items.values(): # without the versions of the children (which count as changed)
+					if isinstance(entry['children'], list):
+						entry['children'] = dict.fromkeys(entry['children'])
+	
+	def refresh(self, zot):
+		'''Finds all items that changed since the last sync.'''
+		self._start_version = zot.library_version()
+		if self.version is None:
+			self.changed = None
+			return
+		
+		changed = zot.item_versions(since=self.version)
+		deleted = set(zot.deleted(since=self.version).get('items', []))
+		parents = {child: key for key, entry in self.items.items() for child in entry['children']}
+		
+		dirty = {key for key in deleted if key in self.items}
+		dirty.update(parents[key] for key in deleted if key in parents)
+		unknown = []
+		for key, version in changed.items():
+			if key in self.items:
+				if self.items[key]['version'] != version:
+					dirty.add(key)
+			elif key in parents:
+				if self.items[parents[key]]['children'][key] != version:
+					dirty.add(parents[key])
+			else:
+				unknown.append(key)
+		if len(unknown): # e.g. new children
+			dirty.update(item['data']['parentItem'] for item in zot.get_items(unknown)
+			             if 'parentItem' in item['data'])
+		# changed items are only remembered again once they are synced (so they are not skipped in later syncs)
+		for key in dirty:
+			self.items.pop(key, None)
+		self.changed = dirty
+	
+	def is_unchanged(self, item):
+		return self.changed is not None and item['key'] in self.items and item['key'] not in self.changed
+	
+	def record(self, item, children, fingerprint):
+		with self._lock:
+			self.items[item['key']] = {'version': item.get('version'), 'fingerprint': fingerprint,
+			                           'children': {child['key']: child.get('version') for child in children}}
+	
+	def record_writes(self, written: Dict[str, Tuple[Optional[int], Optional[str]]]):
+		'''Updates the remembered versions with the ``written`` ones (``ZoteroProcess.written``), incl. new children.'''
+		newer = lambda version, old: version is not None and (old is None or version > old)
+		with self._lock:
+			for key, (version, parent) in written.items():
+				entry = self.items.get(key)
+				if entry is not None and newer(version, entry['version']):
+					entry['version'] = version
+				entry = self.items.get(parent)
+				if entry is not None and newer(version, entry['children'].get(key)):
+					entry['children'][key] = version
+	
+	def save(self):
+		with self._lock:
+			data = {'config': self.config, 'version': self._start_version, 'items': self.items}
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		tmp = self.path.with_name(f'{self.path.name}.tmp')
+		tmp.write_text(json.dumps(data), encoding='utf-8')
+		os.replace(str(tmp), str(self.path))
+		self.version = self._start_version
+
+
 class Publisher(fig.Configurable):
 	@property
 	def ident(self):
@@ -408,6 +606,14 @@ class Publisher(fig.Configurable):
 	def prepare(self, zot):
 		raise NotImplementedError
 	
+	def refresh(self, zot):
+		'''Called at the beginning of each sync.'''
+		pass
+	
+	def commit(self, zot=None):
+		'''Called at the end of each (real) sync, after the changes were written to zotero (with ``zot``).'''
+		pass
+	
 	def process(self, item, get_children=None, manager=None):
 		raise NotImplementedError
 	
@@ -422,11 +628,16 @@ class NotionPublisher(Publisher):
 	             extractors=None, cover_extractor=None, icon_extractor=None,
 	             ignore_failed_extractors=False, filter_extractors=False,
 	             notion_link_attachment='Notion',
-	             notion_version='2022-06-28',
+	             notion_version='2022-06-28', notion_root='https://api.notion.com/v1', rate_limits=None,
+	             http_cache=None, notion_schema_max_age=3600, extraction_memo=None, page_body=None,
 	             **kwargs):
 		super().__init__(**kwargs)
+		transport.configure(rate_limits, http_cache=http_cache)
+		self.notion_schema_max_age = notion_schema_max_age
 		self.notion_link_attachment = notion_link_attachment
+		self._attachment_name = notion_link_attachment
 		self.notion_database_id = notion_database_id
+		self.notion_root = notion_root.rstrip('/')
 		self.notion_parent = {'database_id': self.notion_database_id, 'type': 'database_id'}
 		self._notion_header = {
 			# 'Content-Type': 'application/json',
@@ -434,6 +645,7 @@ class NotionPublisher(Publisher):
 			'Notion-Version': notion_version,
 			'Authorization': f'Bearer {notion_secret}',
 		}
+		self._account = transport.account_key(notion_secret) # each integration has its own rate limit
 		
 		self.timestamp = get_now()
 		
@@ -447,17 +659,22 @@ class NotionPublisher(Publisher):
 		self.icon_extractor = icon_extractor
 		self.ignore_failed_extractors = ignore_failed_extractors
 		self._filter_extractors = filter_extractors
+		self.page_body: Optional[Dict[str,Extractor]] = page_body
 		
 		self.publish_todo = []
+		self.extraction_memo = extraction_memo
+		self.memo = None
 
 	_on_notion_brand = 'synced-with-notion'
+	_tag_lock = threading.Lock()
 	
 	def prepare(self, zot):
 		
 		if self._filter_extractors:
-			database_url = f"https://api.notion.com/v1/databases/{self.notion_database_id}"
+			database_url = f"{self.notion_root}/databases/{self.notion_database_id}"
 			
-			db_info = self.send_request('GET', database_url)
+			# notion doesn't support conditional requests, so the schema is reused for a while instead
+			db_info = self.send_request('GET', database_url, cache=True, max_age=self.notion_schema_max_age)
 			
 			props = db_info.get('properties')
 			
@@ -470,15 +687,49 @@ class NotionPublisher(Publisher):
 					del self.extractors[key]
 				if len(bad):
 					print(f'Removed {len(bad)} extractors {", ".join(bad)} because they were not in the database')
+		
+		self.prepare_memo()
+	
+	
+	def prepare_memo(self):
+		if self.extraction_memo is not None:
+			self.memo = ExtractionMemo(self.extraction_memo, config=self.extraction_config())
+	
+	
+	def extraction_config(self):
+		'''Fingerprint of everything (besides the items) that the extracted data depends on.'''
+		extractors = {**self.extractors, '!cover': self.cover_extractor, '!icon': self.icon_extractor,
+		              **{f'!body/{name}': extractor for name, extractor in (self.page_body or {}).items()}}
+		config = {}
+		for name, extractor in extractors.items():
+			if extractor is not None:
+				my_config = getattr(extractor, '_my_config', None)
+				config[name] = [type(extractor).__name__, None if my_config is None else my_config.to_yaml(),
+				                extractor.memo_state()]
+		return md5(json.dumps(config, sort_keys=True))
+	
+	
+	def refresh(self, zot):
+		if self.memo is not None:
+			self.memo.refresh(zot)
+	
+	
+	def commit(self, zot=None):
+		if self.memo is not None:
+			if zot is not None:
+				self.memo.record_writes(zot.written)
+			self.memo.save()
 
 	
-	def send_request(self, method, url, data=None, headers=None):
+	def send_request(self, method, url, data=None, headers=None, **kwargs):
 		if headers is None:
 			headers = self._notion_header
 		else:
 			headers = {**headers, **self._notion_header}
 		
-		resp = requests.request(method.upper(), url, json=data, headers=headers)
+		endpoint = f'{method.upper()} {url[len(self.notion_root):].strip("/").split("/")[0]}'
+		resp = transport.request('notion', method, url, endpoint=endpoint, json=data, headers=headers,
+		                         account=self._account, **kwargs)
 		return resp.json()
 	
 	
@@ -495,8 +746,101 @@ class NotionPublisher(Publisher):
 		
 		if pageID is None:
 			payload['parent'] = self.notion_parent
-			return self.send_request('POST', 'https://api.notion.com/v1/pages', data=payload)
-		return self.send_request('PATCH', f'https://api.notion.com/v1/pages/{pageID}', data=payload)
+			return self.send_request('POST', f'{self.notion_root}/pages', data=payload)
+		return self.send_request('PATCH', f'{self.notion_root}/pages/{pageID}', data=payload)
+	
+	
+	_max_children = 100 # blocks per append (and children per block)
+	_max_request_blocks = 1000
+	_body_anchor = '!anchor'
+	
+	def section_block(self, name, blocks):
+		'''A toggle heading containing the blocks of a section, so that a section is replaced as a single block.'''
+		return {'object': 'block', 'type': 'heading_2', 'heading_2': {
+			'rich_text': [{'type': 'text', 'text': {'content': name}}], 'is_toggleable': True, 'children': blocks}}
+	
+	def _block_batches(self, blocks):
+		batch, size = [], 0
+		for block in blocks:
+			num = 1 + len(block[block['type']].get('children', []))
+			if len(batch) and (len(batch) >= self._max_children or size + num > self._max_request_blocks):
+				yield batch
+				batch, size = [], 0
+			batch.append(block)
+			size += num
+		if len(batch):
+			yield batch
+	
+	def append_blocks(self, parentID, blocks, after=None):
+		'''
+		Appends the blocks to the parent (after the block ``after``, by default at the end) in as few requests as
+		possible. Returns the IDs of the new blocks and the response of the failed request (if any).
+		'''
+		ids = []
+		for batch in self._block_batches(blocks):
+			payload = {'children': batch}
+			if after is not None:
+				payload['after'] = after
+			resp = self.send_request('PATCH', f'{self.notion_root}/blocks/{parentID}/children', data=payload)
+			if resp.get('status', 200) != 200:
+				return ids, resp
+			new = [block['id'] for block in resp.get('results', [])[:len(batch)]]
+			ids.extend(new)
+			if after is not None:
+				after = new[-1]
+		return ids, None
+	
+	def body_fingerprints(self, body):
+		return {name: md5(json.dumps(blocks, sort_keys=True))[:12]
+		        for name, blocks in body.items() if blocks is not None}
+	
+	def publish_body(self, pageID, body, state=None):
+		'''
+		Updates the page body, where each section (in ``body``) is a toggle heading. Only the sections whose
+		fingerprint changed since they were published (see ``state``) are replaced, and consecutive new sections
+		are appended together (sections that failed to be extracted, i.e. ``None``, are left as they are).
+		
+		Returns the new state (fingerprint and block of each section) and the response of the failed request
+		(if any).
+		'''
+		state = dict(state or {})
+		fingerprints = self.body_fingerprints(body)
+		
+		for name in [name for name in state if name != self._body_anchor]:
+			if (name not in body or body[name] is not None) and fingerprints.get(name) != state[name][0]:
+				resp = self.send_request('DELETE', f'{self.notion_root}/blocks/{state[name][1]}')
+				if resp.get('status', 200) not in {200, 404}: # 404 - already removed manually
+					return state, resp
+				del state[name]
+		
+		runs, run = [], None
+		prev = state.get(self._body_anchor)
+		for name, blocks in body.items():
+			if name in state:
+				prev, run = state[name][1], None
+			elif blocks:
+				if run is None:
+					run = (prev, [])
+					runs.append(run)
+				run[1].append(name)
+		
+		for after, names in runs:
+			blocks = [self.section_block(name, body[name][:self._max_children]) for name in names]
+			if after is None: # the sections of a new page start after a divider (which all new sections follow)
+				blocks.insert(0, {'object': 'block', 'type': 'divider', 'divider': {}})
+			ids, resp = self.append_blocks(pageID, blocks, after=after)
+			if after is None and len(ids):
+				state[self._body_anchor] = ids.pop(0)
+			for name, blockID in zip(names, ids):
+				state[name] = [None, blockID] # until all the blocks of the section are added
+			if resp is not None:
+				return state, resp
+			for name, blockID in zip(names, ids):
+				_, resp = self.append_blocks(blockID, body[name][self._max_children:])
+				if resp is not None:
+					return state, resp
+				state[name][0] = fingerprints[name]
+		return state, None
 
 
 	def select_notion_attachment(self, children):
@@ -516,32 +860,72 @@ class NotionPublisher(Publisher):
 
 	_attachment_name = 'Notion'
 	_attachment_note_title = 'Notion Page Info'
-	def create_notion_attachment(self, item, fingerprint, notion_response=None, **kwargs):
+	def create_notion_attachment(self, item, fingerprint, notion_response=None, property_fingerprints=None,
+	                             body_state=None, **kwargs):
 		url = '' if notion_response is None else notion_response.get('url', '')
 		link = create_url(self._attachment_name, url=url, accessDate=self.timestamp,
-		                  note=self.notion_attachment_note(fingerprint),
+		                  note=self.notion_attachment_note(fingerprint, property_fingerprints, body_state),
 		                  parentItem=item['key'], **kwargs)
 		return link
 	
 	
-	def notion_attachment_note(self, fingerprint):
+	def notion_attachment_note(self, fingerprint, property_fingerprints=None, body_state=None):
 		timestamp = parser.parse(self.timestamp)
 		timestamp = timestamp.strftime('%d %b %Y, %H:%M') # '%Y-%m-%d %H:%M:%S'
 		
 		lines = [self._attachment_note_title,
 		         f'Last Synced: {timestamp}',
 		         f'Fingerprint (do not change): {fingerprint}']
+		if property_fingerprints is not None:
+			lines.append(f'Property Fingerprints (do not change): '
+			             f'{html.escape(json.dumps(property_fingerprints, sort_keys=True), quote=False)}')
+		if body_state:
+			lines.append(f'Page Body (do not change): '
+			             f'{html.escape(json.dumps(body_state, sort_keys=True), quote=False)}')
 		return '\n'.join(f'<p>{line}</p>' for line in lines)
 	
 	
+	@staticmethod
+	def parse_attachment_note(note):
+		'''
+		Returns the fingerprint, the property fingerprints and the state of the page body (if any) stored in the
+		note of the attachment.
+		'''
+		fingerprint = re.search(r'Fingerprint \(do not change\): ([0-9a-f]+)', note)
+		fingerprint = None if fingerprint is None else fingerprint.group(1)
+		
+		def parse_json(label):
+			match = re.search(label + r' \(do not change\): (\{.*?\})(?:</p>|$)', note, re.MULTILINE)
+			if match is not None:
+				try:
+					return json.loads(html.unescape(match.group(1)))
+				except ValueError:
+					pass
+		
+		return fingerprint, parse_json('Property Fingerprints'), parse_json('Page Body')
+	
+	
 	class PublishTodo:
-		def __init__(self, item, data=None, attachment=None):
+		def __init__(self, item, data=None, attachment=None, children=None):
 			self.item = item
 			self.attachment = attachment
 			self.data = data
+			self.children = children
+			self.done = False
 
 
+	def process_data(self, item, data, get_children):
+		'''Adds already extracted ``data`` of the item to be published.'''
+		todo = self.PublishTodo(item, data, self.find_notion_attachment(item, get_children))
+		self.publish_todo.append(todo)
+		return todo
+	
+	
 	def process(self, item, get_children=None, manager=None):
+		if self.memo is not None and self.memo.is_unchanged(item):
+			manager.log_success('skipped', 'Unchanged since the last sync', item)
+			return
+		
 		# extract data
 		try:
 			data, errors = self.extract(item, get_children)
@@ -554,7 +938,8 @@ class NotionPublisher(Publisher):
 			# find notion page
 			notion_attachment = self.find_notion_attachment(item, get_children)
 			
-			todo = self.PublishTodo(item, data, notion_attachment)
+			todo = self.PublishTodo(item, data, notion_attachment,
+			                        children=None if self.memo is None else get_children())
 			
 			self.publish_todo.append(todo)
 			return todo
@@ -563,6 +948,30 @@ class NotionPublisher(Publisher):
 	def fingerprint(self, props):
 		obj = json.dumps(props, sort_keys=True, indent=4)
 		return md5(obj)
+	
+	_icon_key = '!icon'
+	_cover_key = '!cover'
+	
+	def property_fingerprints(self, data):
+		'''Short fingerprint of each property (and the icon and cover) to find which ones changed.'''
+		fingerprints = {name: md5(json.dumps(value, sort_keys=True))[:12]
+		                for name, value in data['properties'].items()}
+		for key, name in [('icon', self._icon_key), ('cover', self._cover_key)]:
+			if key in data:
+				fingerprints[name] = md5(json.dumps(data[key], sort_keys=True))[:12]
+		return fingerprints
+	
+	def changed_data(self, data, fingerprints, prev_fingerprints):
+		'''
+		Only the properties (and icon or cover) of ``data`` which changed since they were last published
+		(properties that are no longer extracted are left as they are, just like with a full update).
+		'''
+		changed = {name for name, fingerprint in fingerprints.items() if prev_fingerprints.get(name) != fingerprint}
+		out = {'properties': {name: value for name, value in data['properties'].items() if name in changed}}
+		for key, name in [('icon', self._icon_key), ('cover', self._cover_key)]:
+			if key in data and name in changed:
+				out[key] = data[key]
+		return out
 
 
 	def extract(self, item, get_children):
@@ -580,6 +989,21 @@ class NotionPublisher(Publisher):
 		
 		data = {'properties': props}
 		
+		if self.page_body is not None:
+			body = {}
+			for name, extractor in self.page_body.items():
+				try:
+					blocks = extractor(item, get_children)
+				except Extractor.ExtractionError as e:
+					errors[f'[page body] {name}'] = e
+					if not self.ignore_failed_extractors:
+						raise e
+					body[name] = None # leave the published section as it is
+				else:
+					if blocks:
+						body[name] = blocks
+			data['body'] = body
+		
 		if self.icon_extractor is not None:
 			try:
 				icon = self.icon_extractor(item, get_children)
@@ -606,23 +1030,33 @@ class NotionPublisher(Publisher):
 	def complete_todo(self, todo, manager):
 		attachment = todo.attachment
 		fingerprint = self.fingerprint(todo.data)
+		prop_fingerprints = self.property_fingerprints(todo.data)
 		
 		pageID = None
+		payload = todo.data
+		prev_body = None
 		if attachment is not None:
 			pageID = attachment['data']['url'].split('-')[-1]
 			note = attachment['data'].get('note')
 			if note is not None:
-				prev_fingerprint = re.search(r'Fingerprint \(do not change\): (.*)', note)
-			
-				if prev_fingerprint is not None and prev_fingerprint.group(1) == fingerprint:
+				prev_fingerprint, prev_props, prev_body = self.parse_attachment_note(note)
+				
+				if prev_fingerprint == fingerprint:
 					manager.add_failed(todo.item, msg='Fingerprints match - no update necessary')
+					todo.done = True
+					if self.memo is not None and manager.is_real_run:
+						self.memo.record(todo.item, todo.children, fingerprint)
 					return
-				
-			attachment['data']['note'] = self.notion_attachment_note(fingerprint)
-			manager.add_update(attachment, msg='Updated Notion attachment')
+				if prev_props is not None: # only send what changed
+					payload = self.changed_data(todo.data, prop_fingerprints, prev_props)
+		body = todo.data.get('body')
+		payload = {key: value for key, value in payload.items() if key != 'body'}
 		
 		if manager.is_real_run:
-			resp = self.publish_page(pageID, **todo.data)
+			if pageID is not None and not any(payload.get(key) for key in ['properties', 'icon', 'cover']):
+				resp = {} # only the page body changed
+			else:
+				resp = self.publish_page(pageID, **payload)
 		else:
 			resp = None
 			verb = 'update' if pageID is not None else 'create'
@@ -630,34 +1064,164 @@ class NotionPublisher(Publisher):
 		
 		if resp is not None and resp.get('status', 200) != 200:
 			manager.log_error(f'{resp.get("status")}: {resp.get("code")}', resp.get('message'), item=todo.item)
+			return resp
+		
+		body_state, error = prev_body, None
+		if body is not None and manager.is_real_run:
+			body_state, error = self.publish_body(resp.get('id') if pageID is None else pageID, body, prev_body)
+			if error is not None:
+				manager.log_error(f'{error.get("status")}: {error.get("code")}', error.get('message'), item=todo.item)
+				fingerprint = None # so the page is updated again next time
+		
+		if attachment is None:
+			attachment = self.create_notion_attachment(todo.item, fingerprint, resp,
+			                                           property_fingerprints=prop_fingerprints,
+			                                           body_state=body_state)
+			manager.add_new(attachment, msg='Created Notion attachment')
 		else:
-			if attachment is None:
-				attachment = self.create_notion_attachment(todo.item, fingerprint, resp)
-				manager.add_new(attachment, msg='Created Notion attachment')
-			
+			attachment['data']['note'] = self.notion_attachment_note(fingerprint, prop_fingerprints, body_state)
+			manager.add_update(attachment, msg='Updated Notion attachment')
+		
+		with self._tag_lock: # the same item may be published to multiple databases at once
 			if not any(tag['tag'] == self._on_notion_brand for tag in todo.item['data']['tags']):
 				todo.item['data']['tags'].append({'tag': self._on_notion_brand, 'type': 1})
 				manager.add_update(todo.item, msg=f'Added {self._on_notion_brand} tag')
 		
+		if error is None:
+			todo.done = True
+			if self.memo is not None and manager.is_real_run:
+				self.memo.record(todo.item, todo.children, fingerprint)
+			
 			verb = 'Updated' if pageID is not None else 'Created'
 			if manager.is_real_run:
 				manager.log(f'{verb} notion page for {todo.item["data"].get("title")}')
 		return resp
 		
 		
-	def publish(self, manager: Script_Manager):
-		for todo in self.publish_todo:
+	def publish(self, manager: Script_Manager, checkpoints=True):
+		for i, todo in enumerate(self.publish_todo):
+			if manager.out_of_budget(len(self.publish_todo) - i):
+				break
 			self.complete_todo(todo, manager)
-		if manager.is_real_run:
-			self.publish_todo.clear()
+			if checkpoints: # only if the manager isn't shared with other (concurrent) targets
+				manager.checkpoint()
+		self.publish_todo.clear()
 
 
 
-@fig.script('sync-notion', description='Sync Zotero items with a Notion database.')
-def sync_notion(A):
+class NotionTarget(NotionPublisher):
+	'''
+	One of the databases of a ``MultiNotionPublisher``, which only publishes the given subset of ``properties``
+	(by default all) of the items that pass the ``filter``. The filter can contain ``tags`` (any of which must
+	be present), ``exclude_tags``, ``item_types`` and ``collections`` (keys).
+	'''
+	def __init__(self, name, notion_database_id, properties=None, filter=None, cover=True, icon=True, body=True,
+	             **kwargs):
+		super().__init__(notion_database_id, **kwargs)
+		self.name = name
+		self.properties = properties
+		self.filter = filter or {}
+		self.cover = cover
+		self.icon = icon
+		self.body = body
+	
+	def matches(self, item):
+		data = item['data']
+		tags = {tag['tag'] for tag in data.get('tags', [])}
+		if 'item_types' in self.filter and data.get('itemType') not in self.filter['item_types']:
+			return False
+		if 'tags' in self.filter and not tags.intersection(self.filter['tags']):
+			return False
+		if 'exclude_tags' in self.filter and tags.intersection(self.filter['exclude_tags']):
+			return False
+		if 'collections' in self.filter and not set(data.get('collections', [])).intersection(
+				self.filter['collections']):
+			return False
+		return True
+	
+	def select(self, data):
+		'''The part of the extracted ``data`` that is published to this database.'''
+		props = data['properties']
+		out = {'properties': props if self.properties is None
+		                     else {name: props[name] for name in self.properties if name in props}}
+		if self.cover and 'cover' in data:
+			out['cover'] = data['cover']
+		if self.icon and 'icon' in data:
+			out['icon'] = data['icon']
+		if self.body and 'body' in data:
+			out['body'] = data['body']
+		return out
+
+
+@fig.component('multi-notion-publisher')
+class MultiNotionPublisher(NotionPublisher):
+	'''
+	Publishes to several Notion databases at once (see ``NotionTarget``): every item is extracted only once
+	(with all ``extractors``) and then the databases are updated concurrently.
+
+	Each database keeps track of its pages with its own attachment (by default "Notion (<name>)").
+	'''
+	@fig.silent_config_args('notion_secret')
+	def __init__(self, targets, notion_secret, notion_database_id=None, **kwargs):
+		super().__init__(notion_database_id, notion_secret, **kwargs)
+		self._targets_config = targets
+		self._notion_secret = notion_secret
+		self.targets: Dict[str, NotionTarget] = {}
+	
+	def create_target(self, name, notion_database_id, notion_secret=None, attachment=None, **kwargs):
+		return NotionTarget(name, notion_database_id,
+		                    notion_secret=self._notion_secret if notion_secret is None else notion_secret,
+		                    notion_link_attachment=f'Notion ({name})' if attachment is None else attachment,
+		                    extractors=dict(self.extractors), cover_extractor=self.cover_extractor,
+		                    icon_extractor=self.icon_extractor, ignore_failed_extractors=self.ignore_failed_extractors,
+		                    filter_extractors=kwargs.pop('filter_extractors', self._filter_extractors),
+		                    notion_root=self.notion_root, notion_version=self._notion_header['Notion-Version'],
+		                    notion_schema_max_age=self.notion_schema_max_age, **kwargs)
+	
+	def prepare(self, zot):
+		# the targets share the extractors (so they are created once the publisher is fully configured)
+		self.targets = {name: self.create_target(name, **target) for name, target in self._targets_config.items()}
+		for target in self.targets.values():
+			target.prepare(zot)
+		self.prepare_memo()
+	
+	def extraction_config(self):
+		return md5(json.dumps([super().extraction_config(), self._targets_config], sort_keys=True))
+	
+	def process(self, item, get_children=None, manager=None):
+		if self.memo is not None and self.memo.is_unchanged(item):
+			manager.log_success('skipped', 'Unchanged since the last sync', item)
+			return
+		
+		try:
+			data, errors = self.extract(item, get_children)
+		except Extractor.SkipItem as e:
+			manager.log_error(e, item=item)
+			return
+		for name, error in errors.items():
+			manager.log_error(f'{name}: {type(error).__name__}', str(error), item)
+		
+		todos = [target.process_data(item, target.select(data), get_children) for target in self.targets.values()
+		         if target.matches(item)]
+		todo = self.PublishTodo(item, data, children=None if self.memo is None else get_children())
+		todo.targets = todos
+		self.publish_todo.append(todo)
+		return todo
+	
+	def publish(self, manager: Script_Manager):
+		from concurrent.futures import ThreadPoolExecutor
+		with ThreadPoolExecutor(max_workers=max(len(self.targets), 1)) as executor:
+			for future in [executor.submit(target.publish, manager, False) for target in self.targets.values()]:
+				future.result()
+		for todo in self.publish_todo:
+			if self.memo is not None and manager.is_real_run and all(t.done for t in todo.targets):
+				self.memo.record(todo.item, todo.children, self.fingerprint(todo.data))
+		self.publish_todo.clear()
+
+
+def prepare_sync_notion(A):
 	A.push('manager._type', 'zotero-manager', overwrite=False, silent=True)
 	A.push('manager.pbar_desc', 'Sync with Notion', overwrite=False, silent=True)
-	manager: Script_Manager = A.pull('manager')
 	
 	publisher_ident = A.pull('publisher_ident', 'default')
 
@@ -680,39 +1244,47 @@ def sync_notion(A):
 			raise Exception(f'Multiple collections found for {collection_name}')
 		zot_query['collection'] = res[0]['key']
 	
-	manager.preamble(zot=zot)
 	publisher.prepare(zot)
+	return {'zot': zot, 'publisher': publisher, 'zot_query': zot_query}
+
+
+def run_sync_notion(manager: Script_Manager, zot: ZoteroProcess, publisher: Publisher, zot_query=None, keys=None):
+	if zot_query is None:
+		zot_query = {}
 	
-	todo = zot.top(**zot_query)
+	manager.preamble(zot=zot)
+	publisher.refresh(zot)
+	
+	todo = zot.top(keys=keys, stream=True, **zot_query)
 	# if A.pull('skip-computer-programs', True):
 	# 	todo = [item for item in todo if item.get('data', {}).get('itemType') not in {'computerProgram', ''}]
-	manager.log(f'Found {len(todo)} new items to process.')
+	if isinstance(todo, list): # otherwise the items are processed as they arrive
+		manager.log(f'Found {len(todo)} new items to process.')
 	
-	for item in manager.iterate(todo):
+	def process_item(item):
 		@lru_cache
 		def get_children(**kwargs):
 			return zot.children(item['key'], **kwargs)
 		try:
-			publisher.process(item, get_children=get_children, manager=manager)
+			with manager.timed(item):
+				publisher.process(item, get_children=get_children, manager=manager)
 		except Exception as e:
 			manager.log_error(e, item=item)
 			# raise
-			
+		info = get_children.cache_info()
+		metrics.record_cache('children', hits=info.hits, misses=info.misses)
+	
+	manager.map(process_item, todo)
 	publisher.publish(manager)
-	return manager.finish()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+	out = manager.finish()
+	if manager.is_real_run:
+		publisher.commit(zot)
+	return out
 
 
+@fig.script('sync-notion', description='Sync Zotero items with a Notion database.')
+def sync_notion(A):
+	components = prepare_sync_notion(A)
+	manager: Script_Manager = A.pull('manager')
+	with manager.guard():
+		return run_sync_notion(manager, keys=A.pull('keys', None), **components)
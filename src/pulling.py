@@ -0,0 +1,281 @@
+from pathlib import Path
+import os
+import json
+from typing import Dict
+
+import omnifig as fig
+
+from .util import Script_Manager
+from .transport import transport
+from .auth import ZoteroProcess
+from .publishing import Tags
+
+
+class Puller(fig.Configurable):
+	'''Applies the value of a Notion property to a Zotero item (the reverse of an ``Extractor``).'''
+	def __call__(self, item, prop):
+		'''Updates the ``item`` in place and returns whether it changed.'''
+		raise NotImplementedError
+	
+	@staticmethod
+	def plain(prop):
+		'''The value of the Notion property as a string (or a list of strings for a multi-select).'''
+		kind = prop.get('type')
+		value = prop.get(kind)
+		if kind in {'title', 'rich_text'}:
+			return ''.join(term.get('plain_text', term.get('text', {}).get('content', '')) for term in value)
+		if kind in {'select', 'status'}:
+			return None if value is None else value['name']
+		if kind == 'multi_select':
+			return [option['name'] for option in value]
+		if kind == 'date':
+			return None if value is None else value['start']
+		if kind == 'formula':
+			return value.get(value.get('type'))
+		return value
+
+
+@fig.component('puller/tags')
+class TagsPuller(Puller):
+	'''
+	Sets the manual tags of the item (starting with ``prefix``, e.g. "status:" to pull a select property) to the
+	selected options, while automatic tags (e.g. the brand tags) are left as they are.
+	
+	The tags are compared by their published option name (see ``Tags.option_name``), so a tag like
+	"deep learning, vision" is kept as it is unless its option was removed in notion.
+	'''
+	def __init__(self, prefix='', **kwargs):
+		super().__init__(**kwargs)
+		self.prefix = prefix
+	
+	def __call__(self, item, prop):
+		names = self.plain(prop)
+		if names is None:
+			names = []
+		elif isinstance(names, str):
+			names = [names]
+		wanted = {f'{self.prefix}{name}' for name in names if len(name)}
+		
+		tags = item['data'].get('tags', [])
+		managed = {tag['tag']: Tags.option_name(tag['tag']) for tag in tags
+		           if tag.get('type', 0) == 0 and tag['tag'].startswith(self.prefix)}
+		published = set(managed.values())
+		if published == wanted:
+			return False
+		item['data']['tags'] = [tag for tag in tags if tag['tag'] not in managed or managed[tag['tag']] in wanted] \
+		                       + [{'tag': tag} for tag in sorted(wanted - published)]
+		return True
+
+
+@fig.component('puller/field')
+class FieldPuller(Puller):
+	'''Sets the given ``field`` of the item (e.g. "extra") to the (plain text) value of the property.'''
+	def __init__(self, field, separator=', ', **kwargs):
+		super().__init__(**kwargs)
+		self.field = field
+		self.separator = separator
+	
+	def __call__(self, item, prop):
+		value = self.plain(prop)
+		if value is None:
+			value = ''
+		elif isinstance(value, (list, tuple)):
+			value = self.separator.join(value)
+		value = str(value)
+		if item['data'].get(self.field, '') == value:
+			return False
+		item['data'][self.field] = value
+		return True
+
+
+class NotionDatabase(fig.Configurable):
+	'''
+	Reads the pages of a Notion database with paginated queries, where each page belongs to the Zotero item whose
+	key is in the ``key_property`` (either the key itself or a link ending with it).
+	'''
+	class NotionError(Exception):
+		pass
+	
+	@fig.silent_config_args('notion_secret')
+	def __init__(self, notion_database_id, notion_secret, key_property='Zotero Key', page_size=100,
+	             notion_version='2022-06-28', notion_root='https://api.notion.com/v1', rate_limits=None,
+	             **kwargs):
+		super().__init__(**kwargs)
+		transport.configure(rate_limits)
+		self.notion_database_id = notion_database_id
+		self.notion_root = notion_root.rstrip('/')
+		self._notion_header = {
+			'Notion-Version': notion_version,
+			'Authorization': f'Bearer {notion_secret}',
+		}
+		self._account = transport.account_key(notion_secret)
+		self.key_property = key_property
+		self.page_size = min(page_size, 100)
+	
+	
+	def send_request(self, method, url, data=None, headers=None, **kwargs):
+		if headers is None:
+			headers = self._notion_header
+		else:
+			headers = {**headers, **self._notion_header}
+		
+		endpoint = f'{method.upper()} {url[len(self.notion_root):].strip("/").split("/")[0]}'
+		resp = transport.request('notion', method, url, endpoint=endpoint, json=data, headers=headers,
+		                         account=self._account, **kwargs)
+		return resp.json()
+	
+	
+	def query(self, filter=None, sorts=None):
+		'''Yields all pages of the database matching the ``filter`` (with as many requests as necessary).'''
+		payload = {'page_size': self.page_size}
+		if filter is not None:
+			payload['filter'] = filter
+		if sorts is not None:
+			payload['sorts'] = sorts
+		
+		while True:
+			resp = self.send_request('POST', f'{self.notion_root}/databases/{self.notion_database_id}/query',
+			                         data=payload)
+			if resp.get('status', 200) != 200:
+				raise self.NotionError(f'{resp.get("status")}: {resp.get("code")} - {resp.get("message")}')
+			yield from resp.get('results', [])
+			if not resp.get('has_more') or resp.get('next_cursor') is None:
+				break
+			payload['start_cursor'] = resp['next_cursor']
+	
+	
+	def page_key(self, page):
+		prop = page.get('properties', {}).get(self.key_property)
+		if prop is None:
+			return
+		key = Puller.plain(prop)
+		if isinstance(key, str):
+			key = key.strip().rstrip('/').split('/')[-1]
+			if len(key):
+				return key
+
+
+@fig.component('notion-puller')
+class NotionPuller(NotionDatabase):
+	'''
+	Finds the pages of the Notion database that were edited since the last pull (using a query filtered on
+	``last_edited_time``), and applies the properties of each page to its Zotero item using the ``pullers``.
+	
+	The time of the most recently edited page is stored in ``notion_pull_checkpoint`` (json), so each pull only
+	requests the pages edited since then. If some pages couldn't be pulled, the checkpoint stays at the oldest
+	of them, so they are requested again by the next pull.
+	'''
+	def __init__(self, pullers=None, notion_pull_checkpoint=None, **kwargs):
+		super().__init__(**kwargs)
+		if pullers is None:
+			print('WARNING: No pullers specified')
+			pullers = {}
+		self.pullers: Dict[str, Puller] = pullers
+		
+		self.checkpoint_path = None if notion_pull_checkpoint is None else Path(notion_pull_checkpoint)
+		self.checkpoints = {}
+		if self.checkpoint_path is not None and self.checkpoint_path.exists():
+			try:
+				self.checkpoints = json.loads(self.checkpoint_path.read_text(encoding='utf-8'))
+			except ValueError:
+				pass
+		self.checkpoint = self.checkpoints.get(self.notion_database_id)
+		self.latest = self.checkpoint
+		self.unkeyed = [] # pages without a zotero key (which are pulled again once they have one)
+
+
+	def edited_pages(self, since=None):
+		'''Yields all pages edited since ``since`` (or all pages), starting with the least recently edited.'''
+		# notion rounds the edit times to the minute, so pages edited at the checkpoint are checked again
+		return self.query(filter=None if since is None else
+		                  {'timestamp': 'last_edited_time', 'last_edited_time': {'on_or_after': since}},
+		                  sorts=[{'timestamp': 'last_edited_time', 'direction': 'ascending'}])
+
+
+	def pull(self, item, page):
+		'''Applies the properties of the ``page`` to the ``item`` and returns the names of the changed ones.'''
+		changed = []
+		for name, puller in self.pullers.items():
+			prop = page['properties'].get(name)
+			if prop is not None and puller(item, prop):
+				changed.append(name)
+		return changed
+
+
+	def collect(self, manager: Script_Manager):
+		'''Returns the most recently edited page for each Zotero key (pages without a key are logged as errors).'''
+		pages = {}
+		self.unkeyed = []
+		for page in self.edited_pages(self.checkpoint):
+			if self.latest is None or page['last_edited_time'] > self.latest:
+				self.latest = page['last_edited_time']
+			key = self.page_key(page)
+			if key is None:
+				manager.log_error('MissingKey', f'Page {page.get("url", page["id"])} has no {self.key_property}')
+				self.unkeyed.append(page)
+			else:
+				pages[key] = page
+		return pages
+
+
+	def commit(self, failed=()):
+		'''Saves the checkpoint, which is kept at the oldest of the ``failed`` pages (if any).'''
+		failed = [page['last_edited_time'] for page in failed]
+		if len(failed):
+			self.latest = min(failed)
+		if self.checkpoint_path is not None and self.latest is not None:
+			self.checkpoints[self.notion_database_id] = self.latest
+			self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+			tmp = self.checkpoint_path.with_name(f'{self.checkpoint_path.name}.tmp')
+			tmp.write_text(json.dumps(self.checkpoints, indent=2), encoding='utf-8')
+			os.replace(str(tmp), str(self.checkpoint_path))
+		self.checkpoint = self.latest
+
+
+def prepare_pull_notion(A):
+	A.push('manager._type', 'zotero-manager', overwrite=False, silent=True)
+	A.push('manager.pbar_desc', 'Pull from Notion', overwrite=False, silent=True)
+	
+	A.push('zotero._type', 'zotero', overwrite=False, silent=True)
+	zot: ZoteroProcess = A.pull('zotero')
+	
+	A.push('puller._type', 'notion-puller', overwrite=False, silent=True)
+	puller: NotionPuller = A.pull('puller')
+	return {'zot': zot, 'puller': puller}
+
+
+def run_pull_notion(manager: Script_Manager, zot: ZoteroProcess, puller: NotionPuller):
+	manager.preamble(zot=zot)
+	
+	pages = puller.collect(manager)
+	items = zot.get_items(list(pages)) if len(pages) else []
+	manager.log(f'Found {len(pages)} edited pages.')
+	
+	missing = set(pages).difference(item['key'] for item in items)
+	for key in missing:
+		manager.log_error('MissingItem', f'No Zotero item with key {key} (page {pages[key].get("url")})')
+	
+	def pull_item(item):
+		changed = puller.pull(item, pages[item['key']])
+		if len(changed):
+			manager.add_update(item, msg=f'Pulled {", ".join(changed)} from Notion')
+		else:
+			manager.log_success('unchanged', 'Already up to date', item)
+	
+	manager.map(pull_item, items)
+	out = manager.finish()
+	if manager.is_real_run:
+		failed = [pages[key] for key in missing.union(manager.unwritten_keys) if key in pages] + puller.unkeyed
+		if len(failed) or not manager.num_errors:
+			puller.commit(failed)
+		else:
+			manager.log('Keeping the pull checkpoint, since not all edited pages were pulled.')
+	return out
+
+
+@fig.script('pull-notion', description='Update Zotero items with the changes made in a Notion database.')
+def pull_notion(A):
+	components = prepare_pull_notion(A)
+	manager: Script_Manager = A.pull('manager')
+	with manager.guard():
+		return run_pull_notion(manager, **components)
@@ -0,0 +1,158 @@
+from typing import Dict, List
+from collections import OrderedDict
+
+import omnifig as fig
+
+from .util import Script_Manager, Outbox
+from .auth import ZoteroProcess
+
+
+def _same_child(a: Dict, b: Dict):
+	a, b = a.get('data', a), b.get('data', b)
+	return all(a.get(field) == b.get(field) for field in ['itemType', 'title', 'url', 'path', 'note'])
+
+
+def group_entries(entries: List[Dict]):
+	'''
+	Groups the pending entries by mutation and brand tag (in the order they were sent in ``write_zotero``), where
+	only the most recent entry of each item is kept.
+	'''
+	groups = OrderedDict()
+	for op in ['create', 'branded', 'update', 'failed', 'delete']:
+		for entry in entries:
+			if entry['op'] == op:
+				group = groups.setdefault((op, entry.get('brand_tag')), OrderedDict())
+				key = entry['item'].get('data', entry['item']).get('key') or entry['id']
+				group.pop(key, None)
+				group[key] = entry
+	for (op, brand_tag), group in groups.items():
+		if op == 'failed': # updated items are branded anyway
+			updated = groups.get(('update', brand_tag), {})
+			for key in [key for key in group if key in updated]:
+				del group[key]
+	return groups
+
+
+def prepare_replay(A):
+	A.push('manager._type', 'zotero-manager', overwrite=False, silent=True)
+	A.push('manager.pbar_desc', 'Replay', overwrite=False, silent=True)
+
+	A.push('zotero._type', 'zotero', overwrite=False, silent=True)
+	zot: ZoteroProcess = A.pull('zotero')
+
+	path = A.pull('outbox', None)
+	if path is None:
+		raise ValueError('No outbox specified (set "outbox" to the journal of the pending mutations).')
+	return {'zot': zot, 'outbox': Outbox(path)}
+
+
+def run_replay(manager: Script_Manager, zot: ZoteroProcess, outbox: Outbox):
+	'''
+	Sends all pending mutations of the ``outbox`` to Zotero. Replaying is idempotent: new items are only created
+	if their parent doesn't have an identical child yet, and items are only updated (or deleted) if they didn't
+	change since the mutation was planned (otherwise the mutation was either already sent, or it would overwrite
+	newer changes, so it is logged as a conflict and set aside in the conflicts file of the outbox).
+	Only the mutations that were actually written are marked as done, so anything that failed stays pending.
+	'''
+	manager.preamble(zot=zot)
+
+	entries = outbox.pending()
+	groups = group_entries(entries)
+	manager.log(f'Found {len(entries)} pending mutations.')
+
+	if not manager.is_real_run:
+		for (op, brand_tag), group in groups.items():
+			manager.log(f'Would {op} {len(group)} items' + ('' if brand_tag is None else f' ({brand_tag})'))
+		return manager.finish()
+
+	children = {}
+	def is_new(item):
+		parent = item.get('data', item).get('parentItem')
+		if parent is None:
+			return True
+		if parent not in children:
+			children[parent] = zot.children(parent)
+		return not any(_same_child(child, item) for child in children[parent])
+
+	def update_batches(entries, **kwargs):
+		'''Updates the items (in batches of 50) and returns the entries whose batch went through.'''
+		done = []
+		for i in range(0, len(entries), 50):
+			batch = entries[i:i+50]
+			if zot.update_items([entry['item'] for entry in batch], **kwargs):
+				done.extend(batch)
+		return done
+	
+	for (op, brand_tag), group in groups.items():
+		entries = list(group.values())
+		use_brand_tag = brand_tag is not None
+		
+		if op == 'create':
+			todo = []
+			for entry in entries:
+				if is_new(entry['item']):
+					todo.append(entry)
+				else:
+					manager.log_success('skipped', 'Already created', entry['item'])
+					outbox.complete([entry['id']])
+			if len(todo):
+				out = zot.create_items([entry['item'] for entry in todo], use_brand_tag=use_brand_tag,
+				                       brand_tag=brand_tag) or {}
+				for item in out.get('successful', {}).values():
+					manager.log_success('new', 'Created item', item)
+				# the results are indexed by the position of the item in the request
+				outbox.complete(todo[int(index)]['id'] for name in ['successful', 'unchanged']
+				                for index in out.get(name, {}))
+			continue
+		
+		if op == 'failed' and not use_brand_tag: # nothing to write
+			outbox.complete(entry['id'] for entry in entries)
+			continue
+		
+		current = {item['key']: item['version'] for item in zot.get_items(list(group))} if len(group) else {}
+		todo, conflicts = [], []
+		for key, entry in zip(group, entries):
+			item = entry['item']
+			if key not in current:
+				if op == 'delete': # already deleted
+					outbox.complete([entry['id']])
+				else:
+					manager.log_error('Missing', f'Item {key} was deleted', item)
+					conflicts.append(entry)
+			elif current[key] != item.get('version', item.get('data', item).get('version')):
+				manager.log_error('Conflict', f'Item {key} changed since the {op} was planned', item)
+				conflicts.append(entry)
+			else:
+				todo.append(entry)
+		outbox.set_aside(conflicts, reason='conflict')
+		
+		if len(todo):
+			if op == 'delete':
+				results = zot.delete_items([entry['item'] for entry in todo])
+				done = [entry for entry, result in zip(todo, results) if result]
+			elif op == 'branded' and zot.ledger is not None and not zot.ledger_tags: # only recorded in the ledger
+				zot.mark_items(brand_tag, [entry['item'] for entry in todo])
+				done = todo
+			elif op == 'failed' and zot.ledger is not None:
+				zot.mark_items(brand_tag, [entry['item'] for entry in todo], status='failed')
+				done = update_batches(todo, brand_tag=brand_tag, status='failed') if zot.ledger_tags else todo
+			else:
+				done = update_batches(todo, use_brand_tag=use_brand_tag, brand_tag=brand_tag,
+				                      status='failed' if op == 'failed' else 'done')
+			for entry in done:
+				manager.log_success(op, f'Replayed {op}', entry['item'])
+			if len(done) < len(todo):
+				manager.log(f'Replaying {len(todo) - len(done)}/{len(todo)} {op} mutations failed '
+				            f'(they stay in the outbox).')
+			outbox.complete(entry['id'] for entry in done)
+
+	outbox.compact()
+	return manager.finish()
+
+
+@fig.script('replay', description='Send the pending Zotero mutations of the outbox (e.g. after a crash).')
+def replay(A):
+	components = prepare_replay(A)
+	manager: Script_Manager = A.pull('manager')
+	with manager.guard():
+		return run_replay(manager, **components)
@@ -0,0 +1,105 @@
+from typing import Dict, List, Optional, Union
+import time
+from datetime import datetime
+
+import omnifig as fig
+
+from .metrics import metrics
+from .features import Attachment_Based
+
+
+@fig.component('scheduler')
+class Scheduler(Attachment_Based):
+	'''
+	Orders the pending work by ``priority`` and decides when a run has to stop to stay within its budgets.
+
+	The priorities are applied in order (ties are broken by the next one): "newest" or "oldest" (``dateAdded``),
+	"flagged" (items in one of the ``flagged_collections`` first), and "smallest" (smallest files first, only
+	for attachments). The first priority is also used to sort the Zotero query itself (if possible), so that the
+	``limit`` keeps the most important items, and the flagged collections are queried separately.
+
+	The ``time_budget`` (in seconds) and the ``quota_budgets`` (max requests per service, e.g. ``{graph: 500}``)
+	are measured from the start of the run (the script, or the call of the engine, see ``metrics.start_run``).
+	Once a budget is exhausted, the remaining items are skipped (and left for the next run).
+	'''
+	def __init__(self, priority=('newest',), flagged_collections=(), time_budget=None, quota_budgets=None,
+	             **kwargs):
+		super().__init__(**kwargs)
+		if isinstance(priority, str):
+			priority = [priority]
+		for rule in priority:
+			if rule not in self._rules:
+				raise ValueError(f'Unknown priority: {rule} (use any of {", ".join(self._rules)})')
+		self.priority = list(priority)
+		if isinstance(flagged_collections, str):
+			flagged_collections = [flagged_collections]
+		self.flagged_collections = list(flagged_collections or [])
+		self.time_budget = time_budget
+		self.quota_budgets = quota_budgets or {}
+
+	_rules = ('newest', 'oldest', 'flagged', 'smallest')
+
+
+	def sort_kwargs(self) -> Dict[str, str]:
+		'''Sorting of the Zotero query which matches the first priority (if any).'''
+		if len(self.priority) and self.priority[0] in {'newest', 'oldest'}:
+			return {'sort': 'dateAdded', 'direction': 'desc' if self.priority[0] == 'newest' else 'asc'}
+		return {}
+
+	@property
+	def uses_flagged(self):
+		return 'flagged' in self.priority and len(self.flagged_collections) > 0
+
+
+	@staticmethod
+	def _added(data):
+		try:
+			return datetime.fromisoformat(data.get('dateAdded', '').replace('Z', '+00:00')).timestamp()
+		except ValueError:
+			return 0.
+
+	def _size(self, data):
+		path = data.get('path')
+		if path is None:
+			return 0
+		try:
+			path = self.fix_path(path)
+			return path.stat().st_size if path.exists() else 0
+		except (OSError, ValueError):
+			return 0
+
+	def key(self, item: Union[Dict, List[Dict]]):
+		'''Sort key of an item (or a group of attachments, e.g. of the same parent).'''
+		items = item if isinstance(item, (list, tuple)) else [item]
+		datas = [entry.get('data', entry) for entry in items]
+		key = []
+		for rule in self.priority:
+			if rule == 'newest':
+				key.append(-max(map(self._added, datas), default=0.))
+			elif rule == 'oldest':
+				key.append(min(map(self._added, datas), default=0.))
+			elif rule == 'flagged':
+				flagged = any(collection in self.flagged_collections
+				              for data in datas for collection in data.get('collections', []))
+				key.append(0 if flagged else 1)
+			elif rule == 'smallest':
+				key.append(sum(map(self._size, datas)))
+		return tuple(key)
+
+	def order(self, items: List) -> List:
+		if not len(self.priority):
+			return list(items)
+		return sorted(items, key=self.key)
+
+
+	def exhausted(self) -> Optional[str]:
+		'''Returns the reason why the run has to stop (or None if all budgets are still available).'''
+		if self.time_budget is not None:
+			elapsed = time.time() - metrics.started
+			if elapsed >= self.time_budget:
+				return f'time budget of {self.time_budget}s exhausted'
+		if len(self.quota_budgets):
+			counts = metrics.request_counts()
+			for service, budget in self.quota_budgets.items():
+				if counts.get(service, 0) >= budget:
+					return f'{service} budget of {budget} requests exhausted'
@@ -3,33 +3,26 @@ import copy
 import omnifig as fig
 from pathlib import Path
 from tqdm import tqdm
-import backoff
 from tabulate import tabulate
 from collections import OrderedDict
 from urllib.parse import urlparse
-from wordcloud import WordCloud, STOPWORDS
 
 import re
-import fitz
 import urllib.parse
 import requests
-import pdfkit
-import PyPDF2
-from fuzzywuzzy import fuzz
 
 from .auth import ZoteroProcess, OneDriveProcess
 from .features import Attachment_Based
 from .util import create_url, get_now, split_by_filter, Script_Manager
+from .metrics import metrics
 
 
-@fig.script('onedrive-links', description='Create OneDrive share links of zotero attachments')
-def onedrive_sharing(A):
+def prepare_onedrive_links(A):
 	silence_config = A.pull('silence-config', A.pull('silent', silent=True), silent=True)
 	A.silence(silence_config)
 
 	A.push('manager._type', 'zotero-manager', overwrite=False, silent=True)
 	A.push('manager.pbar_desc', 'OneDrive Links', overwrite=False, silent=True)
-	manager: Script_Manager = A.pull('manager')
 	
 	share_type = A.pull('share-type', None)  # {'view', 'edit', 'download', 'embed'}
 	source_name = A.pull('source-name', 'PDF')
@@ -37,34 +30,41 @@ def onedrive_sharing(A):
 	if attachment_name is None and A.pull('use-attachment', False):
 		attachment_name = 'OneDrive' if share_type is None else f'OneDrive {share_type.capitalize()}'
 	
-	link_type = 'file' if share_type is None else f'share ({share_type})'
-	out_type = 'the attachment URL' if attachment_name is None else f'a separate attachment "{attachment_name}"'
-	manager.log(f'Creating {link_type} links for attachments named "{source_name}" '
-	            f'and storing them as {out_type}.')
-	
 	onedrive_root = Path(A.pull('onedrive-root', str(Path.home() / 'OneDrive')))
 	
 	A.push('onedrive._type', 'onedrive-auth', overwrite=False, silent=True)
 	auth: OneDriveProcess = A.pull('onedrive')
-	if manager.is_real_run:
-		auth.authorize()
 
 	A.push('brand_tag', 'onedrive' if share_type is None else f'onedrive-{share_type}', overwrite=False, silent=True)
 	A.push('zotero._type', 'zotero', overwrite=False, silent=True)
 	zot: ZoteroProcess = A.pull('zotero')
 	
-	manager.preamble(zot=zot)
-	
 	A.push('attachment-fixer._type', 'attachment-path', overwrite=False, silent=True)
 	fixer: Attachment_Based = A.pull('attachment-fixer')
+	return {'zot': zot, 'auth': auth, 'fixer': fixer, 'onedrive_root': onedrive_root,
+	        'share_type': share_type, 'source_name': source_name, 'attachment_name': attachment_name}
+
+
+def run_onedrive_links(manager: Script_Manager, zot: ZoteroProcess, auth: OneDriveProcess, fixer: Attachment_Based,
+                       onedrive_root: Path, share_type=None, source_name='PDF', attachment_name=None, keys=None):
+	link_type = 'file' if share_type is None else f'share ({share_type})'
+	out_type = 'the attachment URL' if attachment_name is None else f'a separate attachment "{attachment_name}"'
+	manager.log(f'Creating {link_type} links for attachments named "{source_name}" '
+	            f'and storing them as {out_type}.')
+	
+	if manager.is_real_run:
+		auth.authorize()
+	
+	manager.preamble(zot=zot)
 	
 	timestamp = get_now()
 	
-	attachments = zot.collect(q=source_name, itemType='attachment')
+	attachments = zot.collect(q=source_name, itemType='attachment', keys=keys)
 	attachments, unused = split_by_filter(attachments, lambda item: item['data']['linkMode'] == 'linked_file')
 	manager.add_failed(*unused, msg='linkMode != "linked_file"')
 	attachments = [item for item in attachments if item['data']['linkMode'] == 'linked_file']
 	manager.log(f'Found {len(attachments)} new linked file attachments named "{source_name}".')
+	metrics.add_items(manager.stage_name, len(attachments))
 	
 	paths = {}
 	for item in attachments:
@@ -137,14 +137,11 @@ def onedrive_sharing(A):
 			manager.log_success('OneDrivePath', str(path), item)
 	
 	return manager.finish()
-	
-
-
-
-
-
-
-
-
 
 
+@fig.script('onedrive-links', description='Create OneDrive share links of zotero attachments')
+def onedrive_sharing(A):
+	components = prepare_onedrive_links(A)
+	manager: Script_Manager = A.pull('manager')
+	with manager.guard():
+		return run_onedrive_links(manager, keys=A.pull('keys', None), **components)
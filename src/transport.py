@@ -0,0 +1,436 @@
+from typing import Dict, Optional, Callable, Tuple, Any, Union
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from pathlib import Path
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from .metrics import metrics
+
+
+class CircuitOpenError(Exception):
+	def __init__(self, service: str, remaining: float):
+		super().__init__(f'{service}: too many consecutive failures, not sending any requests '
+		                 f'for another {remaining:.0f} sec')
+		self.service = service
+		self.remaining = remaining
+
+
+class ThrottledError(Exception):
+	def __init__(self, service: str, wait: float):
+		super().__init__(f'{service}: throttled for {wait:.0f} sec (longer than the max wait)')
+		self.service = service
+		self.wait = wait
+
+
+def parse_retry_after(value) -> Optional[float]:
+	'''Seconds to wait given a ``Retry-After`` (or ``Backoff``) header, which is either seconds or a date.'''
+	if value is None:
+		return None
+	try:
+		return max(float(value), 0.)
+	except (TypeError, ValueError):
+		pass
+	try:
+		return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.)
+	except (TypeError, ValueError):
+		return None
+
+
+class TokenBucket:
+	'''
+	Allows ``rate`` requests per second on average with bursts of up to ``burst`` requests (no limit if ``rate``
+	is None). The bucket can also be paused, e.g. when the server asks to back off.
+	'''
+	def __init__(self, rate: Optional[float] = None, burst: int = 1):
+		self.rate = rate
+		self.burst = max(burst, 1)
+		self._tokens = float(self.burst)
+		self._last = time.monotonic()
+		self._paused_until = 0.
+		self._lock = threading.Lock()
+
+	def pause(self, seconds: float):
+		with self._lock:
+			self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+	def reserve(self) -> float:
+		'''Takes a token and returns how long to wait before it may be used.'''
+		with self._lock:
+			now = time.monotonic()
+			wait = max(self._paused_until - now, 0.)
+			if self.rate is not None:
+				self._tokens = min(float(self.burst), self._tokens + (now - self._last) * self.rate)
+				self._last = now
+				self._tokens -= 1
+				if self._tokens < 0:
+					wait = max(wait, -self._tokens / self.rate)
+			return wait
+
+
+class CircuitBreaker:
+	'''
+	Stops sending requests to a service after ``failure_threshold`` consecutive failures (server errors or
+	unreachable), until ``reset_timeout`` seconds have passed. Then a single trial request is let through which
+	either closes the circuit again or reopens it.
+	'''
+	def __init__(self, failure_threshold: Optional[int] = 5, reset_timeout: float = 60.):
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.failures = 0
+		self._opened = None
+		self._trial = False
+		self._lock = threading.Lock()
+
+	@property
+	def is_open(self):
+		return self._opened is not None
+
+	def check(self, service: str):
+		with self._lock:
+			if self._opened is None:
+				return
+			remaining = self._opened + self.reset_timeout - time.monotonic()
+			if remaining > 0 or self._trial:
+				raise CircuitOpenError(service, max(remaining, 0.))
+			self._trial = True
+
+	def record_success(self):
+		with self._lock:
+			self.failures = 0
+			self._opened = None
+			self._trial = False
+
+	def record_failure(self):
+		with self._lock:
+			self.failures += 1
+			if self._trial or (self.failure_threshold is not None and self.failures >= self.failure_threshold):
+				self._opened = time.monotonic()
+			self._trial = False
+
+
+class HttpCache:
+	'''
+	Cache of GET responses which are revalidated with the validators of the response (``ETag``,
+	``Last-Modified`` and Zotero's ``Last-Modified-Version``), so unchanged resources are answered with a
+	(small) 304 instead of the full response.
+
+	Entries are kept in memory and, if ``root`` is given, persisted as one json file per entry in
+	``root/<service>/``, so they are reused across runs.
+	'''
+	_validators = {'etag': 'If-None-Match', 'last-modified': 'If-Modified-Since',
+	               'last-modified-version': 'If-Modified-Since-Version'}
+
+	def __init__(self, root: Optional[Union[str, Path]] = None):
+		self.root = None if root is None else Path(root)
+		self._entries = {}
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def _key(service: str, url: str) -> str:
+		return hashlib.md5(f'{service} {url}'.encode('utf-8')).hexdigest()
+
+	def _path(self, service: str, key: str) -> Optional[Path]:
+		return None if self.root is None else self.root / service / f'{key}.json'
+
+	def get(self, service: str, url: str) -> Optional[Dict]:
+		key = self._key(service, url)
+		with self._lock:
+			entry = self._entries.get(key)
+		if entry is None:
+			path = self._path(service, key)
+			if path is not None and path.exists():
+				try:
+					entry = json.loads(path.read_text(encoding='utf-8'))
+				except ValueError: # e.g. an interrupted write
+					return None
+				with self._lock:
+					self._entries[key] = entry
+		return entry
+
+	def put(self, service: str, url: str, body: str, headers: Dict[str, str]) -> Optional[Dict]:
+		'''Stores the body of a response with its validators (the other headers are dropped).'''
+		headers = {k.lower(): str(v) for k, v in headers.items() if k.lower() in self._validators}
+		entry = {'url': url, 'headers': headers, 'body': body, 'stored': time.time()}
+		key = self._key(service, url)
+		with self._lock:
+			self._entries[key] = entry
+		path = self._path(service, key)
+		if path is not None:
+			path.parent.mkdir(parents=True, exist_ok=True)
+			tmp = path.with_name(f'{path.name}.{threading.get_ident()}.tmp')
+			tmp.write_text(json.dumps(entry), encoding='utf-8')
+			os.replace(str(tmp), str(path))
+		return entry
+
+	def conditional_headers(self, entry: Dict) -> Dict[str, str]:
+		return {self._validators[k]: v for k, v in entry['headers'].items() if k in self._validators}
+
+	def is_fresh(self, entry: Dict, max_age: Optional[float] = None) -> bool:
+		return max_age is not None and time.time() - entry['stored'] < max_age
+
+	@staticmethod
+	def response(entry: Dict) -> requests.Response:
+		'''Recreates the (successful) response from the entry.'''
+		resp = requests.Response()
+		resp.status_code = 200
+		resp.url = entry['url']
+		resp.encoding = 'utf-8'
+		resp.headers = CaseInsensitiveDict(entry['headers'])
+		resp._content = entry['body'].encode('utf-8')
+		return resp
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+
+class RateLimiter:
+	'''
+	Sends all requests to a single service: waits for the token bucket, retries throttled (429) and failed
+	(5xx or unreachable) requests with exponential backoff and jitter (or as long as the server asks with
+	``Retry-After``/``Backoff``), trips the circuit breaker, and tracks the quota reported in the response headers.
+	'''
+	def __init__(self, service: str, rate: Optional[float] = None, burst: int = 1, max_retries: int = 5,
+	             backoff_base: float = 1., backoff_max: float = 60., jitter: bool = True,
+	             max_wait: Optional[float] = None, failure_threshold: Optional[int] = 5,
+	             reset_timeout: float = 60., retry_statuses=(429, 500, 502, 503, 504), pool_size: int = 16):
+		self.service = service
+		self.bucket = TokenBucket(rate, burst)
+		self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+		self.max_retries = max_retries
+		self.backoff_base = backoff_base
+		self.backoff_max = backoff_max
+		self.jitter = jitter
+		self.max_wait = max_wait
+		self.retry_statuses = set(retry_statuses)
+		self.quota = {}
+		self.pool_size = pool_size
+		self._session = None
+		self._session_lock = threading.Lock()
+
+	@property
+	def session(self) -> requests.Session:
+		'''Session of the service (created on first use), so connections are kept alive and reused.'''
+		if self._session is None:
+			with self._session_lock:
+				if self._session is None:
+					session = requests.Session()
+					adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+					session.mount('https://', adapter)
+					session.mount('http://', adapter)
+					self._session = session
+		return self._session
+
+	def configure(self, rate=..., burst=None, **kwargs):
+		if rate is not ...:
+			self.bucket.rate = rate
+		if burst is not None:
+			self.bucket.burst = max(burst, 1)
+		for key, value in kwargs.items():
+			if key in {'failure_threshold', 'reset_timeout'}:
+				setattr(self.breaker, key, value)
+			elif key == 'retry_statuses':
+				self.retry_statuses = set(value)
+			elif hasattr(self, key):
+				setattr(self, key, value)
+			else:
+				raise TypeError(f'Unknown rate limit option for {self.service}: {key}')
+		return self
+
+
+	def backoff(self, attempt: int) -> float:
+		delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+		return random.uniform(delay / 2, delay) if self.jitter else delay
+
+	def wait(self, seconds: float):
+		'''Blocks this (and, through the bucket, every other) request to the service for ``seconds``.'''
+		if self.max_wait is not None and seconds > self.max_wait:
+			raise ThrottledError(self.service, seconds)
+		self.bucket.pause(seconds)
+		self._sleep(self.bucket.reserve())
+
+	def _sleep(self, seconds: float):
+		if seconds > 0:
+			metrics.add_wait(self.service, seconds)
+			time.sleep(seconds)
+
+	def update_quota(self, headers):
+		'''Tracks the quota of the service (if reported) and respects any ``Backoff`` header.'''
+		if headers is None:
+			return
+		quota = {}
+		for key in ['limit', 'remaining', 'reset']:
+			value = headers.get(f'x-ratelimit-{key}', headers.get(f'ratelimit-{key}'))
+			if value is not None:
+				try:
+					quota[key] = float(value)
+				except ValueError:
+					pass
+		if len(quota):
+			self.quota.update(quota)
+			metrics.set_quota(self.service, **quota)
+			if quota.get('remaining') == 0 and 'reset' in quota:
+				# the reset is either the seconds until the reset or the (epoch) time of the reset
+				reset = quota['reset']
+				self.bucket.pause(reset - time.time() if reset > 1e9 else reset)
+		backoff = parse_retry_after(headers.get('backoff'))
+		if backoff:
+			self.bucket.pause(backoff)
+
+
+	def call(self, send_fn: Callable[[], Any], endpoint: str = 'request',
+	         get_response: Optional[Callable[[], Any]] = None,
+	         retry_exceptions: Tuple = (requests.ConnectionError, requests.Timeout)):
+		'''
+		Sends a request with ``send_fn`` (and retries it if necessary).
+
+		By default ``send_fn`` returns the response, otherwise ``get_response`` is used to get the response
+		(e.g. for clients like pyzotero which only return the parsed output). Exceptions of the types in
+		``retry_exceptions`` are retried, the last one is raised if all retries fail.
+		'''
+		attempt = 0
+		while True:
+			self.breaker.check(self.service)
+			self._sleep(self.bucket.reserve())
+			error, wait = None, None
+			with metrics.timed_request(self.service, endpoint) as info:
+				try:
+					out = send_fn()
+				except retry_exceptions as e:
+					error = e
+					out = None
+				resp = out if get_response is None else get_response()
+				info['response'] = resp
+
+			status = getattr(resp, 'status_code', None)
+			headers = getattr(resp, 'headers', None)
+			self.update_quota(headers)
+			if error is None and status not in self.retry_statuses:
+				self.breaker.record_success()
+				return out
+
+			if status == 429:
+				metrics.add_throttled(self.service)
+				wait = parse_retry_after(None if headers is None else headers.get('retry-after'))
+			else:
+				self.breaker.record_failure()
+				if status is not None and headers is not None:
+					wait = parse_retry_after(headers.get('retry-after'))
+			if attempt >= self.max_retries or self.breaker.is_open:
+				if error is not None:
+					raise error
+				return out
+			metrics.add_retry(self.service)
+			self.wait(self.backoff(attempt) if wait is None else wait)
+			attempt += 1
+
+
+	def request(self, method: str, url: str, endpoint: Optional[str] = None, **kwargs) -> requests.Response:
+		if endpoint is None:
+			endpoint = method.upper()
+		return self.call(lambda: self.session.request(method.upper(), url, **kwargs), endpoint=endpoint)
+
+
+class Transport:
+	'''
+	All outbound requests go through the ``RateLimiter`` of their service, so the limits (and the pooled
+	connections) are shared by all clients and threads of the process. Idempotent GETs can be cached in ``cache``.
+
+	The defaults follow the documented limits of each service (Notion: 3 requests/sec, Semantic Scholar:
+	100 requests per 5 min without an API key). Zotero and Graph don't have fixed limits, but both tell clients
+	to back off (with the ``Backoff`` and ``Retry-After`` headers).
+	
+	Services which limit each account separately (e.g. every Notion integration) get one limiter per ``account``
+	(see ``account_key``), all with the options of the service.
+	'''
+	_defaults = {
+		'zotero': {},
+		'graph': {},
+		'notion': {'rate': 3., 'burst': 3},
+		'semanticscholar': {'rate': 1/3, 'burst': 1, 'max_retries': 3},
+	}
+
+	def __init__(self, cache_root=None):
+		self._limiters = {}
+		self._options = {}
+		self._lock = threading.Lock()
+		self.cache = HttpCache(cache_root)
+	
+	@staticmethod
+	def account_key(secret: str) -> str:
+		'''Identifies the account of a secret (without keeping the secret itself).'''
+		return hashlib.sha256(secret.encode('utf-8')).hexdigest()[:12]
+	
+	def limiter(self, service: str, account: Optional[str] = None) -> RateLimiter:
+		name = service if account is None else (service, account)
+		with self._lock:
+			if name not in self._limiters:
+				limiter = RateLimiter(service, **self._defaults.get(service, {}))
+				limiter.configure(**self._options.get(service, {}))
+				self._limiters[name] = limiter
+			return self._limiters[name]
+
+	def configure(self, limits: Optional[Dict[str, Dict]] = None, http_cache=None, **services: Dict):
+		'''
+		Sets the rate limits and retry policy of services, e.g. ``configure(notion={'rate': 2.5})``, and the
+		directory where the http cache is persisted (if ``http_cache`` is given).
+		'''
+		if limits is not None:
+			services = {**limits, **services}
+		for service, options in services.items():
+			options = options or {}
+			self.limiter(service)
+			with self._lock:
+				self._options.setdefault(service, {}).update(options)
+				limiters = [limiter for limiter in self._limiters.values() if limiter.service == service]
+			for limiter in limiters:
+				limiter.configure(**options)
+		if http_cache is not None:
+			root = Path(http_cache) if http_cache else None
+			if root != self.cache.root:
+				self.cache = HttpCache(root)
+
+	def request(self, service: str, method: str, url: str, endpoint: Optional[str] = None,
+	            cache: bool = False, max_age: Optional[float] = None, account: Optional[str] = None,
+	            **kwargs) -> requests.Response:
+		'''
+		Sends a request through the limiter of the service (or of the ``account``). If ``cache``, GET requests are
+		revalidated using the cached response (if there is one), and not sent at all if the cached response is
+		younger than ``max_age`` seconds.
+		'''
+		limiter = self.limiter(service, account)
+		if not cache or method.upper() != 'GET':
+			return limiter.request(method, url, endpoint=endpoint, **kwargs)
+
+		entry = self.cache.get(service, url)
+		if entry is not None:
+			if self.cache.is_fresh(entry, max_age):
+				metrics.record_cache(f'http-{service}', hits=1)
+				return self.cache.response(entry)
+			kwargs['headers'] = {**(kwargs.get('headers') or {}), **self.cache.conditional_headers(entry)}
+		resp = limiter.request(method, url, endpoint=endpoint, **kwargs)
+		if resp.status_code == 304 and entry is not None:
+			metrics.record_cache(f'http-{service}', hits=1)
+			entry['stored'] = time.time()
+			return self.cache.response(entry)
+		metrics.record_cache(f'http-{service}', misses=1)
+		if resp.status_code == 200 and (max_age is not None
+		                                or any(k in resp.headers for k in HttpCache._validators)):
+			self.cache.put(service, url, resp.text, resp.headers)
+		return resp
+
+	def reset(self):
+		with self._lock:
+			self._limiters.clear()
+			self._options.clear()
+		self.cache.clear()
+
+
+transport = Transport()
@@ -1,15 +1,27 @@
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Optional, Callable, Iterable
+import os
 import copy
+import csv
+import json
+import time
+import uuid
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from contextlib import contextmanager
+from collections import Counter, deque
 from datetime import datetime, timezone
 from tqdm import tqdm
 from tabulate import tabulate
 
 import omnifig as fig
 
+from .metrics import metrics
+from .profiling import Profiler
+
 import re
 import urllib.parse
-import requests
-from fuzzywuzzy import fuzz
 
 
 def get_now():
@@ -24,9 +36,170 @@ def split_by_filter(options, filter_fn):
 	return good, bad
 	
 
+class Result:
+	'''Compact record of the outcome for a single item (the item itself is not kept).'''
+	__slots__ = ('status', 'message', 'key', 'type', 'title', 'is_error')
+	
+	fields = ('status', 'message', 'key', 'type', 'title', 'is_error')
+	
+	def __init__(self, status: str, message: str, item: Optional[Dict] = None, is_error: bool = False):
+		data = {} if item is None else item.get('data', item)
+		self.status = str(status)
+		self.message = str(message)
+		self.key = data.get('key', '--')
+		self.type = data.get('itemType', '--')
+		self.title = data.get('title', '--')
+		self.is_error = is_error
+	
+	@classmethod
+	def from_error(cls, etype: Union[str, Exception], emsg: Optional[str] = None, item: Optional[Dict] = None):
+		if emsg is None:
+			return cls(type(etype).__name__, str(etype), item, is_error=True)
+		return cls(str(etype), str(emsg), item, is_error=True)
+	
+	def as_row(self):
+		return [self.status, self.message, self.key, self.type, self.title]
+	
+	def as_dict(self):
+		return {field: getattr(self, field) for field in self.fields}
+
+
+class Result_Report:
+	'''Appends results to a JSONL or CSV file (depending on the suffix) as soon as they are logged.'''
+	def __init__(self, path, stage=None):
+		self.path = Path(path)
+		self.stage = stage
+		self.fmt = 'csv' if self.path.suffix.lower() == '.csv' else 'jsonl'
+		self._file = None
+		self._writer = None
+		self._lock = threading.Lock()
+	
+	_columns = ('stage', *Result.fields)
+	
+	def open(self):
+		if self._file is None:
+			self.path.parent.mkdir(parents=True, exist_ok=True)
+			is_new = not self.path.exists() or self.path.stat().st_size == 0
+			self._file = self.path.open('a', newline='' if self.fmt == 'csv' else None, encoding='utf-8')
+			if self.fmt == 'csv':
+				self._writer = csv.writer(self._file)
+				if is_new:
+					self._writer.writerow(self._columns)
+		return self
+	
+	def write(self, result: Result):
+		row = {'stage': self.stage, **result.as_dict()}
+		with self._lock: # results can be logged from several threads (e.g. the targets of a multi-publisher)
+			self.open()
+			if self.fmt == 'csv':
+				self._writer.writerow([row[col] for col in self._columns])
+			else:
+				self._file.write(json.dumps(row) + '\n')
+			self._file.flush()
+	
+	def close(self):
+		with self._lock:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+				self._writer = None
+
+
+class Outbox:
+	'''
+	Durable journal (JSONL at ``path``) of the planned Zotero mutations ("create", "update", "delete", and "failed"
+	or "branded" for items that only need the brand tag), so that they survive a crash and can be applied later
+	with the ``replay`` script.
+	
+	Every mutation is appended (and synced to disk) as soon as it is planned, and marked as done (with a separate
+	``{"done": [...]}`` line) once it was sent, so only the mutations that were never sent stay pending.
+	Mutations which can't be sent anymore (e.g. the item changed since) are set aside in ``conflicts_path``.
+	'''
+	def __init__(self, path):
+		self.path = Path(path)
+		self.conflicts_path = self.path.with_name(f'{self.path.stem}-conflicts{self.path.suffix}')
+		self._run = uuid.uuid4().hex[:8]
+		self._count = 0
+		self._lock = threading.Lock()
+	
+	def _append(self, lines: List[Dict]):
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		with self.path.open('a', encoding='utf-8') as f:
+			for line in lines:
+				f.write(json.dumps(line) + '\n')
+			f.flush()
+			os.fsync(f.fileno())
+	
+	def append(self, op: str, items: Iterable[Dict], brand_tag: Optional[str] = None,
+	           stage: Optional[str] = None) -> List[str]:
+		'''Journals the mutation ``op`` of each item and returns the ids of the entries.'''
+		with self._lock:
+			entries = []
+			for item in items:
+				self._count += 1
+				entries.append({'id': f'{self._run}-{self._count}', 'op': op, 'brand_tag': brand_tag,
+				                'stage': stage, 'time': time.time(), 'item': item})
+			if len(entries):
+				self._append(entries)
+			return [entry['id'] for entry in entries]
+	
+	def complete(self, ids: Iterable[str]):
+		ids = list(ids)
+		if len(ids):
+			with self._lock:
+				self._append([{'done': ids}])
+	
+	def set_aside(self, entries: Iterable[Dict], reason: str):
+		'''Moves the entries to the ``conflicts_path`` (to be reviewed by hand), so they are no longer pending.'''
+		entries = [{**entry, 'reason': reason} for entry in entries]
+		if len(entries):
+			with self._lock:
+				self.conflicts_path.parent.mkdir(parents=True, exist_ok=True)
+				with self.conflicts_path.open('a', encoding='utf-8') as f:
+					for entry in entries:
+						f.write(json.dumps(entry) + '\n')
+					f.flush()
+					os.fsync(f.fileno())
+			self.complete(entry['id'] for entry in entries)
+	
+	def pending(self) -> List[Dict]:
+		'''All entries which were not marked as done (in order).'''
+		if not self.path.exists():
+			return []
+		entries, done = [], set()
+		with self._lock, self.path.open('r', encoding='utf-8') as f:
+			for line in f:
+				try:
+					line = json.loads(line)
+				except ValueError: # partially written line (the run crashed)
+					continue
+				if 'done' in line:
+					done.update(line['done'])
+				else:
+					entries.append(line)
+		return [entry for entry in entries if entry['id'] not in done]
+	
+	def compact(self):
+		'''Rewrites the journal with only the pending entries (or removes it if there are none).'''
+		entries = self.pending()
+		with self._lock:
+			if not len(entries):
+				if self.path.exists():
+					self.path.unlink()
+				return
+			tmp = self.path.with_name(f'{self.path.name}.tmp')
+			with tmp.open('w', encoding='utf-8') as f:
+				for entry in entries:
+					f.write(json.dumps(entry) + '\n')
+			os.replace(str(tmp), str(self.path))
+
+
 @fig.component('zotero-manager')
 class Script_Manager(fig.Configurable):
-	def __init__(self, dry_run=False, silent=False, pbar=None, pbar_desc=None, brand_errors=False, **kwargs):
+	def __init__(self, dry_run=False, silent=False, pbar=None, pbar_desc=None, brand_errors=False,
+	             report_path=None, max_records=100, metrics_path=None, prometheus_path=None,
+	             profile=False, profile_dir='profiles', profile_slowest=20, outbox=None, save_dry_run=False,
+	             flush_every=None, flush_interval=None, scheduler=None, **kwargs):
 		if pbar is None:
 			pbar = not silent
 		
@@ -40,8 +213,37 @@ class Script_Manager(fig.Configurable):
 		
 		self._itr = None
 		
-		self.successes = []
-		self.errors = []
+		self.report_path = report_path
+		self._report = None
+		
+		self.metrics_path = metrics_path
+		self.prometheus_path = prometheus_path
+		self.stage_name = None
+		self._running = False # between ``preamble`` and ``finish``
+		
+		self.profile = profile
+		self.profile_dir = profile_dir
+		self.profile_slowest = profile_slowest
+		self.profiler = None
+		
+		self.outbox_path = outbox
+		self.save_dry_run = save_dry_run
+		self.outbox = None
+		
+		# write the finished items to zotero during long runs (every N items or T seconds)
+		self.flush_every = flush_every
+		self.flush_interval = flush_interval
+		self._since_flush = 0
+		self._last_flush = None
+		
+		self.scheduler = scheduler
+
+		# only the most recent results are kept in memory (everything is streamed to the report file)
+		self.successes = deque(maxlen=max_records)
+		self.errors = deque(maxlen=max_records)
+		self.counts = Counter()
+		self.num_errors = 0
+		self._record_lock = threading.RLock()
 		
 		
 	class ManagerError(Exception):
@@ -51,11 +253,30 @@ class Script_Manager(fig.Configurable):
 		self.zot = zot
 		if self.is_real_run and self.zot is None:
 			raise self.ManagerError('Missing zotero instance.')
+		if self.zot is not None: # the library may have changed since the last stage (e.g. of the same engine)
+			self.zot.refresh()
 		
 		self.new_items = []
 		self.updated_items = []
 		self.remove_items = []
 		self.failed_items = []
+		self.branded_items = []
+		self.unwritten_keys = set() # of the updated/removed items whose write failed (during the whole stage)
+		
+		if self.outbox_path is not None and (self.is_real_run or self.save_dry_run):
+			self.outbox = Outbox(self.outbox_path)
+		self._journaled = {'create': [], 'update': [], 'delete': [], 'failed': [], 'branded': []}
+		self._since_flush = 0
+		self._last_flush = time.time()
+
+		metrics.start_run() # unless the stage is part of a larger run (e.g. the ``process`` script)
+		self.stage_name = metrics.start_stage(self.pbar_desc or 'stage')
+		self._running = True
+		if self.profile:
+			self.profiler = Profiler(self.stage_name, root=self.profile_dir, slowest=self.profile_slowest).start()
+		
+		if self.report_path is not None and self._report is None:
+			self._report = Result_Report(self.report_path, stage=self.pbar_desc)
 		
 		
 	def log(self, msg, **kwargs):
@@ -102,36 +323,129 @@ class Script_Manager(fig.Configurable):
 	def set_description(self, desc):
 		if self._itr is not None:
 			self._itr.set_description(desc)
-		
+	
+	@contextmanager
+	def timed(self, item: Dict, path: Optional[str] = None):
+		'''Times the processing of ``item`` (only if profiling), ``path`` is the attachment (if any).'''
+		if self.profiler is None:
+			yield
+		else:
+			with self.profiler.item(item.get('data', item).get('key', '--'), path):
+				yield
+	
+	def map(self, fn: Callable, items: Iterable, desc=None, total=None):
+		'''Calls ``fn`` on each item (in order), with a progress bar.'''
+		if total is None and hasattr(items, '__len__'):
+			total = len(items)
+		for i, item in enumerate(self.iterate(items, desc=desc, total=total)):
+			if self.out_of_budget(None if total is None else total - i):
+				break
+			fn(item)
+			metrics.add_items(self.stage_name)
+			self.checkpoint()
+	
+	def out_of_budget(self, left=None):
+		'''Whether the budget of the ``scheduler`` is exhausted (the ``left`` items are then left for the next run).'''
+		if self.scheduler is None:
+			return False
+		reason = self.scheduler.exhausted()
+		if reason is None:
+			return False
+		self.log(f'Stopping early ({reason}), {"the remaining" if left is None else left} items are left '
+		         f'for the next run.')
+		return True
+
+	def checkpoint(self):
+		'''Called after each item, flushes every ``flush_every`` items or ``flush_interval`` seconds (if set).'''
+		self._since_flush += 1
+		if (self.flush_every is not None and self._since_flush >= self.flush_every) \
+				or (self.flush_interval is not None and time.time() - self._last_flush >= self.flush_interval):
+			self.flush()
+	
+	def flush(self):
+		'''Writes all finished items to Zotero (so they are not lost if the run dies), and forgets them.'''
+		if self.is_real_run and any(len(items) for items in [self.new_items, self.updated_items, self.remove_items,
+		                                                        self.failed_items, self.branded_items]):
+			self.write_zotero()
+			self.new_items = []
+			self.updated_items = []
+			self.remove_items = []
+			self.failed_items = []
+			self.branded_items = []
+		self._since_flush = 0
+		self._last_flush = time.time()
+
+	
+	def record(self, result: Result):
+		with self._record_lock:
+			if result.is_error:
+				self.errors.append(result)
+				self.num_errors += 1
+			else:
+				self.successes.append(result)
+				self.counts[result.status] += 1
+			if self._report is not None:
+				self._report.write(result)
+	
+	def journal(self, op: str, *items):
+		'''Appends the planned mutations to the outbox (if any) before they are sent in ``write_zotero``.'''
+		if self.outbox is not None and len(items):
+			brand_tag = None if self.zot is None else self.zot.brand_tag
+			ids = self.outbox.append(op, items, brand_tag=brand_tag, stage=self.pbar_desc)
+			self._journaled[op].extend(zip(ids, items))
 	
 	def add_new(self, *items, msg='New item added.'):
-		for item in items:
-			self.new_items.append(item)
-			self.successes.append(['new', msg, item])
-		
+		with self._record_lock:
+			self.journal('create', *items)
+			for item in items:
+				self.new_items.append(item)
+				self.record(Result('new', msg, item))
+	
 	def add_update(self, *items, msg='Item updated.'):
-		for item in items:
-			self.updated_items.append(item)
-			self.successes.append(['updated', msg, item])
+		with self._record_lock:
+			self.journal('update', *items)
+			for item in items:
+				self.updated_items.append(item)
+				self.record(Result('updated', msg, item))
+	
+	def add_branded(self, *items, msg='Item processed.'):
+		'''
+		The items were processed, but only change by getting the brand tag of the stage. Without brand tags in
+		Zotero (with a ``ledger`` and without ``ledger-tags``) they are therefore not updated, but only recorded in
+		the ledger once the new items of the stage were created.
+		'''
+		if self.zot is None or self.zot.ledger_tags:
+			return self.add_update(*items, msg=msg)
+		with self._record_lock:
+			self.journal('branded', *items)
+			for item in items:
+				self.branded_items.append(item)
+				self.record(Result('updated', msg, item))
 	
 	def add_remove(self, *items, msg='Item removed.'):
-		for item in items:
-			self.remove_items.append(item)
-			self.successes.append(['removed', msg, item])
-		
+		with self._record_lock:
+			self.journal('delete', *items)
+			for item in items:
+				self.remove_items.append(item)
+				self.record(Result('removed', msg, item))
+	
 	def add_failed(self, *items, msg='Item failed.'):
-		for item in items:
-			self.failed_items.append(item)
-			self.successes.append(['failed', msg, item])
+		with self._record_lock:
+			self.journal('failed', *items)
+			for item in items:
+				self.failed_items.append(item)
+				self.record(Result('failed', msg, item))
 	
 	def log_error(self, etype: Union[str, Exception], emsg: str = None, item: Dict = {}):
 		assert emsg is not None or isinstance(etype, Exception), 'Must provide an error message.'
-		self.errors.append([etype, emsg, item])
-		if self.brand_errors and len(item):
-			self.failed_items.append(item)
+		with self._record_lock:
+			self.record(Result.from_error(etype, emsg, item))
+			if self.brand_errors and len(item):
+				self.journal('failed', item)
+				self.failed_items.append(item)
 	
 	def log_success(self, stype: str, smsg: str, item: Dict = {}):
-		self.successes.append([stype, smsg, item])
+		self.record(Result(stype, smsg, item))
 
 
 	@property
@@ -143,42 +457,114 @@ class Script_Manager(fig.Configurable):
 		self.log('Writing to Zotero library now.')
 		
 		if len(self.new_items):
-			out = self.zot.create_items(self.new_items)
+			out = self.zot.create_items(self.new_items) or {}
 			keys = [item.get('key') for item in out.get('successful', {}).values()]
 			self.log(f'Zotero: Created {len(keys)}/{len(self.new_items)} new items: {", ".join(keys)}')
 			self.out_new = out
+			# the results are indexed by the position of the item in the request
+			created = [self.new_items[int(index)] for name in ['successful', 'unchanged']
+			           for index in out.get(name, {})]
+			self._complete('create', items=created)
+			created = {id(item) for item in created}
+			uncreated = {item.get('data', item).get('parentItem') for item in self.new_items if id(item) not in created}
+		else:
+			uncreated = set()
 		
+		if len(self.branded_items):
+			# an item (or attachment) is only done once all the new items of its parent were created
+			branded, unwritten = split_by_filter(self.branded_items, lambda item: not {
+				item.get('data', item).get('key'), item.get('data', item).get('parentItem')} & uncreated)
+			self.zot.mark_items(self.zot.brand_tag, branded)
+			self._complete('branded', items=branded)
+			self.unwritten_keys.update(item.get('data', item).get('key') for item in unwritten)
+			self.log(f'Ledger: Recorded {len(branded)}/{len(self.branded_items)} processed items.')
+
 		todo = self.updated_items
+		written = []
 		fmsg = ''
 		if self.zot.brand_tag is not None:
-			todo = todo + self.failed_items
-			fmsg = f' (+{len(self.failed_items)} bad)'
-			
+			# items can fail more than once (e.g. for multiple notion databases), but are only sent once
+			seen = {item.get('data', item).get('key') for item in todo}
+			failed = []
+			for item in self.failed_items:
+				key = item.get('data', item).get('key')
+				if key is None or key not in seen:
+					seen.add(key)
+					failed.append(item)
+			if self.zot.ledger is not None:
+				# failed items are only recorded in the ledger (unless they are also tagged in zotero)
+				self.zot.mark_items(self.zot.brand_tag, failed, status='failed')
+				if self.zot.ledger_tags and len(failed):
+					written.extend(self._update_batches(failed, status='failed'))
+				else:
+					written.extend(failed)
+				failed = []
+			todo = todo + failed
+			fmsg = f' (+{len(failed)} bad)'
+		
 		if len(todo):
-			worked = self.zot.update_items(todo)
+			done = self._update_batches(todo)
+			worked = len(done) == len(todo)
+			written.extend(done)
 			if worked:
 				self.log(f'Zotero: Updated {len(self.updated_items)}{fmsg} items: '
 				         f'{", ".join([item.get("key") for item in self.updated_items])}')
 			else:
-				self.log(f'Zotero: Updating {len(self.updated_items)}{fmsg} items failed.')
+				self.log(f'Zotero: Updating {len(todo) - len(done)}/{len(todo)}{fmsg} items failed.')
+				done = {id(item) for item in done}
+				self.unwritten_keys.update(item.get('data', item).get('key') for item in todo if id(item) not in done)
 			self.out_updated = worked
-			
+		self._complete('update', 'failed', keys=[item.get('data', item).get('key') for item in written])
+		
 		if len(self.remove_items):
-			worked = self.zot.delete_items(self.remove_items)
+			results = self.zot.delete_items(self.remove_items)
+			done = [item for item, result in zip(self.remove_items, results) if result]
+			worked = len(done) == len(self.remove_items)
 			if worked:
 				self.log(f'Zotero: Removed {len(self.remove_items)} items: '
 				         f'{", ".join([item.get("key") for item in self.remove_items])}')
 			else:
-				self.log(f'Zotero: Removing {len(self.remove_items)} items failed.')
+				self.log(f'Zotero: Removing {len(self.remove_items) - len(done)}/{len(self.remove_items)} items failed.')
+				self.unwritten_keys.update(item.get('data', item).get('key')
+				                           for item, result in zip(self.remove_items, results) if not result)
 			self.out_removed = worked
+			self._complete('delete', keys=[item.get('data', item).get('key') for item in done])
 		
-		
+		if self.outbox is not None:
+			self.outbox.compact()
+	
+	def _update_batches(self, items, **kwargs):
+		'''Updates the items (in batches of 50) and returns the ones whose batch went through.'''
+		done = []
+		for i in range(0, len(items), 50):
+			batch = items[i:i+50]
+			if self.zot.update_items(batch, **kwargs):
+				done.extend(batch)
+		return done
+	
+	def _complete(self, *ops, keys=(), items=()):
+		'''
+		Marks the journaled mutations of the written items (by ``keys``, or the new ``items`` themselves) as sent.
+		All other mutations of the ``ops`` stay pending in the outbox (so they can be sent with ``replay``).
+		'''
+		if self.outbox is not None:
+			keys = {key for key in keys if key is not None}
+			items = {id(item) for item in items}
+			for op in ops:
+				self.outbox.complete([eid for eid, item in self._journaled[op]
+				                      if id(item) in items or item.get('data', item).get('key') in keys])
+				self._journaled[op] = []
+	
+	
 	def write_dry_run(self):
 		self.log('Dry run, not writing to Zotero.')
 		self.log(f'Would create {len(self.new_items)} new items.')
 		self.log(f'Would update {len(self.updated_items)} items.')
 		self.log(f'Would remove {len(self.remove_items)} items.')
-	
+		if self.outbox is not None:
+			self.log(f'Saved {sum(map(len, self._journaled.values()))} mutations to {self.outbox.path} '
+			         f'(apply them with "fig replay").')
+
 
 	def finish(self):
 		if self._itr is not None:
@@ -189,38 +575,219 @@ class Script_Manager(fig.Configurable):
 		else:
 			self.write_dry_run()
 		
+		if self._report is not None:
+			self._report.close()
+			self.log(f'Report saved to {self._report.path}')
+		
+		metrics.end_stage(self.stage_name)
+		metrics.end_run()
+		self._running = False
+		if self.metrics_path is not None or self.prometheus_path is not None:
+			metrics.export(self.metrics_path, prometheus_path=self.prometheus_path)
+		
+		if self.profiler is not None:
+			paths = self.profiler.export()
+			self.log(f'Profile saved to {", ".join(map(str, paths))}')
+			self.log(self.profiler.format_slowest())
+		
 		self.print()
 			
 		return self
-			
+	
+	
+	def abort(self):
+		'''Cleans up a stage which stopped before ``finish`` (e.g. it raised), nothing is written to Zotero.'''
+		if self.profiler is not None:
+			self.profiler.stop()
+		if not self._running:
+			return
+		self._running = False
+		if self._itr is not None:
+			self._itr.close()
+		if self._report is not None:
+			self._report.close()
+		metrics.end_stage(self.stage_name)
+		metrics.end_run()
+	
+	@contextmanager
+	def guard(self):
+		'''Runs a stage (from ``preamble`` to ``finish``), which is aborted if it doesn't finish.'''
+		try:
+			yield self
+		finally:
+			self.abort()
+	
+	@staticmethod
+	def _shown(num, records):
+		return '' if num <= len(records) else f' (showing last {len(records)})'
 
 	def print(self, successes=True, errors=True):
 		if not self.silent and successes:
 			print()
-			success = [[str(typ), str(msg),
-			        item.get('data', item).get('key', '--'),
-			        item.get('data', item).get('itemType', '--'),
-			        item.get('data', item).get('title', '--'), ]
-			       for typ, msg, item in self.successes]
+			if len(self.counts):
+				print(tabulate(sorted(self.counts.items()), headers=['Success', 'Count']))
+				print()
+			success = [result.as_row() for result in self.successes]
 			success.sort(key=lambda x: (x[0], x[1], x[3], x[4]))
+			num = sum(self.counts.values())
+			if self._shown(num, success):
+				print(f'{num} Successes{self._shown(num, success)}')
 			print(tabulate(success, headers=['Success', 'Message', 'Key', 'Type', 'Title']))
 			
 		if errors:
-			if len(self.errors):
+			if self.num_errors:
 				print()
-				print(f'{len(self.errors)} Errors')
-				errs = [[type(typ).__name__ if msg is None else str(typ),
-				            str(typ) if msg is None else str(msg),
-				        item.get('data', item).get('key', '--'),
-				        item.get('data', item).get('itemType', '--'),
-				        item.get('data', item).get('title', '--'), ]
-				       for typ, msg, item in self.errors]
+				print(f'{self.num_errors} Errors{self._shown(self.num_errors, self.errors)}')
+				errs = [result.as_row() for result in self.errors]
 				errs.sort(key=lambda x: (x[0], x[1], x[3], x[4]))
 				print(tabulate(errs, headers=['Error', 'Message', 'Key', 'Type', 'Title']))
 			else:
 				print('No Errors')
 
 
+@fig.component('parallel-manager')
+class Parallel_Manager(Script_Manager):
+	'''
+	Manager for scripts where ``map`` distributes the items over a pool of threads.
+	
+	All results logged by the workers are sent through a queue and only collected by the main thread,
+	where repeated updates of the same item (by key) are merged so that each item is written to Zotero at most once.
+	
+	Note that the functions passed to ``map`` are closures over the stage's components (zotero client, databases,
+	etc.), which can't be sent to other processes, so only threads are supported. This pays off when most of the
+	work is waiting for the APIs (Notion, Graph, and the streamed Zotero listings), whereas CPU-bound extraction
+	and the calls of the (shared) pyzotero client are effectively serial.
+	'''
+	def __init__(self, workers=4, executor=None, **kwargs):
+		super().__init__(**kwargs)
+		self.workers = workers
+		self.executor = executor
+		self._queue = None
+		self._item_index = None
+	
+	
+	def preamble(self, zot=None):
+		super().preamble(zot=zot)
+		self._queue = queue.Queue()
+		self._item_index = {'updated_items': {}, 'failed_items': {}, 'remove_items': {}, 'branded_items': {}}
+	
+	
+	def add_new(self, *items, msg='New item added.'):
+		self._queue.put(('add_new', items, {'msg': msg}))
+	
+	def add_branded(self, *items, msg='Item processed.'):
+		if self.zot is None or self.zot.ledger_tags:
+			return self.add_update(*items, msg=msg)
+		self._queue.put(('add_branded', items, {'msg': msg}))
+	
+	def add_update(self, *items, msg='Item updated.'):
+		self._queue.put(('add_update', items, {'msg': msg}))
+	
+	def add_remove(self, *items, msg='Item removed.'):
+		self._queue.put(('add_remove', items, {'msg': msg}))
+	
+	def add_failed(self, *items, msg='Item failed.'):
+		self._queue.put(('add_failed', items, {'msg': msg}))
+	
+	def log_error(self, etype: Union[str, Exception], emsg: str = None, item: Dict = {}):
+		assert emsg is not None or isinstance(etype, Exception), 'Must provide an error message.'
+		self._queue.put(('log_error', (etype, emsg, item), {}))
+	
+	def log_success(self, stype: str, smsg: str, item: Dict = {}):
+		self._queue.put(('log_success', (stype, smsg, item), {}))
+	
+	
+	def _merge_item(self, name, item):
+		'''Adds ``item`` to the list ``name``, replacing any earlier version of the same item.'''
+		key = item.get('data', item).get('key')
+		items = getattr(self, name)
+		index = self._item_index[name]
+		if key is None:
+			items.append(item)
+		elif key in index:
+			items[index[key]] = item
+		else:
+			index[key] = len(items)
+			items.append(item)
+	
+	def drain(self):
+		'''Collects all results that the workers have sent so far (must be called from the main thread).'''
+		while True:
+			try:
+				name, args, kwargs = self._queue.get_nowait()
+			except queue.Empty:
+				break
+			if name == 'add_new':
+				self.journal('create', *args)
+				for item in args:
+					self.new_items.append(item)
+					self.record(Result('new', kwargs['msg'], item))
+			elif name == 'log_error':
+				etype, emsg, item = args
+				self.record(Result.from_error(etype, emsg, item))
+				if self.brand_errors and len(item):
+					self.journal('failed', item)
+					self._merge_item('failed_items', item)
+			elif name == 'log_success':
+				self.record(Result(*args))
+			else:
+				target, status, op = {'add_update': ('updated_items', 'updated', 'update'),
+				                      'add_branded': ('branded_items', 'updated', 'branded'),
+				                      'add_remove': ('remove_items', 'removed', 'delete'),
+				                      'add_failed': ('failed_items', 'failed', 'failed')}[name]
+				self.journal(op, *args)
+				for item in args:
+					self._merge_item(target, item)
+					self.record(Result(status, kwargs['msg'], item))
+	
+	
+	def map(self, fn: Callable, items: Iterable, desc=None, total=None):
+		'''Calls ``fn`` on each item concurrently, the progress bar advances as items complete.'''
+		items = list(items)
+		executor = self.executor
+		if executor is None:
+			executor = ThreadPoolExecutor(max_workers=self.workers)
+		try:
+			futures = {executor.submit(fn, item): item for item in items}
+			stopped = False
+			for future in self.iterate(as_completed(futures), desc=desc, total=len(futures)):
+				if future.cancelled():
+					continue
+				error = future.exception()
+				if error is not None:
+					item = futures[future]
+					self.log_error(error, item=item if isinstance(item, dict) else {})
+				metrics.add_items(self.stage_name)
+				self.drain()
+				self.checkpoint()
+				if not stopped and self.scheduler is not None and self.scheduler.exhausted() is not None:
+					stopped = True # the items that didn't start yet are left for the next run
+					self.out_of_budget(sum(other.cancel() for other in futures))
+		finally:
+			if executor is not self.executor:
+				executor.shutdown()
+		self.drain()
+	
+	
+	def write_zotero(self):
+		# an item that was updated must not be sent a second time as a failed item
+		updated = set(self._item_index['updated_items'])
+		self.failed_items = [item for item in self.failed_items
+		                     if item.get('data', item).get('key') not in updated]
+		return super().write_zotero()
+	
+	def flush(self):
+		super().flush()
+		if not any(len(items) for items in [self.new_items, self.updated_items, self.remove_items,
+		                                    self.failed_items, self.branded_items]):
+			self._item_index = {'updated_items': {}, 'failed_items': {}, 'remove_items': {}, 'branded_items': {}}
+
+	
+	def finish(self):
+		self.drain()
+		return super().finish()
+
+
 _note_template = {'itemType': 'note',
  'note': '',
  'tags': [],